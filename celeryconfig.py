@@ -9,6 +9,9 @@ enable_utc = False
 ## Broker settings.
 broker_url = os.environ['REDIS_URL']
 
+## Result backend, the export chord collects submission results through it.
+result_backend = os.environ['REDIS_URL']
+
 # List of modules to import when the Celery worker starts.
 imports = ('tasks',)
 
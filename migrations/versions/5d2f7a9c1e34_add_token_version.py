@@ -0,0 +1,27 @@
+# pylint: skip-file
+"""add token version
+
+Revision ID: 5d2f7a9c1e34
+Revises: 91c3ead7bc5f
+Create Date: 2026-10-18 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2f7a9c1e34'
+down_revision = '91c3ead7bc5f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('token',
+        sa.Column('version', sa.Integer, nullable=False, server_default='1')
+    )
+
+
+def downgrade():
+    op.drop_column('token', 'version')
@@ -0,0 +1,36 @@
+# pylint: skip-file
+"""create uploaded file table
+
+Revision ID: a93f6d2b7c18
+Revises: c41e8b07d2a5
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a93f6d2b7c18'
+down_revision = 'c41e8b07d2a5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'uploaded_file',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('project_id', sa.String(11), nullable=False),
+        sa.Column('file_name', sa.Text, nullable=False),
+        sa.Column('size', sa.BigInteger, nullable=False),
+        sa.Column('sha256', sa.String(64), nullable=False),
+        sa.Column('date_uploaded', sa.DateTime(timezone=True), server_default=sa.func.now()),
+        sa.UniqueConstraint('project_id', 'file_name', 'size', 'sha256', name='uq_uploaded_file')
+    )
+    op.create_index('ix_uploaded_file_project_sha256', 'uploaded_file', ['project_id', 'sha256'])
+
+
+def downgrade():
+    op.drop_index('ix_uploaded_file_project_sha256', table_name='uploaded_file')
+    op.drop_table('uploaded_file')
@@ -0,0 +1,31 @@
+# pylint: skip-file
+"""create poll cursor table
+
+Revision ID: b6e2d9f4a731
+Revises: f3a9d1c6b208
+Create Date: 2026-10-18 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6e2d9f4a731'
+down_revision = 'f3a9d1c6b208'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'poll_cursor',
+        sa.Column('name', sa.String(64), primary_key=True),
+        sa.Column('etag', sa.Text),
+        sa.Column('last_modified', sa.Text),
+        sa.Column('date_updated', sa.DateTime(timezone=True), server_default=sa.func.now())
+    )
+
+
+def downgrade():
+    op.drop_table('poll_cursor')
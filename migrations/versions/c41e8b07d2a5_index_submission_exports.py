@@ -0,0 +1,31 @@
+# pylint: skip-file
+"""index submission exports
+
+Revision ID: c41e8b07d2a5
+Revises: 5d2f7a9c1e34
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41e8b07d2a5'
+down_revision = '5d2f7a9c1e34'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_submission_export_guid', 'submission', ['export_guid'])
+    op.create_index('ix_submission_date_exported', 'submission', ['date_exported'])
+    op.create_index('ix_submission_unexported', 'submission', ['id'],
+        postgresql_where=sa.text('date_exported IS NULL')
+    )
+
+
+def downgrade():
+    op.drop_index('ix_submission_unexported', table_name='submission')
+    op.drop_index('ix_submission_date_exported', table_name='submission')
+    op.drop_index('ix_submission_export_guid', table_name='submission')
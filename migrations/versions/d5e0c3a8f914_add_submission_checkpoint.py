@@ -0,0 +1,30 @@
+# pylint: skip-file
+"""add submission checkpoint
+
+Revision ID: d5e0c3a8f914
+Revises: a93f6d2b7c18
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5e0c3a8f914'
+down_revision = 'a93f6d2b7c18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('submission', sa.Column('checkpoint', sa.JSON))
+    op.create_index('ix_submission_checkpoint_application', 'submission',
+        [sa.text("(data->>'_id')")],
+        postgresql_where=sa.text('checkpoint IS NOT NULL')
+    )
+
+
+def downgrade():
+    op.drop_index('ix_submission_checkpoint_application', table_name='submission')
+    op.drop_column('submission', 'checkpoint')
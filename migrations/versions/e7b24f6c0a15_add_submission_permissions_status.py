@@ -0,0 +1,27 @@
+# pylint: skip-file
+"""add submission permissions status
+
+Revision ID: e7b24f6c0a15
+Revises: d5e0c3a8f914
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7b24f6c0a15'
+down_revision = 'd5e0c3a8f914'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('submission', sa.Column('permissions_status', sa.String(16)))
+    op.add_column('submission', sa.Column('permissions_result', sa.JSON))
+
+
+def downgrade():
+    op.drop_column('submission', 'permissions_result')
+    op.drop_column('submission', 'permissions_status')
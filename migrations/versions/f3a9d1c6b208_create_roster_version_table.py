@@ -0,0 +1,46 @@
+# pylint: skip-file
+"""create roster version table
+
+Revision ID: f3a9d1c6b208
+Revises: e7b24f6c0a15
+Create Date: 2026-10-18 17:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3a9d1c6b208'
+down_revision = 'e7b24f6c0a15'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'roster_version',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('version', sa.Integer, nullable=False, server_default='1')
+    )
+    op.execute("INSERT INTO roster_version (id, version) VALUES (1, 1)")
+    # any change to the user table bumps the version so workers reload their cached roster
+    op.execute("""
+        CREATE FUNCTION bump_roster_version() RETURNS trigger AS $$
+        BEGIN
+            UPDATE roster_version SET version = version + 1;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER user_roster_version
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON "user"
+        FOR EACH STATEMENT EXECUTE PROCEDURE bump_roster_version()
+    """)
+
+
+def downgrade():
+    op.execute('DROP TRIGGER user_roster_version ON "user"')
+    op.execute("DROP FUNCTION bump_roster_version()")
+    op.drop_table('roster_version')
@@ -2,14 +2,21 @@
 #pylint: disable=too-few-public-methods, invalid-name
 import os
 import datetime
+import logging
+import random
 import re
-from time import perf_counter
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from time import perf_counter, monotonic, sleep
 import json
 from dateutil import parser
 import pytz
 import requests
 from service.resources.utils import create_url, encrypt, decrypt
 from service.resources.models import TokenModel
+from service.resources.rate_limiter import create_rate_limiter
+import service.resources.bluebeam_log as bluebeam_log
 # from oauthlib.oauth2 import LegacyApplicationClient
 # from requests_oauthlib import OAuth2Session
 
@@ -36,8 +43,74 @@ DIRECTORY_STRUCTURE = [
 ]
 
 ERR_NO_UPLOAD_DIR_FOUND = "Could not find the upload directory on Bluebeam"
+ERR_NOT_A_PROJECT_USER = "Added but not listed among the project users"
 ENCRYPTION_KEY = os.environ.get("ENCRYPTION_KEY").encode()
 
+# http connection pool settings
+BLUEBEAM_POOL_CONNECTIONS = int(os.environ.get('BLUEBEAM_POOL_CONNECTIONS', '4'))
+BLUEBEAM_POOL_MAXSIZE = int(os.environ.get('BLUEBEAM_POOL_MAXSIZE', '10'))
+BLUEBEAM_POOL_BLOCK = os.environ.get('BLUEBEAM_POOL_BLOCK', 'false').lower() == 'true'
+BLUEBEAM_KEEP_ALIVE = os.environ.get('BLUEBEAM_KEEP_ALIVE', 'true').lower() == 'true'
+# number of calls of a batch, like the folders of one level of a new project, sent at a time
+BLUEBEAM_MAX_PARALLEL_CALLS = int(os.environ.get('BLUEBEAM_MAX_PARALLEL_CALLS', '4'))
+
+def create_http_session(pool_connections=BLUEBEAM_POOL_CONNECTIONS,
+                        pool_maxsize=BLUEBEAM_POOL_MAXSIZE,
+                        pool_block=BLUEBEAM_POOL_BLOCK,
+                        keep_alive=BLUEBEAM_KEEP_ALIVE):
+    """
+        creates a pooled http session for talking to bluebeam
+        pool_connections is the number of hosts to keep pools for,
+        pool_maxsize is the number of connections kept per host
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        pool_block=pool_block
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+    return session
+
+http_session = create_http_session() # pylint: disable=invalid-name
+
+def reset_http_session():
+    """
+        replaces the http session so a forked worker doesn't share sockets with its parent
+    """
+    global http_session # pylint: disable=global-statement,invalid-name
+    http_session = create_http_session()
+
+os.register_at_fork(after_in_child=reset_http_session)
+
+rate_limiter = create_rate_limiter()
+
+# retry settings
+# every call gets BLUEBEAM_RETRIES retries with full jitter exponential backoff
+# starting at BLUEBEAM_RETRY_BASE_DELAY secs, or the Retry-After of the response,
+# capped at BLUEBEAM_RETRY_MAX_DELAY secs
+BLUEBEAM_RETRIES = int(os.environ.get('BLUEBEAM_RETRIES', '3'))
+BLUEBEAM_RETRY_BASE_DELAY = float(os.environ.get('BLUEBEAM_RETRY_BASE_DELAY', '0.5'))
+BLUEBEAM_RETRY_MAX_DELAY = float(os.environ.get('BLUEBEAM_RETRY_MAX_DELAY', '30'))
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+# the request was processed, or may have been, so only safe to repeat when idempotent
+RETRY_STATUSES = (429, 502, 503, 504)
+RETRY_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+# the request was not processed, so safe to repeat for any call
+SAFE_RETRY_STATUSES = (429,)
+SAFE_RETRY_ERRORS = (requests.exceptions.ConnectTimeout,)
+
+# access token cache settings
+# the token is refreshed TOKEN_REFRESH_MARGIN secs before it expires and the
+# cached copy is checked against the db row version every TOKEN_CACHE_TTL secs
+TOKEN_REFRESH_MARGIN = int(os.environ.get('TOKEN_REFRESH_MARGIN', '300'))
+TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL', '60'))
+TOKEN_CACHE_LOCK = threading.Lock()
+token_cache = {} # pylint: disable=invalid-name
+
 def timer(func):
     """
         decorator to calculate runtime
@@ -124,24 +197,58 @@ def refresh_token(token):
 
 def get_auth_token(dbSession):
     """
-        retrieve auth token from db
-    """
-    token_query = dbSession.query(TokenModel)
-    if token_query.count() > 0:
-        token = token_query.first()
-        # convert to json
-        token = json.loads(decrypt(ENCRYPTION_KEY, token.value))
-
-        # maybe refresh token
-        now = datetime.datetime.utcnow().astimezone(pytz.UTC)
-        expiration_date = parser.parse(token['.expires'])
-        if now > expiration_date:
-            token = refresh_token(token['refresh_token'])
-            save_auth_token(dbSession, token)
-
-        return token
+        retrieve auth token
+        served from the in-process cache while it is fresh,
+        otherwise loaded from the db and refreshed if it is about to expire
+    """
+    with TOKEN_CACHE_LOCK:
+        if token_cache and utcnow() < token_cache['refresh_at']:
+            if monotonic() - token_cache['checked_at'] < TOKEN_CACHE_TTL:
+                return token_cache['token']
+            # another process may have saved a new token since it was cached
+            row = dbSession.query(TokenModel.version).order_by(TokenModel.id).first()
+            if row is not None and row.version == token_cache['version']:
+                token_cache['checked_at'] = monotonic()
+                return token_cache['token']
+        return load_auth_token(dbSession)
+
+def load_auth_token(dbSession):
+    """
+        reads the auth token from the db into the cache
+        the token row is locked while refreshing so that concurrent workers
+        don't spend the same refresh_token
+    """
+    token_row = dbSession.query(TokenModel).order_by(TokenModel.id).first()
+    if token_row is None:
+        token_cache.clear()
+        return None
+
+    token = json.loads(decrypt(ENCRYPTION_KEY, token_row.value))
+    if needs_refresh(token):
+        try:
+            token_row = dbSession.query(TokenModel)\
+                .filter(TokenModel.id == token_row.id)\
+                .with_for_update()\
+                .populate_existing()\
+                .one()
+            token = json.loads(decrypt(ENCRYPTION_KEY, token_row.value))
+            # still stale once we hold the lock, nobody else has refreshed it
+            if needs_refresh(token):
+                token = refresh_token(token['refresh_token'])
+                if 'access_token' not in token:
+                    raise Exception(token.get('error', 'Could not refresh the access token'))
+                token_row.value = encrypt(ENCRYPTION_KEY, json.dumps(token))
+                token_row.version += 1
+            version = token_row.version
+            dbSession.commit()
+        except Exception:
+            dbSession.rollback()
+            raise
+    else:
+        version = token_row.version
 
-    return None
+    cache_token(version, token)
+    return token
 
 def save_auth_token(dbSession, json_token):
     """
@@ -151,13 +258,81 @@ def save_auth_token(dbSession, json_token):
     token = None
     if token_query.count() > 0:
         token = token_query.first()
+        token.version += 1
     else:
-        token = TokenModel()
+        token = TokenModel(version=1)
         dbSession.add(token)
 
     token.value = encrypt(ENCRYPTION_KEY, json.dumps(json_token))
+    version = token.version
     dbSession.commit()
 
+    with TOKEN_CACHE_LOCK:
+        cache_token(version, json_token)
+
+def cache_token(version, token):
+    """
+        keeps the token in the in-process cache, keyed by its db row version
+    """
+    token_cache.update({
+        'version': version,
+        'token': token,
+        'refresh_at': parser.parse(token['.expires']) - \
+            datetime.timedelta(seconds=TOKEN_REFRESH_MARGIN),
+        'checked_at': monotonic()
+    })
+
+def clear_token_cache():
+    """
+        empties the in-process token cache
+    """
+    with TOKEN_CACHE_LOCK:
+        token_cache.clear()
+
+def needs_refresh(token):
+    """
+        whether the token expires within TOKEN_REFRESH_MARGIN secs
+    """
+    expiration_date = parser.parse(token['.expires'])
+    return utcnow() > expiration_date - datetime.timedelta(seconds=TOKEN_REFRESH_MARGIN)
+
+def utcnow():
+    """
+        timezone aware utc now
+    """
+    return datetime.datetime.utcnow().astimezone(pytz.UTC)
+
+def bluebeam_call(method, url, **kwargs):
+    """
+        the keyword arguments of a bluebeam_request, for calls sent as a batch
+    """
+    return {'method': method, 'url': url, **kwargs}
+
+def send_batch(calls, settle=False):
+    """
+        sends bluebeam_call()s at the same time, BLUEBEAM_MAX_PARALLEL_CALLS at a time
+        returns the (response, secs) of each call, the first error is raised once
+        every call has finished unless settle is true, then a failed call gets back
+        its error in place of a response
+    """
+    with ThreadPoolExecutor(max_workers=BLUEBEAM_MAX_PARALLEL_CALLS) as executor:
+        sent = [executor.submit(timed_request, call, settle) for call in calls]
+    return [future.result() for future in sent]
+
+def timed_request(call, settle=False):
+    """
+        sends a bluebeam_call(), returns the response and the secs it took
+        when settle is true an error is returned in place of the response
+    """
+    start_time = perf_counter()
+    try:
+        response = bluebeam_request(**call)
+    except Exception as err: # pylint: disable=broad-except
+        if not settle:
+            raise
+        response = err
+    return response, perf_counter() - start_time
+
 @timer
 def create_project(access, project_name):
     """
@@ -202,12 +377,24 @@ def project_exists(access, project_id):
     return response.status_code == 200
 
 @timer
-def create_folder(access, project_id, folder_name, comment='', parent_folder_id=0):
+def create_folder(access, project_id, folder_name, comment='', parent_folder_id=0,
+                  folder_index=None):
+    # pylint: disable=too-many-arguments
     """
         creates a folder in a project
+        records the new folder in folder_index when one is given
     """
     print("bluebeam.create_folder:{0}".format(folder_name))
     response = bluebeam_request(
+        **create_folder_call(access, project_id, folder_name, comment, parent_folder_id)
+    )
+    return folder_created(response, folder_name, folder_index)
+
+def create_folder_call(access, project_id, folder_name, comment='', parent_folder_id=0):
+    """
+        the call creating a folder
+    """
+    return bluebeam_call(
         'post',
         '{0}/projects/{1}/folders'.format(BLUEBEAM_API_BASE_URL, project_id),
         json={
@@ -216,8 +403,15 @@ def create_folder(access, project_id, folder_name, comment='', parent_folder_id=
             "Comment": comment
         },
         access=access)
+
+def folder_created(response, folder_name, folder_index=None):
+    """
+        id of the folder created, recorded in folder_index when one is given
+    """
     idee = response.json()['Id']
     print("Created folder id:{0}".format(idee))
+    if folder_index is not None:
+        folder_index.setdefault(folder_name, idee)
     return idee
 
 @timer
@@ -234,45 +428,81 @@ def get_folders(access, project_id):
     response_json = response.json()
     return response_json['ProjectFolders']
 
-def get_upload_dir_id(access, project_id):
+def get_folder_index(access, project_id):
+    """
+        fetches the folders of a project once and maps folder name to id
+        when names repeat the first folder listed wins
+    """
+    return index_folders(get_folders(access, project_id))
+
+def index_folders(folders):
     """
-        finds the upload folder id of a bluebeam project
+        maps folder name to id, when names repeat the first folder listed wins
     """
-    dir_id = dir_exists(UPLOAD_DIR_NAME, project_id, access)
+    folder_index = {}
+    for folder in folders:
+        folder_index.setdefault(folder['Name'], folder['Id'])
+    return folder_index
+
+def get_upload_dir_id(folder_index):
+    """
+        finds the upload folder id of a bluebeam project from its folder index
+    """
+    dir_id = folder_index.get(UPLOAD_DIR_NAME)
     if not dir_id:
         raise Exception(ERR_NO_UPLOAD_DIR_FOUND)
 
     return dir_id
 
-def dir_exists(name, project_id, access, dirs_array=None):
+def submittal_folder_name():
     """
-        returns directory id if it exists in the project, false otherwise
+        name of today's submittal folder
     """
-    if dirs_array is None:
-        dirs_array = get_folders(access, project_id)
+    return "{0} {1}".format(SUBMITTAL_DIR_NAME, datetime.date.today())
 
-    for folder in dirs_array:
-        if folder['Name'] == name:
-            return folder['Id']
-    return False
-
-def upload_file(access, project_id, file_name, file_path, folder_id):
+def get_submittal_folder(access, project_id, folder_id, folder_index):
     """
-        uploads a file to bluebeam for given project_id and folder_id
+        finds or creates today's submittal folder under folder_id
     """
-    print("bluebeam.upload_file:{0}".format(file_name))
-    # remove illegal characters
-    file_name = re.sub(r'["<>\|:\*\?\\/]', '_', file_name)
-
-    upload_dir_of_the_day = "{0} {1}".format(SUBMITTAL_DIR_NAME, datetime.date.today())
-    upload_dir_of_the_day_id = dir_exists(upload_dir_of_the_day, project_id, access)
+    upload_dir_of_the_day = submittal_folder_name()
+    upload_dir_of_the_day_id = folder_index.get(upload_dir_of_the_day)
     if not upload_dir_of_the_day_id:
         upload_dir_of_the_day_id = create_folder(
             access,
             project_id,
             upload_dir_of_the_day,
-            parent_folder_id=folder_id
+            parent_folder_id=folder_id,
+            folder_index=folder_index
         )
+    return upload_dir_of_the_day_id
+
+def clean_file_name(file_name):
+    """
+        replaces the characters bluebeam doesn't allow in file names
+    """
+    return re.sub(r'["<>\|:\*\?\\/]', '_', file_name)
+
+def upload_file(access, project_id, file_name, source, folder_id, folder_index, folder_lock): #pylint: disable=too-many-arguments
+    """
+        uploads a file to bluebeam for given project_id and folder_id
+        source is a file path or a SizedStream
+        folder_index is the project's folder name to id map from get_folder_index,
+        folder_lock is a threading.Lock guarding it
+    """
+    print("bluebeam.upload_file:{0}".format(file_name))
+    # remove illegal characters
+    file_name = clean_file_name(file_name)
+
+    upload_dir_of_the_day_id = folder_index.get(submittal_folder_name())
+    if not upload_dir_of_the_day_id:
+        # files uploading in parallel must not each create today's folder
+        with folder_lock:
+            upload_dir_of_the_day_id = get_submittal_folder(
+                access,
+                project_id,
+                folder_id,
+                folder_index
+            )
 
     # find out where to upload file
     response_json = initiate_upload(
@@ -286,7 +516,7 @@ def upload_file(access, project_id, file_name, file_path, folder_id):
     upload_content_type = response_json['UploadContentType']
 
     # upload file
-    upload(upload_url, file_path, upload_content_type)
+    upload(upload_url, source, upload_content_type)
 
     # confirm upload
     return confirm_upload(access, project_id, file_id)
@@ -297,7 +527,14 @@ def initiate_upload(access, project_id, file_name, folder_id):
         initate file upload with bluebeam
     """
     print("bluebeam.initiate_upload")
-    response = bluebeam_request(
+    response = bluebeam_request(**initiate_upload_call(access, project_id, file_name, folder_id))
+    return response.json()
+
+def initiate_upload_call(access, project_id, file_name, folder_id):
+    """
+        the call starting an upload
+    """
+    return bluebeam_call(
         'post',
         '{0}/projects/{1}/files'.format(BLUEBEAM_API_BASE_URL, project_id),
         json={
@@ -307,24 +544,53 @@ def initiate_upload(access, project_id, file_name, folder_id):
         access=access
     )
 
-    return response.json()
+class SizedStream():
+    """
+        read-only stream of a known length
+        lets requests send a Content-Length for a body it can't seek,
+        pre-signed upload urls don't accept chunked bodies
+    """
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.len = length
+
+    def read(self, size=-1):
+        """ reads from the wrapped stream """
+        return self.stream.read(size)
+
+    def seekable(self):
+        """ a wrapped stream that can seek, like a zip member, is rewound for a retry """
+        return hasattr(self.stream, 'seekable') and self.stream.seekable()
+
+    def tell(self):
+        """ position in the wrapped stream """
+        return self.stream.tell()
+
+    def seek(self, offset, whence=0):
+        """ moves within the wrapped stream """
+        return self.stream.seek(offset, whence)
+
+def upload_headers(content_type):
+    """
+        headers of the PUT to a pre-signed upload url
+    """
+    return {
+        'Content-Type': content_type,
+        'x-amz-server-side-encryption': 'AES256'
+    }
 
 @timer
-def upload(upload_url, file_path, content_type):
+def upload(upload_url, source, content_type):
     """
-        uploads file
+        uploads file from a path or a SizedStream
     """
     print("bluebeam.upload")
-    with open(file_path, 'rb') as file_obj:
-        bluebeam_request(
-            'put',
-            upload_url,
-            data=file_obj,
-            headers={
-                'Content-Type': content_type,
-                'x-amz-server-side-encryption': 'AES256'
-            }
-        )
+    headers = upload_headers(content_type)
+    if isinstance(source, SizedStream):
+        bluebeam_request('put', upload_url, data=source, headers=headers)
+    else:
+        with open(source, 'rb') as file_obj:
+            bluebeam_request('put', upload_url, data=file_obj, headers=headers)
 
 @timer
 def confirm_upload(access, project_id, file_id):
@@ -332,84 +598,209 @@ def confirm_upload(access, project_id, file_id):
         true/false confirm upload with bluebeam
     """
     print("bluebeam.confirm_upload")
-    response = bluebeam_request(
+    response = bluebeam_request(**confirm_upload_call(access, project_id, file_id))
+    return response.status_code == 204
+
+def confirm_upload_call(access, project_id, file_id):
+    """
+        the call confirming an upload
+    """
+    return bluebeam_call(
         'post',
         '{0}/projects/{1}/files/{2}/confirm-upload'.format(
             BLUEBEAM_API_BASE_URL,
             project_id,
             file_id),
-        access=access
+        access=access,
+        idempotent=True
     )
-    return response.status_code == 204
 
-def create_directories(access, project_id, directories, parent_folder_id=0):
+def create_directories(access, project_id, directories, parent_folder_id=0, folder_index=None):
     """
-        Recursive function for creating directories
+        creates a directory tree, a folder only needs the id of its parent so
+        each level of the tree is created at the same time
+        folders already in folder_index are kept, which finishes a tree left half made
         Returns pdf upload directory id if it was created, otherwise None
     """
     print("bluebeam.create_directories")
+    start_time = perf_counter()
+    serial_secs = 0
+    folders = 0
+    levels = 0
     pdf_folder_id = None
-    for folder in directories:
-        folder_id = create_folder(access,\
-                project_id,\
-                folder["name"],\
-                parent_folder_id=parent_folder_id)
-
-        if "subdirs" in folder:
-            possible_pdf_folder_id = create_directories(
-                access,
-                project_id,
-                folder["subdirs"],
-                folder_id
-            )
-            if possible_pdf_folder_id is not None:
-                pdf_folder_id = possible_pdf_folder_id
+    folder_ids = dict(folder_index or {})
+    level = [(folder, parent_folder_id) for folder in directories]
+    while level:
+        missing = missing_folders(level, folder_ids)
+        if missing:
+            created = send_batch([
+                create_folder_call(access, project_id, folder["name"], parent_folder_id=parent_id)
+                for folder, parent_id in missing
+            ])
+            serial_secs += record_folders(missing, created, folder_ids, folder_index)
+            folders += len(missing)
+            levels += 1
+        level, pdf_folder_id = next_level(level, folder_ids, pdf_folder_id)
+
+    log_directories(start_time, folders, levels, serial_secs)
+    return pdf_folder_id
 
+def missing_folders(level, folder_ids):
+    """
+        the (folder, parent id)s of a level of the tree that don't exist yet
+    """
+    return [(folder, parent_id) for folder, parent_id in level
+            if folder["name"] not in folder_ids]
+
+def record_folders(missing, created, folder_ids, folder_index):
+    """
+        records the folders created for a level of the tree,
+        returns the secs creating them one at a time would have taken
+    """
+    serial_secs = 0
+    for (folder, _), (response, secs) in zip(missing, created):
+        folder_ids[folder["name"]] = folder_created(response, folder["name"], folder_index)
+        serial_secs += secs
+    return serial_secs
+
+def next_level(level, folder_ids, pdf_folder_id):
+    """
+        the (folder, parent id)s of the level below and the pdf upload directory id
+    """
+    subdirs = []
+    for folder, _ in level:
+        folder_id = folder_ids[folder["name"]]
         if "pdf_uploads" in folder and folder["pdf_uploads"]:
             pdf_folder_id = folder_id
-    return pdf_folder_id
+        subdirs.extend((subdir, folder_id) for subdir in folder.get("subdirs", []))
+    return subdirs, pdf_folder_id
+
+def log_directories(start_time, folders, levels, serial_secs):
+    """
+        logs how long creating a directory tree took
+        serial_secs is how long creating the folders one at a time would have taken
+    """
+    bluebeam_log.log_request(logging.INFO, {
+        'event': 'create_directories',
+        'folders': folders,
+        'levels': levels,
+        'secs': round(perf_counter() - start_time, 4),
+        'serial_secs': round(serial_secs, 4)
+    })
 
 def assign_user_permissions(access, project_id, users):
     """
         assigns full access to each email in users
+        the users are added to the project at the same time, the project users are
+        fetched once and then the added users are given full access at the same time
+        a user who can't be added or given access doesn't stop the others
+        returns whether each user was added and given full access, and the error if not
     """
     print("assign_user_permissions")
-    emails = list(map(lambda user: user.email, users))
-    added_user_emails = []
-    for email in emails:
-        # add the user to the project
-        try:
-            add_project_user(access, project_id, email)
-            added_user_emails.append(email)
-        except Exception as err:    # pylint: disable=broad-except
-            # non blocking error
-            print("Unable to add {0} to the project".format(email))
+    report = permission_report(users)
+
+    # add the users to the project
+    added = send_batch([
+        add_project_user_call(access, project_id, result['email'])
+        for result in report
+    ], settle=True)
+    record_added(report, added)
 
     # give the users full access
     project_users = get_project_users(access, project_id)
     print("project_users: {0}".format(project_users))
-    if 'ProjectUsers' in project_users:
-        for project_user in project_users['ProjectUsers']:
-            # looking for users which were just added
-            if project_user['Email'] in added_user_emails:
-                try:
-                    user_id = project_user['Id']
-                    set_full_access_for_user(access, project_id, user_id)
-                except Exception as err:    # pylint: disable=broad-except
-                    # non blocking error
-                    # print out error and continue
-                    print("Encountered error giving access to {0}:{1}".format(
-                        project_user['Email'],
-                        err
-                    ))
+    user_ids = project_user_ids(project_users)
+    granting = to_grant(report, user_ids)
+    granted = send_batch([
+        set_full_access_for_user_call(access, project_id, user_ids[result['email'].lower()])
+        for result in granting
+    ], settle=True)
+    record_granted(granting, granted)
+    return finish_report(report, user_ids)
+
+def permission_report(users):
+    """
+        the result of assigning permissions to each email of users, one per email
+        emails are matched without regard to case, the first spelling is kept
+    """
+    report = {}
+    for user in users:
+        if user.email and user.email.lower() not in report:
+            report[user.email.lower()] = {
+                'email': user.email,
+                'added': False,
+                'full_access': False,
+                'error': None
+            }
+    return list(report.values())
+
+def record_added(report, added):
+    """
+        records the users added to the project
+    """
+    for result, (response, _) in zip(report, added):
+        if isinstance(response, Exception):
+            # non blocking error
+            print("Unable to add {0} to the project".format(result['email']))
+            result['error'] = str(response)
+        else:
+            result['added'] = True
+
+def project_user_ids(project_users):
+    """
+        maps the lowercase email of each project user to their id
+    """
+    return {
+        project_user['Email'].lower(): project_user['Id']
+        for project_user in project_users.get('ProjectUsers', [])
+    }
+
+def to_grant(report, user_ids):
+    """
+        the users added to the project who are listed among its users
+    """
+    return [
+        result for result in report
+        if result['added'] and result['email'].lower() in user_ids
+    ]
+
+def record_granted(granting, granted):
+    """
+        records the users given full access
+    """
+    for result, (response, _) in zip(granting, granted):
+        if isinstance(response, Exception):
+            # non blocking error
+            print("Encountered error giving access to {0}:{1}".format(
+                result['email'],
+                response
+            ))
+            result['error'] = str(response)
+        else:
+            result['full_access'] = True
+
+def finish_report(report, user_ids):
+    """
+        flags the users added but missing from the project users
+    """
+    for result in report:
+        if result['added'] and result['email'].lower() not in user_ids:
+            result['error'] = ERR_NOT_A_PROJECT_USER
+    return report
 
 @timer
 def add_project_user(access, project_id, email):
     """
         adds a user to a project
     """
+    bluebeam_request(**add_project_user_call(access, project_id, email))
+
+def add_project_user_call(access, project_id, email):
+    """
+        the call adding a user to a project
+    """
     print("add_project_user:{0}".format(email))
-    bluebeam_request(
+    return bluebeam_call(
         'post',
         '{0}/projects/{1}/users'.format(BLUEBEAM_API_BASE_URL, project_id),
         json={
@@ -425,7 +816,13 @@ def set_full_access_for_user(access, project_id, user_id):
     """
         sets full access to allow for user_id
     """
-    bluebeam_request(
+    bluebeam_request(**set_full_access_for_user_call(access, project_id, user_id))
+
+def set_full_access_for_user_call(access, project_id, user_id):
+    """
+        the call giving a project user full access
+    """
+    return bluebeam_call(
         'put',
         '{0}/projects/{1}/users/{2}/permissions'.format(
             BLUEBEAM_API_BASE_URL,
@@ -454,25 +851,141 @@ def get_project_users(access, project_id):
     )
     return response.json()
 
-def bluebeam_request(method, url, data=None, json=None, headers=None, access=None): #pylint: disable=too-many-arguments,redefined-outer-name
-    """ prints bluebeam requests info to log """
-    print("endpoint: {0}".format(url))
-    print("method: {0}".format(method))
-    print("request header: {0}".format(headers))
-    if data is not None:
-        print("request body: {0}".format(data))
-    if json is not None:
-        print("request body: {0}".format(json))
+def bluebeam_request(method, url, data=None, json=None, headers=None, access=None, #pylint: disable=too-many-arguments,redefined-outer-name
+                     idempotent=None, retries=BLUEBEAM_RETRIES):
+    """
+        sends a request to bluebeam and logs one json line per attempt
+        transient failures are retried up to retries times, calls that aren't
+        idempotent (POST unless told otherwise) are only retried when the
+        request was not processed
+    """
+    #pylint: disable=too-many-locals
+    headers = auth_headers(headers, access)
+    idempotent, retries, body_position = retry_policy(method, data, idempotent, retries)
+
+    attempt = 0
+    while True:
+        attempt += 1
+        throttled = rate_limiter.acquire(rate_limit_bucket(method, url))
+        entry = bluebeam_log.attempt_entry(method, url, attempt, throttled)
+        start_time = perf_counter()
+        try:
+            response = http_session.request(
+                method=method,
+                url=url,
+                data=data,
+                json=json,
+                headers=headers
+            )
+        except requests.exceptions.RequestException as err:
+            delay = error_retry_delay(entry, err, start_time, (attempt, retries, idempotent))
+            if delay is None:
+                raise
+        else:
+            delay = response_retry_delay(
+                entry,
+                response,
+                start_time,
+                (attempt, retries, idempotent),
+                headers,
+                json if json is not None else data
+            )
+            if delay is None:
+                response.raise_for_status()
+                return response
+
+        bluebeam_log.log_retry(entry, delay)
+        sleep(delay)
+        if body_position is not None:
+            data.seek(body_position)
 
+def auth_headers(headers, access):
+    """
+        adds the bearer token of access to the request headers
+    """
     if access is not None:
         if headers is None:
             headers = {}
         headers['Authorization'] = 'Bearer {0}'.format(access['access_token'])
+    return headers
+
+def retry_policy(method, data, idempotent, retries):
+    """
+        whether a call is idempotent, how many times it can be retried and
+        where its body has to be rewound to before it's sent again
+        a streamed body that can't be rewound isn't retried
+    """
+    if idempotent is None:
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+
+    body_position = None
+    if hasattr(data, 'read'):
+        if hasattr(data, 'seek') and data.seekable():
+            body_position = data.tell()
+        else:
+            retries = 0
+    return idempotent, retries, body_position
+
+def error_retry_delay(entry, err, start_time, policy):
+    """
+        secs to wait before retrying an attempt that raised err,
+        None when it isn't retried and the error is logged
+        policy is the (attempt, retries, idempotent) of the call
+    """
+    attempt, retries, idempotent = policy
+    entry['secs'] = round(perf_counter() - start_time, 4)
+    entry['error'] = type(err).__name__
+    retryable = isinstance(err, RETRY_ERRORS if idempotent else SAFE_RETRY_ERRORS)
+    if attempt > retries or not retryable:
+        bluebeam_log.log_request(logging.ERROR, entry)
+        return None
+    return backoff_delay(attempt)
+
+def response_retry_delay(entry, response, start_time, policy, headers, body): #pylint: disable=too-many-arguments
+    """
+        secs to wait before retrying an attempt that got response,
+        None when it isn't retried and the response is logged
+        policy is the (attempt, retries, idempotent) of the call
+    """
+    attempt, retries, idempotent = policy
+    entry['status'] = response.status_code
+    entry['secs'] = round(perf_counter() - start_time, 4)
+    level = logging.INFO if response.ok else logging.WARNING
+    bluebeam_log.add_bodies(entry, level, headers, body, response)
+    retryable = response.status_code in \
+        (RETRY_STATUSES if idempotent else SAFE_RETRY_STATUSES)
+    if attempt > retries or not retryable:
+        bluebeam_log.log_request(level, entry)
+        return None
+    delay = get_retry_after(response)
+    if delay is None:
+        delay = backoff_delay(attempt)
+    return delay
+
+def rate_limit_bucket(method, url):
+    """ uploads to upload urls are limited apart from the other calls """
+    if method.upper() == 'PUT' and not url.startswith(str(BLUEBEAM_API_BASE_URL)):
+        return 'upload'
+    return 'metadata'
+
+def backoff_delay(attempt):
+    """ full jitter exponential backoff for the retry after attempt """
+    return random.uniform(
+        0,
+        min(BLUEBEAM_RETRY_MAX_DELAY, BLUEBEAM_RETRY_BASE_DELAY * 2 ** (attempt - 1))
+    )
 
-    print("start timestamp: {0}".format(datetime.datetime.now()))
-    response = requests.request(method=method, url=url, data=data, json=json, headers=headers)
-    print("end timestamp: {0}".format(datetime.datetime.now()))
-    print("response header: {0}".format(response.headers))
-    print("response body: {0}".format(response.text))
-    response.raise_for_status()
-    return response
+def get_retry_after(response):
+    """ secs to wait from the Retry-After header, given in secs or as a date """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    if value.strip().isdigit():
+        delay = int(value)
+    else:
+        try:
+            retry_date = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        delay = (retry_date - utcnow()).total_seconds()
+    return min(max(delay, 0), BLUEBEAM_RETRY_MAX_DELAY)
@@ -0,0 +1,36 @@
+"""Async Bluebeam module"""
+import asyncio
+import functools
+import service.resources.bluebeam as bluebeam
+
+async def run_in_thread(func, *args):
+    """
+        runs blocking work off the event loop
+    """
+    return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+def in_thread(func):
+    """
+        async version of a bluebeam function, the call runs on the event loop's
+        thread pool so rate limiting, retries and logging stay those of the bluebeam module
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_in_thread(functools.partial(func, *args, **kwargs))
+    return wrapper
+
+create_project = in_thread(bluebeam.create_project)
+delete_project = in_thread(bluebeam.delete_project)
+project_exists = in_thread(bluebeam.project_exists)
+create_folder = in_thread(bluebeam.create_folder)
+get_folders = in_thread(bluebeam.get_folders)
+get_folder_index = in_thread(bluebeam.get_folder_index)
+create_directories = in_thread(bluebeam.create_directories)
+initiate_upload = in_thread(bluebeam.initiate_upload)
+upload = in_thread(bluebeam.upload)
+confirm_upload = in_thread(bluebeam.confirm_upload)
+upload_file = in_thread(bluebeam.upload_file)
+assign_user_permissions = in_thread(bluebeam.assign_user_permissions)
+add_project_user = in_thread(bluebeam.add_project_user)
+set_full_access_for_user = in_thread(bluebeam.set_full_access_for_user)
+get_project_users = in_thread(bluebeam.get_project_users)
@@ -0,0 +1,130 @@
+"""Bluebeam request log module"""
+import os
+import sys
+import json
+import logging
+import random
+import re
+import threading
+from collections import Counter
+from urllib.parse import urlparse
+
+# request log settings
+# one json line is logged per bluebeam call, request and response bodies are
+# included at DEBUG level, for failed calls and for BLUEBEAM_LOG_SAMPLE_RATE of
+# the other calls, truncated to BLUEBEAM_LOG_BODY_LIMIT chars
+BLUEBEAM_LOG_LEVEL = os.environ.get('BLUEBEAM_LOG_LEVEL', 'INFO').upper()
+BLUEBEAM_LOG_BODY_LIMIT = int(os.environ.get('BLUEBEAM_LOG_BODY_LIMIT', '1024'))
+BLUEBEAM_LOG_SAMPLE_RATE = float(os.environ.get('BLUEBEAM_LOG_SAMPLE_RATE', '0'))
+REDACTED = '[REDACTED]'
+REDACTED_FIELDS = ('access_token', 'refresh_token', 'client_secret', 'code', 'password')
+REDACTED_HEADERS = ('authorization',)
+REDACTED_TEXT_PATTERN = re.compile(
+    r'("(?:{0})"\s*:\s*)"[^"]*"'.format('|'.join(REDACTED_FIELDS))
+)
+PATH_ID_PATTERN = re.compile(r'^(\d+|\d{3}-\d{3}-\d{3})$')
+RETRY_METRICS_LOCK = threading.Lock()
+retry_metrics = Counter()
+
+def create_logger():
+    """
+        creates the bluebeam request logger, which writes bare json lines to stdout
+    """
+    request_logger = logging.getLogger(__name__)
+    if not request_logger.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        request_logger.addHandler(handler)
+    request_logger.setLevel(BLUEBEAM_LOG_LEVEL)
+    request_logger.propagate = False
+    return request_logger
+
+logger = create_logger() # pylint: disable=invalid-name
+
+def attempt_entry(method, url, attempt, throttled):
+    """
+        the log entry of an attempt at a call
+    """
+    entry = {
+        'event': 'bluebeam_request',
+        'method': method.upper(),
+        'path': path_template(url),
+        'attempt': attempt
+    }
+    if throttled:
+        entry['throttled'] = round(throttled, 4)
+    return entry
+
+def add_bodies(entry, level, headers, body, response):
+    """
+        adds the redacted headers and bodies of a call to its log entry
+        when it failed, at DEBUG level or when it's sampled
+    """
+    if level > logging.INFO or logger.isEnabledFor(logging.DEBUG) or \
+            random.random() < BLUEBEAM_LOG_SAMPLE_RATE:
+        entry['request_headers'] = redact_fields(headers, REDACTED_HEADERS)
+        entry['request_body'] = loggable_body(body)
+        entry['response_body'] = truncate(redact_text(str(response.text)))
+
+def log_retry(entry, delay):
+    """
+        logs and counts an attempt that is retried after delay secs
+    """
+    entry['retry_in'] = round(delay, 4)
+    entry['retries_total'] = count_retry(entry)
+    log_request(logging.WARNING, entry)
+
+def count_retry(entry):
+    """ counts a retry of a call in the retry metrics, returns the count for the call """
+    reason = entry.get('error', entry.get('status'))
+    key = '{0} {1} {2}'.format(entry['method'], entry['path'], reason)
+    with RETRY_METRICS_LOCK:
+        retry_metrics[key] += 1
+        return retry_metrics[key]
+
+def get_retry_metrics():
+    """ retries per call and reason since the process started """
+    with RETRY_METRICS_LOCK:
+        return dict(retry_metrics)
+
+def log_request(level, entry):
+    """ writes a log entry as a single json line """
+    if logger.isEnabledFor(level):
+        logger.log(level, json.dumps(entry, default=str))
+
+def path_template(url):
+    """ url path with ids replaced by placeholders and the query string dropped """
+    path = urlparse(url).path
+    return '/'.join(
+        '{id}' if PATH_ID_PATTERN.match(segment) else segment
+        for segment in path.split('/')
+    )
+
+def loggable_body(body):
+    """ request body as a short redacted string, streams are only named """
+    if body is None:
+        return None
+    if isinstance(body, dict):
+        return truncate(json.dumps(redact_fields(body, REDACTED_FIELDS), default=str))
+    if isinstance(body, (str, bytes, list)):
+        return truncate(redact_text(str(body)))
+    return '<{0}>'.format(type(body).__name__)
+
+def redact_fields(fields, names):
+    """ copy of a dict with the values of sensitive keys redacted """
+    if fields is None:
+        return None
+    return {
+        key: REDACTED if key.lower() in names else value
+        for key, value in fields.items()
+    }
+
+def redact_text(text):
+    """ redacts tokens and secrets in a json string """
+    return REDACTED_TEXT_PATTERN.sub(r'\1"{0}"'.format(REDACTED), text)
+
+def truncate(text):
+    """ limits text to BLUEBEAM_LOG_BODY_LIMIT chars """
+    if len(text) > BLUEBEAM_LOG_BODY_LIMIT:
+        return '{0}...[{1} chars]'.format(text[:BLUEBEAM_LOG_BODY_LIMIT], len(text))
+    return text
@@ -3,8 +3,38 @@ import os
 import sqlalchemy as sa
 from sqlalchemy.orm import sessionmaker
 
-db_engine = sa.create_engine(os.environ.get('DATABASE_URL'), echo=True) # pylint: disable=invalid-name
+# engine settings
+# DB_ECHO is false, true (statements) or debug (statements and rows)
+DB_ECHO = os.environ.get('DB_ECHO', 'false').lower()
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', '10'))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true'
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', '1800'))
+
+def create_db_engine(database_url=None,
+                     echo=DB_ECHO,
+                     pool_size=DB_POOL_SIZE,
+                     max_overflow=DB_MAX_OVERFLOW,
+                     pool_pre_ping=DB_POOL_PRE_PING,
+                     pool_recycle=DB_POOL_RECYCLE):
+    # pylint: disable=too-many-arguments
+    """
+        creates the database engine
+        pool_recycle is the number of secs after which a connection is replaced,
+        -1 keeps connections indefinitely
+    """
+    return sa.create_engine(
+        database_url or os.environ.get('DATABASE_URL'),
+        echo={'true': True, 'debug': 'debug'}.get(echo, False),
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_pre_ping=pool_pre_ping,
+        pool_recycle=pool_recycle
+    )
+
+db_engine = create_db_engine() # pylint: disable=invalid-name
+Session = sessionmaker(bind=db_engine) # pylint: disable=invalid-name
 
 def create_session():
-    """creates database session"""
-    return sessionmaker(bind=db_engine)
+    """returns the shared database session factory"""
+    return Session
@@ -0,0 +1,209 @@
+"""Download cache module"""
+#pylint: disable=too-few-public-methods
+import os
+import json
+import hashlib
+import shutil
+import tempfile
+import threading
+import uuid
+from collections import Counter
+
+# submission files kept on disk so retried exports and resubmissions skip the download,
+# the least recently used files are evicted past DOWNLOAD_CACHE_MAX_BYTES and 0 turns it off
+DOWNLOAD_CACHE_DIR = os.environ.get(
+    'DOWNLOAD_CACHE_DIR',
+    os.path.join(tempfile.gettempdir(), 'bluebeam-download-cache')
+)
+DOWNLOAD_CACHE_MAX_BYTES = int(os.environ.get(
+    'DOWNLOAD_CACHE_MAX_BYTES',
+    str(2 * 1024 * 1024 * 1024)
+))
+HASH_CHUNK_SIZE = 1024 * 1024
+
+class DownloadCache():
+    """
+        downloaded files kept on disk, stored once per content hash and found by url
+        a cached file is only used once the server confirms it with the ETag or
+        Last-Modified it was first sent with, the worker processes of a host can share
+        the cache dir
+    """
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.metrics = Counter()
+
+    def validators(self, url):
+        """
+            conditional request headers for the cached copy of url, empty when there's none
+        """
+        entry = self.get_entry(url)
+        if entry is None:
+            return {}
+        if not os.path.exists(self.blob_path(entry['sha256'])):
+            # evicted
+            remove_file(self.entry_path(url))
+            return {}
+        if entry['etag']:
+            return {'If-None-Match': entry['etag']}
+        return {'If-Modified-Since': entry['last_modified']}
+
+    def checkout(self, url, file_path):
+        """
+            puts the cached copy of url at file_path, returns false when it's gone
+            file_path is a hard link so the copy outlives its eviction
+        """
+        entry = self.get_entry(url)
+        if entry is None:
+            return False
+        blob = self.blob_path(entry['sha256'])
+        try:
+            link_or_copy(blob, file_path)
+            # most recently used
+            os.utime(blob)
+        except OSError:
+            return False
+        self.count('hits')
+        return True
+
+    def add(self, url, headers, file_path):
+        """
+            keeps a file downloaded from url, it's only used again when
+            the response headers had an ETag or Last-Modified to check it with
+            the cache failing never fails the download
+        """
+        self.count('misses')
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if self.max_bytes <= 0 or not (etag or last_modified):
+            return
+        try:
+            if os.path.getsize(file_path) > self.max_bytes:
+                return
+            sha256 = hash_file(file_path)
+            blob = self.blob_path(sha256)
+            if not os.path.exists(blob):
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                partial = '{0}.{1}.tmp'.format(blob, uuid.uuid4().hex)
+                link_or_copy(file_path, partial)
+                os.replace(partial, blob)
+            os.utime(blob)
+            write_json(self.entry_path(url), {
+                'url': url,
+                'etag': etag,
+                'last_modified': last_modified,
+                'sha256': sha256
+            })
+            self.evict()
+        except OSError as err:
+            print("download cache unavailable: {0}".format(err))
+
+    def evict(self):
+        """
+            removes the least recently used files until the cache fits in max_bytes
+        """
+        blobs = []
+        with os.scandir(os.path.join(self.cache_dir, 'blobs')) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    blobs.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in blobs)
+        for _, size, path in sorted(blobs):
+            if total_size <= self.max_bytes:
+                break
+            remove_file(path)
+            total_size -= size
+            self.count('evictions')
+
+    def get_entry(self, url):
+        """ what's cached for url, None when nothing is """
+        if self.max_bytes <= 0:
+            return None
+        try:
+            with open(self.entry_path(url), encoding='utf-8') as entry_file:
+                return json.load(entry_file)
+        except (OSError, ValueError):
+            return None
+
+    def entry_path(self, url):
+        """ where the entry of a url is kept """
+        return os.path.join(
+            self.cache_dir,
+            'urls',
+            hashlib.sha256(url.encode()).hexdigest() + '.json'
+        )
+
+    def blob_path(self, sha256):
+        """ where the file with a content hash is kept """
+        return os.path.join(self.cache_dir, 'blobs', sha256)
+
+    def count(self, key):
+        """ counts a hit, miss or eviction """
+        with self.lock:
+            self.metrics[key] += 1
+
+    def get_metrics(self):
+        """ number of hits, misses and evictions of this process """
+        with self.lock:
+            return {key: self.metrics[key] for key in ('hits', 'misses', 'evictions')}
+
+def create_download_cache(cache_dir=None, max_bytes=DOWNLOAD_CACHE_MAX_BYTES):
+    """
+        creates the download cache in DOWNLOAD_CACHE_DIR
+    """
+    return DownloadCache(cache_dir or DOWNLOAD_CACHE_DIR, max_bytes)
+
+def hash_file(file_path):
+    """ sha256 of a file, read one chunk at a time """
+    with open(file_path, 'rb') as file_obj:
+        return hash_stream(file_obj)
+
+def hash_stream(file_obj):
+    """ sha256 of what's left to read in a file object, read one chunk at a time """
+    sha256 = hashlib.sha256()
+    for chunk in iter(lambda: file_obj.read(HASH_CHUNK_SIZE), b''):
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+class HashingReader():
+    """
+        reads through a file object and keeps the sha256 of what was read
+    """
+    def __init__(self, file_obj):
+        self.file_obj = file_obj
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        """ reads from the wrapped file object """
+        chunk = self.file_obj.read(size)
+        self.sha256.update(chunk)
+        return chunk
+
+    def hexdigest(self):
+        """ sha256 of what was read so far """
+        return self.sha256.hexdigest()
+
+def link_or_copy(source, destination):
+    """ hard links source to destination, copies it across file systems """
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+def write_json(path, data):
+    """ replaces a json file in one step so readers never see half of it """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = '{0}.{1}.tmp'.format(path, uuid.uuid4().hex)
+    with open(partial, 'w', encoding='utf-8') as json_file:
+        json.dump(data, json_file)
+    os.replace(partial, path)
+
+def remove_file(path):
+    """ removes a file another process may have removed already """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
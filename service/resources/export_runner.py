@@ -0,0 +1,17 @@
+"""Async export runner module"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+async def export_submissions(export_submission, submission_ids, max_in_flight):
+    """
+        exports submissions concurrently from one event loop,
+        up to max_in_flight of them in flight at a time
+        export_submission exports the submission of an id on a thread of its own
+        and returns its result for finish_export, or the exception it raised
+    """
+    loop = asyncio.get_event_loop()
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        return await asyncio.gather(*[
+            loop.run_in_executor(executor, export_submission, submission_id)
+            for submission_id in submission_ids
+        ], return_exceptions=True)
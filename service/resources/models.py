@@ -5,7 +5,7 @@ import uuid
 from urllib.parse import urlparse
 from sqlalchemy.ext.declarative import declarative_base
 import sqlalchemy as sa
-from sqlalchemy.orm import relationship, validates
+from sqlalchemy.orm import relationship, validates, object_session
 from sqlalchemy.sql import func
 from sqlalchemy.dialects.postgresql import UUID
 
@@ -16,6 +16,22 @@ class SubmissionModel(BASE):
     """Map Submission object to db"""
 
     __tablename__ = 'submission'
+    __table_args__ = (
+        sa.Index('ix_submission_export_guid', 'export_guid'),
+        sa.Index('ix_submission_date_exported', 'date_exported'),
+        # pending submissions, in id order
+        sa.Index(
+            'ix_submission_unexported',
+            'id',
+            postgresql_where=sa.text('date_exported IS NULL')
+        ),
+        # checkpoints by building permits application, see get_checkpoint
+        sa.Index(
+            'ix_submission_checkpoint_application',
+            sa.text("(data->>'_id')"),
+            postgresql_where=sa.text('checkpoint IS NOT NULL')
+        ),
+    )
     id = sa.Column('id', sa.Integer, primary_key=True)
     data = sa.Column('data', sa.JSON, nullable=False)
     date_received = sa.Column(
@@ -26,6 +42,11 @@ class SubmissionModel(BASE):
     date_exported = sa.Column('date_exported', sa.DateTime(timezone=True))
     bluebeam_project_id = sa.Column('bluebeam_project_id', sa.String(11))
     error_message = sa.Column('error_message', sa.String(255))
+    # the steps of a new project's export completed so far, a failed export resumes after them
+    checkpoint = sa.Column('checkpoint', sa.JSON)
+    # new projects are given their users by the assign_permissions task after the export
+    permissions_status = sa.Column('permissions_status', sa.String(16))
+    permissions_result = sa.Column('permissions_result', sa.JSON)
     export_status_guid = sa.Column(
         'export_guid',
         UUID(as_uuid=True),
@@ -43,14 +64,59 @@ class SubmissionModel(BASE):
 
 def create_submission(db_session, json_data, export_id=None):
     """helper function for creating a submission"""
+    submission = new_submission(json_data, export_id)
+    db_session.add(submission)
+    db_session.commit()
+    return submission
+
+def new_submission(json_data, export_id=None):
+    """helper function for validating a submission that isn't saved yet"""
     validate(json_data)
     submission = SubmissionModel(data=json_data)
     if export_id is not None:
         submission.export_status_guid = export_id
-    db_session.add(submission)
-    db_session.commit()
     return submission
 
+def get_checkpoint(submission):
+    """
+        helper function for the completed export steps of a submission,
+        a failed submission is exported again as a new submission of the same
+        building permits application, which takes over the latest one's steps
+        until one of them is exported, see clear_checkpoints
+    """
+    application_id = submission.data.get('_id')
+    if submission.checkpoint or application_id is None:
+        return submission.checkpoint
+    earlier = object_session(submission).query(SubmissionModel).filter(
+        SubmissionModel.id < submission.id,
+        SubmissionModel.date_exported.is_(None),
+        SubmissionModel.checkpoint.isnot(None),
+        sa.text("data->>'_id' = :application_id").bindparams(application_id=application_id)
+    ).order_by(SubmissionModel.id.desc()).first()
+    return earlier.checkpoint if earlier is not None else None
+
+def clear_checkpoints(submission):
+    """
+        helper function for dropping the checkpoints of the earlier submissions
+        of an exported submission's application, so a later export of the
+        application starts a new project
+    """
+    application_id = submission.data.get('_id')
+    if application_id is None:
+        return
+    object_session(submission).query(SubmissionModel).filter(
+        SubmissionModel.id < submission.id,
+        SubmissionModel.checkpoint.isnot(None),
+        sa.text("data->>'_id' = :application_id").bindparams(application_id=application_id)
+    ).update({SubmissionModel.checkpoint: sa.null()}, synchronize_session=False)
+
+def save_checkpoint(db_session, submission_id, checkpoint):
+    """helper function for recording the completed export steps of a submission"""
+    db_session.query(SubmissionModel).filter(
+        SubmissionModel.id == submission_id
+    ).update({'checkpoint': checkpoint}, synchronize_session=False)
+    db_session.commit()
+
 def validate(json_params):
     """enforce validation rules"""
     #pylint: disable=unused-argument
@@ -97,6 +163,23 @@ def create_export(db_session):
     db_session.commit()
     return export
 
+def create_exports(db_session, groups):
+    """
+        helper function to create an export for each group of submission json,
+        everything is inserted in bulk and committed at once
+        returns the guids of the exports
+    """
+    exports = [ExportStatusModel(guid=uuid.uuid4()) for _ in groups]
+    submissions = [
+        new_submission(json_data, export.guid)
+        for export, group in zip(exports, groups)
+        for json_data in group
+    ]
+    db_session.bulk_save_objects(exports)
+    db_session.bulk_save_objects(submissions)
+    db_session.commit()
+    return [export.guid for export in exports]
+
 class UserModel(BASE):
     # pylint: disable=too-few-public-methods
     """Map User object to db"""
@@ -104,9 +187,84 @@ class UserModel(BASE):
     id = sa.Column('id', sa.Integer, primary_key=True)
     email = sa.Column('email', sa.String(256))
 
+class RosterVersionModel(BASE):
+    # pylint: disable=too-few-public-methods
+    """Map RosterVersion object to db, bumped by a trigger whenever the user table changes"""
+    __tablename__ = "roster_version"
+    id = sa.Column('id', sa.Integer, primary_key=True)
+    version = sa.Column('version', sa.Integer, nullable=False, server_default='1')
+
+class PollCursorModel(BASE):
+    # pylint: disable=too-few-public-methods
+    """Map PollCursor object to db, where the scheduler's polls of an upstream api left off"""
+    __tablename__ = "poll_cursor"
+    name = sa.Column('name', sa.String(64), primary_key=True)
+    # validators of the last poll that found nothing, the next poll is conditional on them
+    etag = sa.Column('etag', sa.Text)
+    last_modified = sa.Column('last_modified', sa.Text)
+    date_updated = sa.Column(
+        'date_updated',
+        sa.DateTime(timezone=True),
+        server_default=func.now(),
+        onupdate=func.now()
+    )
+
+def get_poll_cursor(db_session, name):
+    """helper function for finding a poll cursor, a new one is added to the session"""
+    poll_cursor = db_session.query(PollCursorModel).get(name)
+    if poll_cursor is None:
+        poll_cursor = PollCursorModel(name=name)
+        db_session.add(poll_cursor)
+    return poll_cursor
+
+class UploadedFileModel(BASE):
+    # pylint: disable=too-few-public-methods
+    """Map UploadedFile object to db, the files uploaded to each bluebeam project"""
+    __tablename__ = "uploaded_file"
+    __table_args__ = (
+        sa.Index('ix_uploaded_file_project_sha256', 'project_id', 'sha256'),
+        sa.UniqueConstraint('project_id', 'file_name', 'size', 'sha256', name='uq_uploaded_file'),
+    )
+    id = sa.Column('id', sa.Integer, primary_key=True)
+    project_id = sa.Column('project_id', sa.String(11), nullable=False)
+    file_name = sa.Column('file_name', sa.Text, nullable=False)
+    size = sa.Column('size', sa.BigInteger, nullable=False)
+    sha256 = sa.Column('sha256', sa.String(64), nullable=False)
+    date_uploaded = sa.Column(
+        'date_uploaded',
+        sa.DateTime(timezone=True),
+        server_default=func.now()
+    )
+
+def find_uploaded_file(db_session, project_id, file_name, size, sha256=None):
+    # pylint: disable=too-many-arguments
+    """helper function for finding a file uploaded to a project, by sha256 as well when given"""
+    query = db_session.query(UploadedFileModel).filter(
+        UploadedFileModel.project_id == project_id,
+        UploadedFileModel.size == size,
+        UploadedFileModel.file_name == file_name
+    )
+    if sha256 is not None:
+        query = query.filter(UploadedFileModel.sha256 == sha256)
+    return query.first()
+
+def create_uploaded_file(db_session, project_id, file_name, size, sha256):
+    # pylint: disable=too-many-arguments
+    """helper function for recording a file uploaded to a project"""
+    uploaded_file = UploadedFileModel(
+        project_id=project_id,
+        file_name=file_name,
+        size=size,
+        sha256=sha256
+    )
+    db_session.add(uploaded_file)
+    db_session.commit()
+    return uploaded_file
+
 class TokenModel(BASE):
     # pylint: disable=too-few-public-methods
     """Map Token object to db fields"""
     __tablename__ = "token"
     id = sa.Column('id', sa.Integer, primary_key=True)
     value = sa.Column('value', sa.LargeBinary)
+    version = sa.Column('version', sa.Integer, nullable=False, default=1, server_default='1')
@@ -0,0 +1,115 @@
+"""Rate limiter module"""
+#pylint: disable=too-few-public-methods
+import os
+import threading
+from time import sleep, monotonic
+import redis
+
+# token bucket settings, rates are calls per sec and 0 turns a bucket off
+# metadata is every call to the bluebeam api, uploads are the PUTs to upload urls
+BLUEBEAM_RATE_LIMIT = float(os.environ.get('BLUEBEAM_RATE_LIMIT', '10'))
+BLUEBEAM_RATE_BURST = int(os.environ.get('BLUEBEAM_RATE_BURST', '20'))
+BLUEBEAM_UPLOAD_RATE_LIMIT = float(os.environ.get('BLUEBEAM_UPLOAD_RATE_LIMIT', '4'))
+BLUEBEAM_UPLOAD_RATE_BURST = int(os.environ.get('BLUEBEAM_UPLOAD_RATE_BURST', '8'))
+RATE_LIMIT_KEY_PREFIX = 'bluebeam:rate:'
+
+# takes a token from the bucket in KEYS[1] refilled at ARGV[1] tokens per sec up to
+# ARGV[2] tokens, returns 0 or the secs to wait for the next token
+# the redis clock is used so workers on different hosts share one timeline
+TOKEN_BUCKET_SCRIPT = """
+redis.replicate_commands()
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'timestamp')
+local tokens = tonumber(bucket[1]) or burst
+local timestamp = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - timestamp) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'timestamp', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+class RedisBuckets():
+    """
+        token buckets kept in redis, shared by every worker using the same redis
+    """
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self.take_token = redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def take(self, name, rate, burst):
+        """ takes a token, returns 0 or the secs to wait before trying again """
+        return float(self.take_token(keys=[RATE_LIMIT_KEY_PREFIX + name], args=[rate, burst]))
+
+class MemoryBuckets():
+    """
+        token buckets kept in process, for running without redis and for tests
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def take(self, name, rate, burst):
+        """ takes a token, returns 0 or the secs to wait before trying again """
+        with self.lock:
+            now = monotonic()
+            tokens, timestamp = self.buckets.get(name, (burst, now))
+            tokens = min(burst, tokens + max(0, now - timestamp) * rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self.buckets[name] = (tokens, now)
+            return wait
+
+class RateLimiter():
+    """
+        blocks callers so that each named bucket is used at most at its rate
+        limits are {name: (calls per sec, burst)}
+    """
+    def __init__(self, buckets, limits):
+        self.buckets = buckets
+        self.limits = limits
+
+    def acquire(self, name):
+        """
+            waits for a token from the named bucket, returns the secs waited
+            a redis failure lets the call through rather than failing the export
+        """
+        rate, burst = self.limits[name]
+        waited = 0
+        while rate > 0:
+            try:
+                wait = self.buckets.take(name, rate, burst)
+            except redis.exceptions.RedisError as err:
+                print("rate limiter unavailable: {0}".format(err))
+                break
+            if wait <= 0:
+                break
+            sleep(wait)
+            waited += wait
+        return waited
+
+def create_rate_limiter(redis_url=None):
+    """
+        creates the bluebeam rate limiter on the celery broker redis,
+        or in process when there is no redis
+    """
+    redis_url = redis_url or os.environ.get('REDIS_URL')
+    if redis_url:
+        buckets = RedisBuckets(redis.Redis.from_url(redis_url))
+    else:
+        buckets = MemoryBuckets()
+    return RateLimiter(buckets, {
+        'metadata': (BLUEBEAM_RATE_LIMIT, BLUEBEAM_RATE_BURST),
+        'upload': (BLUEBEAM_UPLOAD_RATE_LIMIT, BLUEBEAM_UPLOAD_RATE_BURST)
+    })
@@ -0,0 +1,61 @@
+"""Roster module"""
+import os
+import threading
+from collections import namedtuple
+from time import monotonic
+from service.resources.models import UserModel, RosterVersionModel
+
+# the users given access to new projects are cached in each worker,
+# the cached copy is checked against the roster_version row every ROSTER_CACHE_TTL secs
+# and a trigger bumps the row whenever the user table changes
+ROSTER_CACHE_TTL = int(os.environ.get('ROSTER_CACHE_TTL', '300'))
+ROSTER_CACHE_LOCK = threading.Lock()
+roster_cache = {} # pylint: disable=invalid-name
+
+RosterUser = namedtuple('RosterUser', ['id', 'email'])
+
+def get_roster(db_session):
+    """
+        the users of the user table as RosterUsers,
+        served from the in-process cache while it is fresh
+    """
+    with ROSTER_CACHE_LOCK:
+        if roster_cache:
+            if monotonic() - roster_cache['checked_at'] < ROSTER_CACHE_TTL:
+                return roster_cache['users']
+            # the user table may have changed since it was cached
+            if get_roster_version(db_session) == roster_cache['version']:
+                roster_cache['checked_at'] = monotonic()
+                return roster_cache['users']
+        return load_roster(db_session)
+
+def load_roster(db_session):
+    """
+        reads the users from the db into the cache
+        the version is read first so a change made in between is picked up next time
+    """
+    version = get_roster_version(db_session)
+    users = tuple(
+        RosterUser(row.id, row.email)
+        for row in db_session.query(UserModel.id, UserModel.email).order_by(UserModel.id)
+    )
+    roster_cache.update({
+        'version': version,
+        'users': users,
+        'checked_at': monotonic()
+    })
+    return users
+
+def get_roster_version(db_session):
+    """
+        the version of the user table
+    """
+    row = db_session.query(RosterVersionModel.version).first()
+    return row.version if row is not None else None
+
+def clear_roster_cache():
+    """
+        empties the in-process roster cache
+    """
+    with ROSTER_CACHE_LOCK:
+        roster_cache.clear()
@@ -0,0 +1,148 @@
+"""Submission files module"""
+import os
+import zipfile
+from urllib.parse import urlparse
+import requests
+from service.resources.download_cache import create_download_cache
+
+ERR_DOWNLOAD_TOO_LARGE = "File exceeds the download size limit"
+ERR_ZIP_TOO_MANY_FILES = "Zip file exceeds the file count limit"
+ERR_ZIP_TOO_LARGE = "Zip file exceeds the uncompressed size limit"
+ERR_ZIP_RATIO = "Zip file exceeds the compression ratio limit"
+
+# downloads are streamed to disk in chunks, never held in memory whole
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get('DOWNLOAD_CHUNK_SIZE', str(1024 * 1024)))
+# most bytes a worker will pull down for a single file
+MAX_DOWNLOAD_BYTES = int(os.environ.get('MAX_DOWNLOAD_BYTES', str(1024 * 1024 * 1024)))
+# limits on a zip checked from its central directory before anything is unzipped,
+# the size and ratio are of the pdfs since nothing else in a zip is unzipped
+MAX_ZIP_FILES = int(os.environ.get('MAX_ZIP_FILES', '1000'))
+MAX_ZIP_UNCOMPRESSED_BYTES = int(os.environ.get(
+    'MAX_ZIP_UNCOMPRESSED_BYTES',
+    str(2 * 1024 * 1024 * 1024)
+))
+MAX_ZIP_RATIO = float(os.environ.get('MAX_ZIP_RATIO', '100'))
+
+download_cache = create_download_cache() # pylint: disable=invalid-name
+
+def download(file_url, headers=None):
+    """
+        starts a streamed download of a submission file
+    """
+    url, params = get_download_location(file_url)
+    response = requests.get(url, params=params, headers=headers, stream=True)
+    response.raise_for_status()
+    return response
+
+def get_download_location(file_url):
+    """
+        url and query params to download a submission file from
+        bucketeer files are retrieved through the cloudstorage api
+    """
+    file_url_parsed = urlparse(file_url)
+
+    if file_url_parsed.netloc == os.environ.get('BUCKETEER_DOMAIN'):
+        print("upload_files cloud path:{0}".format(file_url_parsed.path[1:]))
+        return os.environ.get('CLOUDSTORAGE_URL'), {
+            'name':file_url_parsed.path[1:],
+            'apikey':os.environ.get('CLOUDSTORAGE_API_KEY')
+        }
+    return file_url, None
+
+def get_passthrough_length(response):
+    """
+        returns the length of a download that can be uploaded as it streams in
+        None when the length is unknown or the body is content-encoded,
+        those go through disk since the upload url needs an exact Content-Length
+    """
+    content_length = response.headers.get('Content-Length')
+    content_encoding = response.headers.get('Content-Encoding', 'identity')
+    if content_length is None or content_encoding != 'identity':
+        return None
+
+    content_length = int(content_length)
+    if content_length > MAX_DOWNLOAD_BYTES:
+        raise Exception(ERR_DOWNLOAD_TOO_LARGE)
+    return content_length
+
+def save_download(response, file_url, file_path):
+    """
+        writes a download to file_path, a 304 response takes the file from the download cache
+        returns true when the file came from the cache
+    """
+    if response.status_code == 304:
+        if download_cache.checkout(file_url, file_path):
+            return True
+        # the cached file was evicted after the request went out
+        response = download(file_url)
+        try:
+            save_response(response, file_path)
+        finally:
+            response.close()
+    else:
+        save_response(response, file_path)
+    download_cache.add(file_url, response.headers, file_path)
+    return False
+
+def save_response(response, file_path,
+                  chunk_size=DOWNLOAD_CHUNK_SIZE, max_bytes=MAX_DOWNLOAD_BYTES):
+    """
+        streams a download to file_path one chunk at a time
+        raises when the file is larger than max_bytes
+    """
+    content_length = response.headers.get('Content-Length')
+    if content_length is not None and int(content_length) > max_bytes:
+        raise Exception(ERR_DOWNLOAD_TOO_LARGE)
+
+    bytes_written = 0
+    with open(file_path, 'wb') as downloaded_file:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            bytes_written += len(chunk)
+            if bytes_written > max_bytes:
+                raise Exception(ERR_DOWNLOAD_TOO_LARGE)
+            downloaded_file.write(chunk)
+    return bytes_written
+
+def check_zip(f, file_dir):
+    # pylint: disable=invalid-name
+    """
+        downloads a zip into its own dir and checks it against the zip limits
+    """
+    os.makedirs(file_dir)
+    file_path = os.path.join(file_dir, f['originalName'])
+    response = download(f['url'], download_cache.validators(f['url']))
+    try:
+        cached = save_download(response, f['url'], file_path)
+    finally:
+        response.close()
+    check_zip_limits(file_path)
+    return file_path, cached
+
+def check_zip_limits(file_path):
+    """
+        raises when the zip at file_path is over the MAX_ZIP_* limits
+    """
+    with zipfile.ZipFile(file_path, "r") as zip_file:
+        pdf_members(zip_file)
+
+def pdf_members(zip_file):
+    """
+        the pdfs of a zip file, in any of its folders
+        the resource forks macOS adds to zips are skipped
+        raises when the zip is over the MAX_ZIP_* limits
+    """
+    members = zip_file.infolist()
+    if len(members) > MAX_ZIP_FILES:
+        raise Exception(ERR_ZIP_TOO_MANY_FILES)
+
+    pdfs = [
+        member for member in members
+        if member.filename.endswith(".pdf") and not member.filename.startswith("__MACOSX/")
+    ]
+    # zipfile won't unzip more than the sizes recorded in the central directory
+    if sum(member.file_size for member in pdfs) > MAX_ZIP_UNCOMPRESSED_BYTES:
+        raise Exception(ERR_ZIP_TOO_LARGE)
+    for member in pdfs:
+        if member.file_size > MAX_ZIP_RATIO * max(member.compress_size, 1):
+            raise Exception(ERR_ZIP_RATIO)
+    return pdfs
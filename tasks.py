@@ -2,25 +2,36 @@
 # pylint: disable=too-many-locals,too-many-branches,too-many-statements
 
 import os
-from io import BytesIO
+import asyncio
+import posixpath
 from datetime import datetime
-from urllib.parse import urlparse
 import tempfile
 import zipfile
 import shutil
 import traceback
+import threading
 import json
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from time import perf_counter
 from types import SimpleNamespace
 import requests
+from sqlalchemy.exc import IntegrityError
 import celery
 import jsend
 from kombu import serialization
 import celeryconfig
 import service.resources.bluebeam as bluebeam
-from service.resources.models import create_submission, create_export,\
-    SubmissionModel, ExportStatusModel, UserModel
+import service.resources.bluebeam_log as bluebeam_log
+from service.resources.models import create_exports, validate, get_poll_cursor,\
+    find_uploaded_file, create_uploaded_file, get_checkpoint,\
+    save_checkpoint, clear_checkpoints, SubmissionModel, ExportStatusModel
 from service.resources.db import create_session
 import service.resources.utils as utils
+from service.resources.download_cache import hash_file, hash_stream, HashingReader
+import service.resources.submission_files as submission_files
+from service.resources.roster import get_roster
+import service.resources.export_runner as export_runner
 
 TEMP_DIR = 'tmp'
 serialization.register_pickle()
@@ -34,153 +45,452 @@ celery_app.config_from_object(celeryconfig)
 ERR_UPLOAD_FAIL = "Unable to upload file"
 ERR_INVALID_PROJECT_ID = "Invalid Bluebeam project id"
 
+# upload files straight from the download stream when their length is known
+STREAM_UPLOADS = os.environ.get('STREAM_UPLOADS', 'false').lower() == 'true'
+# number of files of a submission transferred at the same time
+MAX_PARALLEL_UPLOADS = int(os.environ.get('MAX_PARALLEL_UPLOADS', '4'))
+# chord fans an export out to one celery task per submission,
+# async exports all the submissions of an export from one worker's event loop,
+# each on a thread of its own
+EXPORT_RUNNER = os.environ.get('EXPORT_RUNNER', 'chord')
+# number of submissions an async export keeps in flight
+MAX_ASYNC_EXPORTS = int(os.environ.get('MAX_ASYNC_EXPORTS', '8'))
+# the users of a new project are given access by the assign_permissions task after the
+# export is reported, it's retried with a backoff starting at PERMISSIONS_RETRY_DELAY secs
+PERMISSIONS_MAX_RETRIES = int(os.environ.get('PERMISSIONS_MAX_RETRIES', '5'))
+PERMISSIONS_RETRY_DELAY = int(os.environ.get('PERMISSIONS_RETRY_DELAY', '30'))
+PERMISSIONS_PENDING = 'pending'
+PERMISSIONS_DONE = 'done'
+PERMISSIONS_FAILED = 'failed'
+# the scheduler marks queued applications as processing SCHEDULER_MAX_PARALLEL_PATCHES
+# at a time, then saves them in one transaction as exports of SCHEDULER_EXPORT_SIZE
+# applications each, 0 puts all the applications of a run in one export
+SCHEDULER_MAX_PARALLEL_PATCHES = int(os.environ.get('SCHEDULER_MAX_PARALLEL_PATCHES', '8'))
+SCHEDULER_EXPORT_SIZE = int(os.environ.get('SCHEDULER_EXPORT_SIZE', '1'))
+# queued applications are read BUILDING_PERMITS_PAGE_SIZE at a time,
+# at most BUILDING_PERMITS_MAX_PAGES per run and the rest are left for the next run
+BUILDING_PERMITS_PAGE_SIZE = int(os.environ.get('BUILDING_PERMITS_PAGE_SIZE', '100'))
+BUILDING_PERMITS_MAX_PAGES = int(os.environ.get('BUILDING_PERMITS_MAX_PAGES', '20'))
+APPLICATIONS_CURSOR = 'building_permits_applications'
+
 @celery_app.task(name="tasks.bluebeam_export", bind=True)
 def bluebeam_export(self, export_id):
-    # pylint: disable=unused-argument
     """
         exports unexported submissions to bluebeam
+        each submission is exported by its own export_submission task so a slow
+        project doesn't hold up the others and the work spreads across workers,
+        finish_export records the outcome once they are all done
+        with EXPORT_RUNNER=async the submissions are exported from this worker's
+        event loop instead, many at a time on threads of their own
     """
     print("export:guid - {0}".format(export_id))
 
     session = create_session()
     db_session = session()
-    submissions_to_export = db_session.query(SubmissionModel).filter( # pylint: disable=no-member
-        SubmissionModel.export_status_guid == export_id
+    submission_ids = [
+        row.id for row in db_session.query(SubmissionModel.id).filter( # pylint: disable=no-member
+            SubmissionModel.export_status_guid == export_id
+        ).order_by(SubmissionModel.id)
+    ]
+    db_session.close()
+
+    if not submission_ids:
+        finish_export.apply(args=([], export_id))
+        return
+
+    if EXPORT_RUNNER == 'async':
+        results = asyncio.run(export_runner.export_submissions(
+            run_export,
+            submission_ids,
+            MAX_ASYNC_EXPORTS
+        ))
+        # a submission whose export raised fails on its own
+        results = [
+            export_failed(submission_id, None, result) if isinstance(result, Exception) else result
+            for submission_id, result in zip(submission_ids, results)
+        ]
+        log_export_metrics(export_id=str(export_id))
+        defer_permissions(self, results)
+        finish_export.apply(args=(results, export_id))
+        return
+
+    workflow = celery.chord(
+        [export_submission.s(submission_id) for submission_id in submission_ids],
+        finish_export.s(export_id)
     )
-    statuses = {
-        'success': [],
-        'failure': []
-    }
+    # an export applied in process runs its subtasks in process as well
+    if self.request.is_eager:
+        workflow.apply()
+    else:
+        workflow.apply_async()
+
+@celery_app.task(name="tasks.export_submission", bind=True)
+def export_submission(self, submission_id):
+    """
+        exports a single submission to bluebeam
+        returns ('success', status) or ('failure', status) for finish_export
+    """
+    result = run_export(submission_id)
+    log_export_metrics(submission_id=submission_id)
+    defer_permissions(self, [result])
+    return result
+
+def run_export(submission_id):
+    """
+        exports a submission and records the outcome,
+        shared by the export_submission task and the async runner
+    """
+    print("export:submission_id - {0}".format(submission_id))
 
-    for submission in submissions_to_export:
+    session = create_session()
+    db_session = session()
+    submission = export = None
+    try:
+        submission = db_session.query(SubmissionModel).get(submission_id) # pylint: disable=no-member
+        export = start_export(submission)
         # get access token
         access_token = bluebeam.get_auth_token(db_session)
+        export_to_bluebeam(submission, access_token, export)
+        report_export(submission.data, export['project_id'])
+        result = export_succeeded(submission, export)
+    except Exception as err: # pylint: disable=broad-except
+        result = export_failed(submission_id, submission, err)
+        try:
+            if export is not None:
+                report_export(submission.data, export['project_id'], result[1]['err'])
+        except Exception: #pylint: disable=broad-except
+            pass
 
-        project_id = submission.data.get('project_id', None)
-        upload_dir_id = None
-        webhook = submission.data.get('_webhook', None)
+    # commit update this submission immediately
+    if submission is not None:
+        db_session.commit()
+    db_session.close()
+    return result
 
-        try:
-            if project_id and project_id is not None:
-                # resubmission
-                print("export:resubmission - {0}".format(submission.id))
-                project_id = format_project_id(project_id)
-                print("project_id: {0}".format(project_id))
-                if bluebeam.project_exists(access_token, project_id):
-                    upload_dir_id = bluebeam.get_upload_dir_id(access_token, project_id)
-                    upload_files(
-                        project_id,
-                        upload_dir_id,
-                        submission.data.get('files'),
-                        access_token
-                    )
-                else:
-                    print(ERR_INVALID_PROJECT_ID)
-                    raise Exception(ERR_INVALID_PROJECT_ID)
-            else:
-                # create bluebeam project
-                try:
-                    print("export:submission - {0}".format(submission.id))
-
-                    # generate project name and
-                    # create project in bluebeam
-                    if 'building_permit_number' in submission.data:
-                        project_name = "{0} - {1}".format(
-                            submission.data['project_name'],
-                            submission.data['building_permit_number']
-                        )
-                    else:
-                        project_name = submission.data['project_name']
-                    project_id = bluebeam.create_project(access_token, project_name)
-
-                    # create directory structure
-                    upload_dir_id = bluebeam.create_directories(
-                        access_token,
-                        project_id,
-                        bluebeam.DIRECTORY_STRUCTURE
-                    )
-                    upload_files(
-                        project_id,
-                        upload_dir_id,
-                        submission.data.get('files'),
-                        access_token
-                    )
-
-                    # assign user permissions
-                    if webhook:
-                        users = list(map(
-                            lambda user: SimpleNamespace(**user),
-                            webhook.get('users')
-                        ))
-                    else:
-                        users = db_session.query(UserModel).all()
-
-                    bluebeam.assign_user_permissions(access_token, project_id, users)
-
-                except Exception as err: # pylint: disable=broad-except
-                    # delete project in bluebeam if it was created
-                    print("Exception caught: {0}".format(project_id))
-                    if project_id is not None:
-                        try:
-                            bluebeam.delete_project(access_token, project_id)
-                        except Exception as delete_err: # pylint: disable=broad-except
-                            pass
-                    raise err
-
-            if webhook:
-                trigger_webhook(
-                    submission.data.get('_webhook'), {"bluebeam_project_id": project_id})
+def log_export_metrics(**exported):
+    """
+        logs the bluebeam retry and download cache counters of this worker
+        as one json line once it's done exporting,
+        they count from when the worker started
+    """
+    bluebeam_log.log_request(logging.INFO, {
+        'event': 'export_metrics',
+        **exported,
+        'retries': bluebeam_log.get_retry_metrics(),
+        'download_cache': submission_files.download_cache.get_metrics()
+    })
+
+def defer_permissions(task, results):
+    """
+        queues assign_permissions for the new projects exported among results,
+        in process when task was applied in process
+    """
+    for status, status_details in results:
+        if status == 'success' and status_details['permissions'] == PERMISSIONS_PENDING:
+            if task.request.is_eager:
+                assign_permissions.apply(args=(status_details['submission_id'],))
             else:
-                # log success
-                log_status(
-                    {
-                        'actionState':project_id,
-                        'bluebeamStatus':'done'
-                    },
-                    submission.data.get('_id'))
-
-            # finished exporting this submission
-            statuses['success'].append({
-                'submission_id': submission.id,
-                'bluebeam_id': project_id
-            })
-            submission.date_exported = datetime.utcnow()
-            submission.bluebeam_project_id = project_id
+                assign_permissions.apply_async(args=(status_details['submission_id'],))
+
+@celery_app.task(name="tasks.assign_permissions", bind=True,
+                 max_retries=PERMISSIONS_MAX_RETRIES)
+def assign_permissions(self, submission_id):
+    """
+        gives the users of an exported submission's new project full access
+        the export is reported without waiting on it since one user failing
+        doesn't fail the others, only a failed assignment as a whole is retried
+        the outcome is recorded in permissions_status and permissions_result
+    """
+    print("permissions:submission_id - {0}".format(submission_id))
 
+    session = create_session()
+    db_session = session()
+    try:
+        submission = db_session.query(SubmissionModel).get(submission_id) # pylint: disable=no-member
+        try:
+            report = bluebeam.assign_user_permissions(
+                bluebeam.get_auth_token(db_session),
+                submission.bluebeam_project_id,
+                get_permission_users(db_session, submission.data)
+            )
         except Exception as err: # pylint: disable=broad-except
-            err_msg = "{0}".format(err)
-            print('Encountered error exporting submission with id: {0}'.format(submission.id))
-            print(err_msg)
-            print(traceback.format_exc())
-            submission.error_message = err_msg
-            statuses['failure'].append({
-                'id': submission.id,
-                'data': submission.data,
-                'err': err_msg
-            })
-
-            try:
-                if webhook:
-                    trigger_webhook(
-                        submission.data.get('_webhook'),
-                        {"bluebeam_project_id": project_id},
-                        'Error: {}'.format(err_msg)
-                    )
-                else:
-                # log error
-                    log_status(
-                        {
-                            'actionState':'Error: {}'.format(err_msg),
-                            'bluebeamStatus':'Error'
-                        },
-                        submission.data.get('_id'))
-            except Exception: #pylint: disable=broad-except
-                pass
-
-        # commit update this submission immediately
+            if self.request.retries < self.max_retries:
+                raise self.retry(
+                    exc=err,
+                    countdown=PERMISSIONS_RETRY_DELAY * 2 ** self.request.retries
+                )
+            print("Encountered error assigning permissions: {0}".format(err))
+            submission.permissions_status = PERMISSIONS_FAILED
+            submission.permissions_result = {'error': "{0}".format(err)}
+        else:
+            submission.permissions_status = PERMISSIONS_DONE
+            submission.permissions_result = {'users': report}
         db_session.commit()
+    finally:
+        db_session.close()
+
+def start_export(submission):
+    """
+        what the export of a submission keeps track of,
+        checkpoint has the steps an earlier export of a new project got through
+    """
+    return {
+        'submission_id': submission.id,
+        'project_id': submission.data.get('project_id', None),
+        'checkpoint': dict(get_checkpoint(submission) or {}),
+        'file_timings': [],
+        'permissions': None
+    }
+
+def checkpoint_export(export, **steps):
+    """
+        records completed steps of a new project's export so a failed export resumes
+        after them, the files uploaded are recorded in the uploaded_file table
+        each call has its own short session since the project tree is created on another thread
+    """
+    export['checkpoint'].update(steps)
+    db_session = create_session()()
+    try:
+        save_checkpoint(db_session, export['submission_id'], export['checkpoint'])
+    finally:
+        db_session.close()
+
+def export_to_bluebeam(submission, access_token, export):
+    """
+        creates or finds the bluebeam project of a submission and uploads its files
+        export['project_id'] and export['file_timings'] are filled in as it goes
+        a new project is kept when its export fails so the next export of its
+        application resumes it, see rollback_project
+    """
+    project_id = export['project_id']
+    if project_id and project_id is not None:
+        # resubmission
+        print("export:resubmission - {0}".format(submission.id))
+        project_id = export['project_id'] = format_project_id(project_id)
+        print("project_id: {0}".format(project_id))
+        if bluebeam.project_exists(access_token, project_id):
+            folder_index = bluebeam.get_folder_index(access_token, project_id)
+            upload_dir_id = bluebeam.get_upload_dir_id(folder_index)
+            export['file_timings'] = upload_files(
+                project_id,
+                upload_dir_id,
+                submission.data.get('files'),
+                access_token,
+                folder_index
+            )
+        else:
+            print(ERR_INVALID_PROJECT_ID)
+            raise Exception(ERR_INVALID_PROJECT_ID)
+    else:
+        # create bluebeam project
+        print("export:submission - {0}".format(submission.id))
+
+        files = submission.data.get('files')
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            # zips are downloaded and checked against the zip limits first,
+            # one over them fails the export before any bluebeam call
+            checked = check_zips(files, tmp_dir)
+
+            # the other files are downloaded while the project and its folders are created,
+            # only their uploads wait for the upload folder
+            folder_index = {}
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                project = executor.submit(
+                    create_project_tree,
+                    access_token,
+                    submission.data,
+                    folder_index,
+                    export
+                )
+                export['file_timings'] = transfer_files(
+                    project.result,
+                    files,
+                    access_token,
+                    folder_index,
+                    checked
+                )
+            project.result()
+        except Exception:
+            if not resumed_later(submission, export):
+                rollback_project(access_token, export)
+            raise
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        # the users are given access by assign_permissions once the export is reported
+        export['permissions'] = PERMISSIONS_PENDING
+
+def resumed_later(submission, export):
+    """
+        true unless a failed export created a project nothing will resume,
+        only a building permits application is exported again once it's re-queued,
+        a submission without one has its project deleted like before checkpoints
+    """
+    return export['project_id'] is None or submission.data.get('_id') is not None
+
+def rollback_project(access_token, export):
+    """
+        deletes the project of a failed export and clears its checkpoint
+    """
+    try:
+        bluebeam.delete_project(access_token, export['project_id'])
+    except Exception as delete_err: # pylint: disable=broad-except
+        print("export:delete_project failed - {0}".format(delete_err))
+        return
+    export['checkpoint'].clear()
+    checkpoint_export(export)
+
+def create_project_tree(access_token, submission_data, folder_index, export):
+    """
+        creates the bluebeam project of a new submission and its directory structure,
+        or finishes the one an earlier export left
+        export['project_id'] is set as soon as the project exists
+        returns the project id and the id of its upload dir
+    """
+    project_id = export['checkpoint'].get('project_id')
+    if project_id and resumable(access_token, project_id):
+        print("export:resuming - {0}".format(project_id))
+        folder_index.update(bluebeam.get_folder_index(access_token, project_id))
+    else:
+        # generate project name and
+        # create project in bluebeam
+        project_id = bluebeam.create_project(
+            access_token,
+            get_project_name(submission_data)
+        )
+        export['checkpoint'].clear()
+        checkpoint_export(export, project_id=project_id)
+    export['project_id'] = project_id
+
+    if 'folders' in export['checkpoint']:
+        return project_id, bluebeam.get_upload_dir_id(folder_index)
+
+    # create directory structure
+    # the index is complete once the directories are created
+    upload_dir_id = bluebeam.create_directories(
+        access_token,
+        project_id,
+        bluebeam.DIRECTORY_STRUCTURE,
+        folder_index=folder_index
+    )
+    checkpoint_export(export, folders=dict(folder_index))
+    return project_id, upload_dir_id
+
+def resumable(access_token, project_id):
+    """
+        whether the project an earlier export created is still there to resume
+    """
+    try:
+        return bluebeam.project_exists(access_token, project_id)
+    except requests.exceptions.HTTPError as err:
+        if err.response is not None and err.response.status_code == 404:
+            return False
+        raise
+
+def get_project_name(submission_data):
+    """
+        name of the bluebeam project of a new submission
+    """
+    if 'building_permit_number' in submission_data:
+        return "{0} - {1}".format(
+            submission_data['project_name'],
+            submission_data['building_permit_number']
+        )
+    return submission_data['project_name']
 
-    # finished export
+def get_permission_users(db_session, submission_data):
+    """
+        users given full access to a new project, the webhook's users or all users
+        all users come from the roster cached in the worker
+    """
+    webhook = submission_data.get('_webhook', None)
+    if webhook:
+        return list(map(
+            lambda user: SimpleNamespace(**user),
+            webhook.get('users')
+        ))
+    return get_roster(db_session)
+
+def report_export(submission_data, project_id, err_msg=None):
+    """
+        tells the webhook, or else the building permits api, how the export went
+    """
+    webhook = submission_data.get('_webhook', None)
+    if err_msg is None:
+        if webhook:
+            trigger_webhook(webhook, {"bluebeam_project_id": project_id})
+        else:
+            # log success
+            log_status(
+                {
+                    'actionState':project_id,
+                    'bluebeamStatus':'done'
+                },
+                submission_data.get('_id'))
+    else:
+        if webhook:
+            trigger_webhook(
+                webhook,
+                {"bluebeam_project_id": project_id},
+                'Error: {}'.format(err_msg)
+            )
+        else:
+            # log error
+            log_status(
+                {
+                    'actionState':'Error: {}'.format(err_msg),
+                    'bluebeamStatus':'Error'
+                },
+                submission_data.get('_id'))
+
+def export_succeeded(submission, export):
+    """
+        marks a submission exported, returns its result for finish_export
+    """
+    submission.date_exported = datetime.utcnow()
+    submission.bluebeam_project_id = export['project_id']
+    submission.permissions_status = export['permissions']
+    clear_checkpoints(submission)
+    return ('success', {
+        'submission_id': submission.id,
+        'bluebeam_id': export['project_id'],
+        'file_timings': export['file_timings'],
+        'permissions': export['permissions']
+    })
+
+def export_failed(submission_id, submission, err):
+    """
+        records the error of a submission, returns its result for finish_export
+        submission is None when it couldn't be read
+    """
+    err_msg = "{0}".format(err)
+    print('Encountered error exporting submission with id: {0}'.format(submission_id))
+    print(err_msg)
+    print(''.join(traceback.format_exception(type(err), err, err.__traceback__)))
+    if submission is not None:
+        submission.error_message = err_msg
+    return ('failure', {
+        'id': submission_id,
+        'data': submission.data if submission is not None else None,
+        'err': err_msg
+    })
+
+@celery_app.task(name="tasks.finish_export", bind=True)
+def finish_export(self, results, export_id):
+    # pylint: disable=unused-argument
+    """
+        records the results of all export_submission tasks of an export
+    """
+    statuses = {
+        'success': [],
+        'failure': []
+    }
+    for status, status_details in results:
+        statuses[status].append(status_details)
+
+    session = create_session()
+    db_session = session()
     export_status = db_session.query(ExportStatusModel).filter(
         ExportStatusModel.guid == export_id
     ).first()
@@ -196,6 +506,9 @@ def scheduler(self):
     """
         queries for building permit applications and
         schedules them to be exported to bluebeam
+        queued applications are read a page at a time, each page is saved in one transaction
+        there's no high-water mark since an application can be queued again with an older _id,
+        the ones exported leave the queue so later pages only skip the ones still in it
     """
     print("scheduler starting...")
 
@@ -204,109 +517,343 @@ def scheduler(self):
 
     # check queued records
     try:
-        submissions_response = requests.get(
-            '{0}/applications'.format(os.environ.get('BUILDING_PERMITS_URL').rstrip('/')),
-            headers={'x-apikey':os.environ.get('BUILDING_PERMITS_API_KEY')},
-            params={
-                'actionState':os.environ.get('BLUEBEAM_ACTION_STATE_VALUE')
-            }
-        )
-        submissions_response.raise_for_status()
-
-        queued_submissions = submissions_response.json()
-        print("submissions from Building Permits API:{0}".format(queued_submissions))
-        for submission in queued_submissions:
-            log_status(
-                {'actionState':'processing'},
-                submission['_id']
-            )
-
-            export_obj = create_export(db_session)
-            create_submission(
-                db_session,
-                json_data={
-                    '_id':submission.get('_id'),
-                    'building_permit_number':submission['data'].get('buildingPermitApplicationNumber'), #pylint: disable=line-too-long
-                    'project_name':submission['data'].get('projectAddress'),
-                    'project_id':submission['data'].get('bluebeamId'),
-                    'files':utils.get_files(submission)},
-                export_id=export_obj.guid
-            )
-            db_session.commit()
-
-            bluebeam_export.apply_async(
-                args=(export_obj.guid,),
-                serializer='pickle'
+        poll_cursor = get_poll_cursor(db_session, APPLICATIONS_CURSOR)
+        still_queued = 0
+        for page_number in range(BUILDING_PERMITS_MAX_PAGES):
+            headers = {'x-apikey':os.environ.get('BUILDING_PERMITS_API_KEY')}
+            if page_number == 0:
+                # the validators are of the last run's empty queue
+                headers.update(conditional_headers(poll_cursor))
+            submissions_response = requests.get(
+                '{0}/applications'.format(os.environ.get('BUILDING_PERMITS_URL').rstrip('/')),
+                headers=headers,
+                params=applications_query(still_queued)
             )
+            if submissions_response.status_code == 304:
+                print("no new applications from Building Permits API")
+                break
+            submissions_response.raise_for_status()
+
+            queued_submissions = submissions_response.json()
+            print("page {0} from Building Permits API:{1}".format(
+                page_number,
+                [submission.get('_id') for submission in queued_submissions]
+            ))
+            if not queued_submissions:
+                if page_number == 0:
+                    poll_cursor.etag = submissions_response.headers.get('ETag')
+                    poll_cursor.last_modified = submissions_response.headers.get('Last-Modified')
+                    db_session.commit()
+                break
+
+            still_queued += ingest_applications(db_session, poll_cursor, queued_submissions)
+            if len(queued_submissions) < BUILDING_PERMITS_PAGE_SIZE:
+                break
     except Exception as err:    # pylint: disable=broad-except
         print("Encountered error when querying Building Permits API: {0}".format(err))
         print(traceback.format_exc())
         raise err
     finally:
-        db_session.commit()
         db_session.close()
 
-def upload_files(project_id, upload_dir_id, files, access_token):
+def applications_query(skip):
+    """
+        query params for a page of queued applications, oldest first,
+        skip is the number of applications this run left in the queue
+    """
+    return {
+        'actionState':os.environ.get('BLUEBEAM_ACTION_STATE_VALUE'),
+        'sort':'_id',
+        'max':BUILDING_PERMITS_PAGE_SIZE,
+        'skip':skip
+    }
+
+def conditional_headers(poll_cursor):
+    """
+        If-None-Match/If-Modified-Since for the last empty response
+    """
+    if poll_cursor.etag:
+        return {'If-None-Match':poll_cursor.etag}
+    if poll_cursor.last_modified:
+        return {'If-Modified-Since':poll_cursor.last_modified}
+    return {}
+
+def ingest_applications(db_session, poll_cursor, queued_submissions):
+    """
+        saves a page of applications as exports
+        invalid applications and the ones that couldn't be set to processing
+        stay queued for the next run, as do all of them when they can't be saved
+        returns how many of the page stay queued
+    """
+    applications = []
+    for submission in queued_submissions:
+        json_data = application_submission(submission)
+        try:
+            validate(json_data)
+        except Exception as err: # pylint: disable=broad-except
+            print("Skipping invalid application {0}: {1}".format(submission.get('_id'), err))
+            continue
+        applications.append(json_data)
+
+    applications = set_action_state(applications, 'processing')
+    poll_cursor.etag = None
+    poll_cursor.last_modified = None
+
+    # the cleared validators are committed along with the exports
+    try:
+        export_ids = create_exports(
+            db_session,
+            group_applications(applications, SCHEDULER_EXPORT_SIZE)
+        )
+    except Exception:
+        # not saved, so they go back in the queue rather than stay in processing
+        db_session.rollback()
+        set_action_state(applications, os.environ.get('BLUEBEAM_ACTION_STATE_VALUE'))
+        raise
+    for export_id in export_ids:
+        bluebeam_export.apply_async(
+            args=(export_id,),
+            serializer='pickle'
+        )
+    return len(queued_submissions) - len(applications)
+
+def application_submission(submission):
+    """
+        the submission json of a building permit application
+    """
+    return {
+        '_id':submission.get('_id'),
+        'building_permit_number':submission['data'].get('buildingPermitApplicationNumber'),
+        'project_name':submission['data'].get('projectAddress'),
+        'project_id':submission['data'].get('bluebeamId'),
+        'files':utils.get_files(submission)
+    }
+
+def set_action_state(applications, action_state):
+    """
+        sets the actionState of the applications in the Building Permits API concurrently
+        returns the applications that were updated
+    """
+    with ThreadPoolExecutor(max_workers=SCHEDULER_MAX_PARALLEL_PATCHES) as executor:
+        futures = [
+            executor.submit(log_status, {'actionState':action_state}, application['_id'])
+            for application in applications
+        ]
+    return [
+        application for application, future in zip(applications, futures)
+        if future.exception() is None
+    ]
+
+def group_applications(applications, size):
+    """
+        splits the applications into groups of size, one group when size is 0
+    """
+    size = size or len(applications) or 1
+    return [applications[i:i + size] for i in range(0, len(applications), size)]
+
+def upload_files(project_id, upload_dir_id, files, access_token, folder_index):
     """
         upload all the files to the upload dir of a project
+        returns the time spent on each file
+    """
+    return transfer_files(
+        lambda: (project_id, upload_dir_id),
+        files,
+        access_token,
+        folder_index
+    )
+
+def transfer_files(destination, files, access_token, folder_index, checked=None):
+    """
+        downloads the files and uploads them to bluebeam
+        destination() returns the project id and upload dir id, it is only called
+        once a file is ready to upload so downloads can start before the project exists
+        up to MAX_PARALLEL_UPLOADS files are transferred at the same time,
+        the first failure cancels the files not yet started and is raised
+        once the uploads in flight finish
+        folder_index is shared across files so the project folders are only listed once
+        checked has the zips check_zips already downloaded, they aren't downloaded again
+        returns the time spent on each file
     """
     print("tasks.upload_files:{0}".format(files))
-    cloudstorage_url = os.environ.get('CLOUDSTORAGE_URL')
-    cloudstorage_api_key = os.environ.get('CLOUDSTORAGE_API_KEY')
-    bucketeer_domain = os.environ.get('BUCKETEER_DOMAIN')
 
     if files is None:
         files = []
 
-    for f in files: #pylint: disable=invalid-name
-        print("tasks.upload_files file: {0}".format(f))
-        file_url = f['url']
-        file_url_parsed = urlparse(file_url)
-
-        # use cloudstorage api to retrieve file
-        response = None
-        if file_url_parsed.netloc == bucketeer_domain:
-            response = requests.get(
-                cloudstorage_url,
-                params={
-                    'name':file_url_parsed.path[1:],
-                    'apikey':cloudstorage_api_key
-                },
-                stream=True
+    # guards folder_index while today's submittal folder is created
+    folder_lock = threading.Lock()
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_UPLOADS) as executor:
+        futures = [
+            executor.submit(
+                upload_submission_file,
+                f,
+                destination,
+                access_token,
+                folder_index,
+                folder_lock,
+                checked or {}
+            ) for f in files
+        ]
+        wait(futures, return_when=FIRST_EXCEPTION)
+        for future in futures:
+            future.cancel()
+
+    timings = [future.result() for future in futures]
+    print("tasks.upload_files timings:{0}".format(timings))
+    return timings
+
+def upload_submission_file(f, destination, access_token, folder_index, folder_lock, checked):
+    # pylint: disable=invalid-name,too-many-arguments
+    """
+        downloads a single submission file and uploads it to bluebeam,
+        a zip in checked is uploaded from where check_zips downloaded it
+        returns the file name, the seconds it took and whether the download was cached
+    """
+    print("tasks.upload_files file: {0}".format(f))
+    start_time = perf_counter()
+    if f['url'] in checked:
+        file_path, cached = checked[f['url']]
+        upload_zip(access_token, destination, file_path, folder_index, folder_lock)
+    else:
+        cached = download_and_upload(f, destination, access_token, folder_index, folder_lock)
+
+    return {
+        'name': f['originalName'],
+        'seconds': round(perf_counter() - start_time, 4),
+        'cached': cached
+    }
+
+def download_and_upload(f, destination, access_token, folder_index, folder_lock):
+    # pylint: disable=invalid-name
+    """
+        downloads a submission file and uploads it to bluebeam
+        returns true when the download came from the download cache
+    """
+    response = submission_files.download(
+        f['url'],
+        submission_files.download_cache.validators(f['url'])
+    )
+    file_name = f['originalName']
+    cached = False
+
+    try:
+        content_length = None
+        if STREAM_UPLOADS and not file_name.endswith('.zip') and response.status_code != 304:
+            content_length = submission_files.get_passthrough_length(response)
+        if content_length is not None and is_uploaded(
+                destination()[0], bluebeam.clean_file_name(file_name), content_length):
+            # the project has a file with this name and size,
+            # it goes through disk to be compared by sha256
+            content_length = None
+
+        if content_length is not None:
+            # pipe the download straight into the upload without touching disk,
+            # these aren't cached
+            upload_passthrough(
+                response,
+                file_name,
+                content_length,
+                destination,
+                access_token,
+                folder_index,
+                folder_lock
             )
-            print("upload_files cloud path:{0}".format(file_url_parsed.path[1:]))
         else:
-            response = requests.get(file_url, stream=True)
-        response.raise_for_status()
-        file_name = f['originalName']
+            cached = upload_from_disk(
+                response,
+                f['url'],
+                file_name,
+                destination,
+                access_token,
+                folder_index,
+                folder_lock
+            )
+    finally:
+        response.close()
+    return cached
 
-        # write downloaded file locally
-        tmp_dir = tempfile.mkdtemp()
+def upload_passthrough(response, file_name, content_length, destination, access_token,
+                       folder_index, folder_lock):
+    # pylint: disable=too-many-arguments
+    """
+        uploads a download as it streams in
+        its sha256 is only known once it's read, so it's recorded after the upload
+    """
+    project_id, upload_dir_id = destination()
+    stream = HashingReader(response.raw)
+    bluebeam.upload_file(
+        access_token,
+        project_id,
+        file_name,
+        bluebeam.SizedStream(stream, content_length),
+        upload_dir_id,
+        folder_index,
+        folder_lock
+    )
+    record_upload(
+        project_id,
+        bluebeam.clean_file_name(file_name),
+        content_length,
+        stream.hexdigest()
+    )
+
+def check_zips(files, tmp_dir):
+    """
+        downloads the zips among files into tmp_dir and checks them against the zip limits,
+        so a new project is only created once its zips are known to be uploadable
+        returns the path of each zip and whether it came from the download cache, by url
+    """
+    zips = [f for f in files or [] if f['originalName'].endswith('.zip')]
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_UPLOADS) as executor:
+        checked = executor.map(
+            submission_files.check_zip,
+            zips,
+            [os.path.join(tmp_dir, str(index)) for index in range(len(zips))]
+        )
+        return {f['url']: zip_checked for f, zip_checked in zip(zips, checked)}
+
+def upload_from_disk(response, file_url, file_name, destination, access_token, folder_index,
+                     folder_lock):
+    # pylint: disable=too-many-arguments
+    """
+        writes the download to a temp dir and uploads it from there
+        returns true when the file came from the download cache
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
         file_path = os.path.join(tmp_dir, file_name)
-        downloaded_file = open(file_path, 'wb')
-        shutil.copyfileobj(BytesIO(response.content), downloaded_file)
-        del response
-        downloaded_file.close()
+        cached = submission_files.save_download(response, file_url, file_path)
 
         # handle zips
         if file_name.endswith('.zip'):
             upload_zip(
                 access_token,
-                project_id,
+                destination,
                 file_path,
-                upload_dir_id
+                folder_index,
+                folder_lock
             )
         else:
-            bluebeam.upload_file(
-                access_token,
+            project_id, upload_dir_id = destination()
+            upload_once(
                 project_id,
                 file_name,
-                file_path,
-                upload_dir_id
+                os.path.getsize(file_path),
+                hash_file(file_path),
+                lambda: bluebeam.upload_file(
+                    access_token,
+                    project_id,
+                    file_name,
+                    file_path,
+                    upload_dir_id,
+                    folder_index,
+                    folder_lock
+                )
             )
-
+    finally:
         # cleanup
         shutil.rmtree(tmp_dir)
+    return cached
 
 def format_project_id(project_id):
     """
@@ -340,29 +887,92 @@ def log_status(status, formio_id):
         print("status:{0}".format(status))
         raise err
 
-def upload_zip(access_token, project_id, file_path, upload_dir_id):
+def upload_zip(access_token, destination, file_path, folder_index, folder_lock):
     """
-        unzips file and uploads pdfs to bluebeam
+        uploads the pdfs in a zip file to bluebeam
+        each pdf is streamed out of the zip into its upload, nothing is extracted
+        a zip over the limits fails before waiting on destination()
     """
-    tmp_dir = tempfile.mkdtemp()
-
-    # extract zip file
     with zipfile.ZipFile(file_path, "r") as zip_file:
-        zip_file.extractall(tmp_dir)
-
-    # upload only pdfs
-    files = os.listdir(tmp_dir)
-    for f in files: # pylint: disable=invalid-name
-        if f.endswith(".pdf"):
-            bluebeam.upload_file(
-                access_token,
+        members = submission_files.pdf_members(zip_file)
+        project_id, upload_dir_id = destination()
+        for member in members:
+            # read twice, once for the checksum and again if it has to be uploaded
+            with zip_file.open(member) as pdf:
+                sha256 = hash_stream(pdf)
+            upload_once(
                 project_id,
-                f,
-                os.path.join(tmp_dir, f),
-                upload_dir_id
+                posixpath.basename(member.filename),
+                member.file_size,
+                sha256,
+                lambda member=member: upload_member(
+                    access_token,
+                    project_id,
+                    zip_file,
+                    member,
+                    upload_dir_id,
+                    folder_index,
+                    folder_lock
+                )
             )
-    # cleanup
-    shutil.rmtree(tmp_dir)
+
+def upload_member(access_token, project_id, zip_file, member, upload_dir_id, folder_index,
+                  folder_lock):
+    # pylint: disable=too-many-arguments
+    """
+        streams a pdf out of a zip into its upload
+    """
+    with zip_file.open(member) as pdf:
+        bluebeam.upload_file(
+            access_token,
+            project_id,
+            posixpath.basename(member.filename),
+            bluebeam.SizedStream(pdf, member.file_size),
+            upload_dir_id,
+            folder_index,
+            folder_lock
+        )
+
+def upload_once(project_id, file_name, size, sha256, upload):
+    """
+        calls upload() unless the project already has a file with the same name,
+        size and sha256, so a resubmission only uploads the files that changed
+        the file is only recorded once upload() returns, after its upload is confirmed,
+        so a failed, cancelled or killed upload leaves nothing behind to skip it
+        returns false when the file was skipped
+    """
+    file_name = bluebeam.clean_file_name(file_name)
+    if is_uploaded(project_id, file_name, size, sha256):
+        print("tasks.upload_once:{0} is already in {1}".format(file_name, project_id))
+        return False
+    upload()
+    record_upload(project_id, file_name, size, sha256)
+    return True
+
+def is_uploaded(project_id, file_name, size, sha256=None):
+    """
+        true when the project has a file with the same name and size,
+        and the same sha256 when it's given
+        each call has its own short session since uploads run in parallel threads
+    """
+    db_session = create_session()()
+    try:
+        return find_uploaded_file(db_session, project_id, file_name, size, sha256) is not None
+    finally:
+        db_session.close()
+
+def record_upload(project_id, file_name, size, sha256):
+    """
+        records a file uploaded to a project, the unique constraint keeps a single record
+        when several exports uploaded the same file at the same time
+    """
+    db_session = create_session()()
+    try:
+        create_uploaded_file(db_session, project_id, file_name, size, sha256)
+    except IntegrityError:
+        print("tasks.record_upload:{0} was already recorded in {1}".format(file_name, project_id))
+    finally:
+        db_session.close()
 
 def trigger_webhook(webhook, payload, err_msg=None):
     """
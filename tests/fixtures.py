@@ -2,6 +2,11 @@
 import pytest
 from falcon import testing
 import service.microservice
+import service.resources.bluebeam as bluebeam
+from service.resources.rate_limiter import RateLimiter, MemoryBuckets
+from service.resources.download_cache import DownloadCache
+from service.resources.db import db_engine
+from service.resources.roster import clear_roster_cache
 
 CLIENT_HEADERS = {
     "ACCESS_KEY": "1234567"
@@ -9,6 +14,39 @@ CLIENT_HEADERS = {
 
 BLUEBEAM_USERNAME = "user@sfgov.org"
 
+@pytest.fixture(autouse=True)
+def no_rate_limit(monkeypatch):
+    """ bluebeam calls aren't rate limited unless a test sets up a limiter """
+    monkeypatch.setattr(bluebeam, 'rate_limiter', RateLimiter(MemoryBuckets(), {
+        'metadata': (0, 0),
+        'upload': (0, 0)
+    }))
+
+@pytest.fixture(autouse=True)
+def no_download_cache(monkeypatch, tmp_path):
+    """ downloads aren't cached unless a test sets up a cache """
+    monkeypatch.setattr(
+        'service.resources.submission_files.download_cache',
+        DownloadCache(str(tmp_path / 'cache'), 0)
+    )
+
+@pytest.fixture(autouse=True)
+def no_uploaded_files():
+    """ projects start out without any uploaded files on record """
+    with db_engine.connect() as con:
+        con.execute("DELETE FROM uploaded_file")
+
+@pytest.fixture(autouse=True)
+def no_poll_cursor():
+    """ the scheduler starts reading applications from the beginning """
+    with db_engine.connect() as con:
+        con.execute("DELETE FROM poll_cursor")
+
+@pytest.fixture(autouse=True)
+def fresh_roster():
+    """ tests change the user table, so each one starts without a cached roster """
+    clear_roster_cache()
+
 @pytest.fixture()
 def client():
     """ client fixture """
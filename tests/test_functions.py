@@ -1,12 +1,34 @@
 """Test functions"""
+#pylint: disable=too-many-lines
+import asyncio
 import datetime
-from unittest.mock import patch
+import os
+import json
+import logging
+import threading
+import uuid
+from io import BytesIO
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter, sleep
+from types import SimpleNamespace
+from unittest.mock import patch, Mock, MagicMock
 import pytest
+import redis
+import requests
 from cryptography.fernet import Fernet
+from sqlalchemy.dialects import postgresql
 import service.resources.bluebeam as bluebeam
-from service.resources.db import create_session
-from service.resources.models import is_url, TokenModel
+import service.resources.bluebeam_log as bluebeam_log
+import service.resources.bluebeam_async as bluebeam_async
+from service.resources.db import create_session, create_db_engine, db_engine
+from service.resources.models import is_url, TokenModel, SubmissionModel, UserModel,\
+    RosterVersionModel
 import service.resources.utils as utils
+from service.resources.rate_limiter import RateLimiter, RedisBuckets, MemoryBuckets, \
+    create_rate_limiter
+import service.resources.download_cache as download_cache
+from service.resources.download_cache import DownloadCache, create_download_cache
+import service.resources.roster as roster
 import tests.mocks as mocks
 import tests.utils as test_utils
 from tasks import format_project_id
@@ -14,9 +36,11 @@ from tasks import format_project_id
 session = create_session() # pylint: disable=invalid-name
 db = session() # pylint: disable=invalid-name
 
+TEST_PDF = 'tests/resources/dummy.pdf'
+
 def test_invalid_file_name():
     """ test uploading a file with an invalid filename """
-    with patch('service.resources.bluebeam.requests.request') as mock_post:
+    with patch('service.resources.bluebeam.http_session.request') as mock_post:
         mock_post.return_value.json.return_value = mocks.INIT_FILE_UPLOAD_INVALID_NAME_RESPONSE
         mock_post.return_value.status_code = 200
 
@@ -34,7 +58,7 @@ def test_is_url():
 
 def test_bluebeam_create_project_invalid_name():
     """ Test invalid bluebeam project name """
-    with patch('service.resources.bluebeam.requests.request') as mock_request:
+    with patch('service.resources.bluebeam.http_session.request') as mock_request:
         mock_request.json.return_value = mocks.CREATE_PROJECT_RESPONSE_INVALID_NAME
         mock_request.status_code = 400
 
@@ -55,6 +79,8 @@ def test_no_stored_token():
     """ Test case where no token is stored in db """
     # delete token in db
     db.query(TokenModel).delete()
+    db.commit()
+    bluebeam.clear_token_cache()
 
     # get token from db
     token = bluebeam.get_auth_token(db)
@@ -69,13 +95,164 @@ def test_save_get_token():
     hour_past = test_utils.NOW - datetime.timedelta(hours=1)
     token['.expires'] = hour_past.strftime("%a, %d %b %Y %H:%M:%S %Z")
     bluebeam.save_auth_token(db, token)
-    with patch('service.resources.bluebeam.requests.request') as mock_token_request:
+    with patch('service.resources.bluebeam.http_session.request') as mock_token_request:
         mock_token_request.return_value.json.return_value = test_utils.BLUEBEAM_ACCESS_TOKEN
         mock_token_request.return_value.status_code = 200
         retrieved_token = bluebeam.get_auth_token(db)
 
     assert test_utils.BLUEBEAM_ACCESS_TOKEN == retrieved_token
 
+def test_token_cache():
+    """ a fresh cached token is served without touching the db """
+    bluebeam.save_auth_token(db, test_utils.BLUEBEAM_ACCESS_TOKEN)
+    db_session = Mock()
+    with patch('service.resources.bluebeam.decrypt') as mock_decrypt:
+        for _ in range(3):
+            assert bluebeam.get_auth_token(db_session) == test_utils.BLUEBEAM_ACCESS_TOKEN
+        mock_decrypt.assert_not_called()
+    db_session.query.assert_not_called()
+
+def test_token_cache_version():
+    """ the cached token is checked against the db row version after the ttl """
+    bluebeam.save_auth_token(db, test_utils.BLUEBEAM_ACCESS_TOKEN)
+
+    # unchanged row, the cached token is kept
+    bluebeam.token_cache['checked_at'] -= bluebeam.TOKEN_CACHE_TTL
+    with patch('service.resources.bluebeam.decrypt') as mock_decrypt:
+        assert bluebeam.get_auth_token(db) == test_utils.BLUEBEAM_ACCESS_TOKEN
+        mock_decrypt.assert_not_called()
+
+    # another process saves a new token
+    new_token = test_utils.BLUEBEAM_ACCESS_TOKEN.copy()
+    new_token['access_token'] = 'new secret'
+    token_row = db.query(TokenModel).first()
+    token_row.value = utils.encrypt(bluebeam.ENCRYPTION_KEY, json.dumps(new_token))
+    token_row.version += 1
+    db.commit()
+
+    assert bluebeam.get_auth_token(db) == test_utils.BLUEBEAM_ACCESS_TOKEN
+    bluebeam.token_cache['checked_at'] -= bluebeam.TOKEN_CACHE_TTL
+    assert bluebeam.get_auth_token(db) == new_token
+
+def test_roster_cache():
+    """ the roster is read once into immutable records and served from the cache """
+    roster.clear_roster_cache()
+    users = roster.get_roster(db)
+    assert users == tuple(
+        roster.RosterUser(user.id, user.email)
+        for user in db.query(UserModel).order_by(UserModel.id)
+    )
+    with pytest.raises(AttributeError):
+        users[0].email = 'someone@test.com'
+
+    db_session = Mock()
+    assert roster.get_roster(db_session) is users
+    db_session.query.assert_not_called()
+
+def test_roster_cache_version():
+    """ a change to the user table is picked up once the cached roster is checked """
+    roster.clear_roster_cache()
+    users = roster.get_roster(db)
+
+    # unchanged table, the cached roster is kept
+    roster.roster_cache['checked_at'] -= roster.ROSTER_CACHE_TTL
+    assert roster.get_roster(db) is users
+
+    # the trigger bumps the version
+    version = roster.get_roster_version(db)
+    user = UserModel(email='roster@test.com')
+    db.add(user)
+    db.commit()
+    assert roster.get_roster_version(db) == version + 1
+
+    assert roster.get_roster(db) is users
+    roster.roster_cache['checked_at'] -= roster.ROSTER_CACHE_TTL
+    assert roster.get_roster(db)[-1] == roster.RosterUser(user.id, 'roster@test.com')
+
+    db.delete(user)
+    db.commit()
+    roster.clear_roster_cache()
+    assert roster.RosterUser(user.id, 'roster@test.com') not in roster.get_roster(db)
+
+    # without a version row
+    db_session = Mock()
+    db_session.query.return_value.first.return_value = None
+    assert roster.get_roster_version(db_session) is None
+    db_session.query.assert_called_once_with(RosterVersionModel.version)
+
+def test_token_proactive_refresh():
+    """ a token about to expire is refreshed before it expires """
+    token = test_utils.BLUEBEAM_ACCESS_TOKEN.copy()
+    expiring = test_utils.NOW + datetime.timedelta(seconds=bluebeam.TOKEN_REFRESH_MARGIN / 2)
+    token['.expires'] = expiring.strftime("%a, %d %b %Y %H:%M:%S %Z")
+    bluebeam.save_auth_token(db, token)
+    version = db.query(TokenModel).first().version
+
+    with patch('service.resources.bluebeam.http_session.request') as mock_token_request:
+        mock_token_request.return_value.json.return_value = test_utils.BLUEBEAM_ACCESS_TOKEN
+        mock_token_request.return_value.status_code = 200
+        assert bluebeam.get_auth_token(db) == test_utils.BLUEBEAM_ACCESS_TOKEN
+        assert bluebeam.get_auth_token(db) == test_utils.BLUEBEAM_ACCESS_TOKEN
+        assert mock_token_request.call_count == 1
+
+    db.expire_all()
+    assert db.query(TokenModel).first().version == version + 1
+    assert bluebeam.token_cache['version'] == version + 1
+
+def test_token_refresh_other_worker():
+    """ a worker waiting on the token row lock uses the token refreshed by the holder """
+    expired_token = test_utils.BLUEBEAM_ACCESS_TOKEN.copy()
+    hour_past = test_utils.NOW - datetime.timedelta(hours=1)
+    expired_token['.expires'] = hour_past.strftime("%a, %d %b %Y %H:%M:%S %Z")
+    bluebeam.save_auth_token(db, expired_token)
+    bluebeam.clear_token_cache()
+
+    # the other worker claims the row
+    other_db = session()
+    token_row = other_db.query(TokenModel).with_for_update().first()
+
+    results = []
+    worker_db = session()
+    with patch('service.resources.bluebeam.refresh_token') as mock_refresh:
+        thread = threading.Thread(
+            target=lambda: results.append(bluebeam.get_auth_token(worker_db))
+        )
+        thread.start()
+        thread.join(0.5)
+        # blocked on the row lock
+        assert thread.is_alive()
+
+        token_row.value = utils.encrypt(
+            bluebeam.ENCRYPTION_KEY,
+            json.dumps(test_utils.BLUEBEAM_ACCESS_TOKEN)
+        )
+        token_row.version += 1
+        other_db.commit()
+        thread.join()
+
+        mock_refresh.assert_not_called()
+    assert results == [test_utils.BLUEBEAM_ACCESS_TOKEN]
+    worker_db.close()
+    other_db.close()
+
+def test_token_refresh_error():
+    """ a failed refresh raises and leaves the stored token alone """
+    expired_token = test_utils.BLUEBEAM_ACCESS_TOKEN.copy()
+    hour_past = test_utils.NOW - datetime.timedelta(hours=1)
+    expired_token['.expires'] = hour_past.strftime("%a, %d %b %Y %H:%M:%S %Z")
+    bluebeam.save_auth_token(db, expired_token)
+    version = db.query(TokenModel).first().version
+
+    with patch('service.resources.bluebeam.http_session.request') as mock_token_request:
+        mock_token_request.return_value.json.return_value = {'error': 'invalid_grant'}
+        mock_token_request.return_value.status_code = 400
+        with pytest.raises(Exception, match='invalid_grant'):
+            bluebeam.get_auth_token(db)
+
+    token_row = db.query(TokenModel).first()
+    assert token_row.version == version
+    assert json.loads(utils.decrypt(bluebeam.ENCRYPTION_KEY, token_row.value)) == expired_token
+
 def test_format_project_id():
     """ Test the format_project_id function from tasks.py """
     project_id = format_project_id("123456789")
@@ -92,3 +269,792 @@ def test_format_project_id():
     input_id = "ABCDEFG"
     project_id = format_project_id(input_id)
     assert project_id == input_id
+
+class StandInBluebeamHandler(BaseHTTPRequestHandler):
+    """ local stand-in for the bluebeam api which counts tcp connections """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    connections = 0
+    requests = 0
+
+    def setup(self):
+        super().setup()
+        StandInBluebeamHandler.connections += 1
+
+    def respond(self):
+        """ consume the request body and answer every call with the same json """
+        StandInBluebeamHandler.requests += 1
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        body = json.dumps({
+            'Id': 1,
+            'UploadUrl': 'http://{0}:{1}/upload'.format(*self.server.server_address),
+            'UploadContentType': 'application/pdf',
+            'ProjectFolders': [],
+            'ProjectUsers': [{'Id': 1, 'Email': 'user1@test.com'}]
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = respond
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        pass
+
+def run_stand_in_export(http_session, base_url):
+    """ runs the bluebeam calls of a new project export with one file """
+    StandInBluebeamHandler.connections = 0
+    StandInBluebeamHandler.requests = 0
+    users = [SimpleNamespace(email='user1@test.com')]
+    start_time = perf_counter()
+    with patch('service.resources.bluebeam.http_session', http_session):
+        with patch('service.resources.bluebeam.BLUEBEAM_API_BASE_URL', base_url):
+            access = {'access_token': 'secret'}
+            project_id = bluebeam.create_project(access, 'stand-in')
+            folder_id = bluebeam.create_directories(
+                access,
+                project_id,
+                bluebeam.DIRECTORY_STRUCTURE
+            )
+            bluebeam.upload_file(
+                access,
+                project_id,
+                'dummy.pdf',
+                TEST_PDF,
+                folder_id,
+                {},
+                threading.Lock()
+            )
+            bluebeam.assign_user_permissions(access, project_id, users)
+    return (
+        StandInBluebeamHandler.connections,
+        StandInBluebeamHandler.requests,
+        perf_counter() - start_time
+    )
+
+def test_http_session_reuses_connections():
+    """ benchmark the pooled session against one connection per call """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInBluebeamHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = 'http://{0}:{1}'.format(*server.server_address)
+    try:
+        pooled_connections, pooled_requests, pooled_time = run_stand_in_export(
+            bluebeam.create_http_session(),
+            base_url
+        )
+        unpooled_connections, unpooled_requests, unpooled_time = run_stand_in_export(
+            bluebeam.create_http_session(keep_alive=False),
+            base_url
+        )
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    print("pooled: {0} requests over {1} connections in {2:.4f} secs".format(
+        pooled_requests,
+        pooled_connections,
+        pooled_time
+    ))
+    print("unpooled: {0} requests over {1} connections in {2:.4f} secs".format(
+        unpooled_requests,
+        unpooled_connections,
+        unpooled_time
+    ))
+    print("handshakes saved per export: {0}".format(unpooled_connections - pooled_connections))
+    assert pooled_requests == unpooled_requests
+    assert unpooled_connections == unpooled_requests
+    # the folders of a level are created at the same time, each on its own connection
+    assert pooled_connections <= bluebeam.BLUEBEAM_MAX_PARALLEL_CALLS
+
+def test_reset_http_session():
+    """ a forked worker gets a fresh session """
+    original_session = bluebeam.http_session
+    bluebeam.reset_http_session()
+    assert bluebeam.http_session is not original_session
+    assert bluebeam.http_session.get_adapter('https://api.test.com')._pool_maxsize == \
+        bluebeam.BLUEBEAM_POOL_MAXSIZE # pylint: disable=protected-access
+
+def test_create_db_engine():
+    """ the engine is built from the db settings """
+    engine = create_db_engine(
+        echo='false',
+        pool_size=2,
+        max_overflow=3,
+        pool_pre_ping=True,
+        pool_recycle=60
+    )
+    assert not engine.echo
+    assert engine.pool.size() == 2
+    assert engine.pool._max_overflow == 3 # pylint: disable=protected-access
+    assert engine.pool._pre_ping # pylint: disable=protected-access
+    assert engine.pool._recycle == 60 # pylint: disable=protected-access
+
+    assert create_db_engine(echo='true').echo is True
+    assert create_db_engine(echo='debug').echo == 'debug'
+
+def test_create_session_cached():
+    """ the session factory is built once """
+    assert create_session() is create_session()
+
+def logged_entries(mock_log):
+    """ (level, entry) for every request log line """
+    return [(args[0], json.loads(args[1])) for args, _ in mock_log.call_args_list]
+
+def test_bluebeam_request_log():
+    """ a successful call logs one line without bodies """
+    with patch('service.resources.bluebeam.http_session.request') as mock_request:
+        mock_request.return_value.status_code = 200
+        mock_request.return_value.ok = True
+        with patch.object(bluebeam_log.logger, 'log') as mock_log:
+            bluebeam.bluebeam_request(
+                'get',
+                'https://api.test.com/publicapi/v1/projects/123-456-789/folders/42?sig=abc',
+                access={'access_token': 'secret'}
+            )
+
+    [(level, entry)] = logged_entries(mock_log)
+    assert level == logging.INFO
+    assert entry['event'] == 'bluebeam_request'
+    assert entry['method'] == 'GET'
+    assert entry['path'] == '/publicapi/v1/projects/{id}/folders/{id}'
+    assert entry['status'] == 200
+    assert entry['secs'] >= 0
+    assert 'request_body' not in entry
+    assert 'response_body' not in entry
+
+def test_bluebeam_request_log_failure():
+    """ a failed call logs truncated and redacted bodies """
+    with patch('service.resources.bluebeam.http_session.request') as mock_request:
+        mock_request.return_value.status_code = 400
+        mock_request.return_value.ok = False
+        mock_request.return_value.text = json.dumps({
+            'access_token': 'secret',
+            'refresh_token': 'secret2',
+            'error': 'x' * 100
+        })
+        mock_request.return_value.raise_for_status.side_effect = requests.exceptions.HTTPError
+        with patch('service.resources.bluebeam_log.BLUEBEAM_LOG_BODY_LIMIT', 80):
+            with patch.object(bluebeam_log.logger, 'log') as mock_log:
+                with pytest.raises(requests.exceptions.HTTPError):
+                    bluebeam.bluebeam_request(
+                        'post',
+                        'https://authserver.bluebeam.com/auth/token',
+                        data={'grant_type': 'refresh_token', 'refresh_token': 'secret2'},
+                        access={'access_token': 'secret'}
+                    )
+
+    [(level, entry)] = logged_entries(mock_log)
+    assert level == logging.WARNING
+    assert entry['status'] == 400
+    assert entry['request_headers'] == {'Authorization': bluebeam_log.REDACTED}
+    assert json.loads(entry['request_body']) == {
+        'grant_type': 'refresh_token',
+        'refresh_token': bluebeam_log.REDACTED
+    }
+    assert 'secret' not in entry['response_body']
+    assert entry['response_body'].endswith('chars]')
+    assert len(entry['response_body']) < 100
+
+def test_bluebeam_request_log_sampled():
+    """ sampled calls log bodies, but streamed uploads only by type """
+    with patch('service.resources.bluebeam.http_session.request') as mock_request:
+        mock_request.return_value.status_code = 200
+        mock_request.return_value.ok = True
+        mock_request.return_value.text = ''
+        with patch('service.resources.bluebeam_log.BLUEBEAM_LOG_SAMPLE_RATE', 1):
+            with patch.object(bluebeam_log.logger, 'log') as mock_log:
+                bluebeam.bluebeam_request('put', 'https://s3.test.com/upload', data=BytesIO(b'pdf'))
+                bluebeam.bluebeam_request('post', 'https://api.test.com/projects', json=[1])
+                bluebeam.bluebeam_request('post', 'https://api.test.com/projects')
+
+    entries = [entry for _, entry in logged_entries(mock_log)]
+    assert entries[0]['request_body'] == '<BytesIO>'
+    assert entries[0]['request_headers'] is None
+    assert entries[1]['request_body'] == '[1]'
+    assert entries[2]['request_body'] is None
+
+def test_bluebeam_request_log_error():
+    """ connection errors are logged and raised """
+    with patch('service.resources.bluebeam.http_session.request') as mock_request:
+        mock_request.side_effect = requests.exceptions.ConnectionError
+        with patch.object(bluebeam_log.logger, 'log') as mock_log:
+            with pytest.raises(requests.exceptions.ConnectionError):
+                bluebeam.bluebeam_request(
+                    'get',
+                    'https://api.test.com/projects/123-456-789',
+                    retries=0
+                )
+
+    [(level, entry)] = logged_entries(mock_log)
+    assert level == logging.ERROR
+    assert entry['error'] == 'ConnectionError'
+    assert entry['path'] == '/projects/{id}'
+
+def test_create_logger():
+    """ the request logger gets its stdout handler once """
+    handlers = list(bluebeam_log.logger.handlers)
+    assert bluebeam_log.create_logger() is bluebeam_log.logger
+    assert bluebeam_log.logger.handlers == handlers
+    assert not bluebeam_log.logger.propagate
+
+def explain(con, query):
+    """ the postgres query plan for an orm query """
+    compiled = query.statement.compile(dialect=postgresql.dialect())
+    return "\n".join(row[0] for row in con.execute("EXPLAIN " + str(compiled), compiled.params))
+
+def test_submission_query_plans():
+    """ the export lookups use the submission indexes on a large table """
+    con = db_engine.connect()
+    transaction = con.begin()
+    try:
+        # 50k submissions spread over 2k exports, 1% of them not exported yet
+        con.execute(
+            "INSERT INTO export_status (guid, date_started) " +\
+            "SELECT md5(g::text)::uuid, now() FROM generate_series(1, 2000) g"
+        )
+        con.execute(
+            "INSERT INTO submission (data, date_exported, export_guid) " +\
+            "SELECT '{}', CASE WHEN mod(g, 100) = 0 THEN NULL ELSE now() END, " +\
+            "md5((mod(g, 2000) + 1)::text)::uuid FROM generate_series(1, 50000) g"
+        )
+        con.execute("ANALYZE submission")
+
+        # submissions of an export
+        plan = explain(con, db.query(SubmissionModel.id).filter(
+            SubmissionModel.export_status_guid == uuid.uuid4()
+        ).order_by(SubmissionModel.id))
+        print(plan)
+        assert 'ix_submission_export_guid' in plan
+
+        # submissions waiting to be exported
+        plan = explain(con, db.query(SubmissionModel.id).filter(
+            SubmissionModel.date_exported.is_(None)
+        ).order_by(SubmissionModel.id))
+        print(plan)
+        # freshly inserted rows can make the planner prefer the full date_exported index
+        assert 'Seq Scan' not in plan
+        assert 'ix_submission_unexported' in plan or 'ix_submission_date_exported' in plan
+
+        # submissions exported recently
+        plan = explain(con, db.query(SubmissionModel.id).filter(
+            SubmissionModel.date_exported > test_utils.HOUR_FUTURE
+        ))
+        print(plan)
+        assert 'ix_submission_date_exported' in plan
+    finally:
+        transaction.rollback()
+        con.close()
+
+def fake_response(status_code, headers=None):
+    """ mock bluebeam response with a status """
+    response = Mock()
+    response.status_code = status_code
+    response.ok = status_code < 400
+    response.headers = headers or {}
+    response.text = ''
+    if not response.ok:
+        response.raise_for_status.side_effect = requests.exceptions.HTTPError(status_code)
+    return response
+
+def test_bluebeam_request_retry():
+    """ idempotent calls are retried on transient failures """
+    with patch('service.resources.bluebeam.http_session.request') as mock_request:
+        mock_request.side_effect = [
+            fake_response(503, {'Retry-After': '2'}),
+            requests.exceptions.ConnectionError(),
+            fake_response(502),
+            fake_response(200)
+        ]
+        with patch('service.resources.bluebeam.sleep') as mock_sleep:
+            with patch.object(bluebeam_log.logger, 'log') as mock_log:
+                response = bluebeam.bluebeam_request('get', 'https://api.test.com/projects/1')
+
+    assert response.status_code == 200
+    assert mock_request.call_count == 4
+    delays = [args[0] for args, _ in mock_sleep.call_args_list]
+    assert delays[0] == 2
+    assert 0 <= delays[1] <= bluebeam.BLUEBEAM_RETRY_BASE_DELAY * 2
+    assert 0 <= delays[2] <= bluebeam.BLUEBEAM_RETRY_BASE_DELAY * 4
+    entries = logged_entries(mock_log)
+    assert [entry['attempt'] for _, entry in entries] == [1, 2, 3, 4]
+    assert [level for level, _ in entries] == [logging.WARNING] * 3 + [logging.INFO]
+    assert entries[0][1]['retry_in'] == 2
+    metrics = bluebeam_log.get_retry_metrics()
+    assert metrics['GET /projects/{id} 503'] >= 1
+    assert metrics['GET /projects/{id} ConnectionError'] >= 1
+    assert metrics['GET /projects/{id} 502'] >= 1
+
+def test_bluebeam_request_retry_budget():
+    """ the last failure is raised once the retries are spent """
+    with patch('service.resources.bluebeam.http_session.request') as mock_request:
+        mock_request.return_value = fake_response(503)
+        with patch('service.resources.bluebeam.sleep') as mock_sleep:
+            with pytest.raises(requests.exceptions.HTTPError):
+                bluebeam.bluebeam_request('delete', 'https://api.test.com/projects/1', retries=2)
+            assert mock_sleep.call_count == 2
+        assert mock_request.call_count == 3
+
+        mock_request.return_value = fake_response(429)
+        mock_request.reset_mock()
+        with patch('service.resources.bluebeam.sleep'):
+            with pytest.raises(requests.exceptions.HTTPError):
+                bluebeam.bluebeam_request('get', 'https://api.test.com/projects/1')
+        assert mock_request.call_count == bluebeam.BLUEBEAM_RETRIES + 1
+
+def test_bluebeam_request_retry_post():
+    """ calls that aren't idempotent are only retried when they weren't processed """
+    with patch('service.resources.bluebeam.http_session.request') as mock_request:
+        with patch('service.resources.bluebeam.sleep') as mock_sleep:
+            # may have been processed
+            mock_request.side_effect = [fake_response(503)]
+            with pytest.raises(requests.exceptions.HTTPError):
+                bluebeam.create_project({'access_token': 'secret'}, 'project')
+
+            mock_request.side_effect = [requests.exceptions.ConnectionError()]
+            with pytest.raises(requests.exceptions.ConnectionError):
+                bluebeam.create_project({'access_token': 'secret'}, 'project')
+            mock_sleep.assert_not_called()
+
+            # never processed
+            created = fake_response(200)
+            created.json.return_value = mocks.CREATE_PROJECT_RESPONSE
+            mock_request.side_effect = [
+                fake_response(429, {'Retry-After': 'soon'}),
+                requests.exceptions.ConnectTimeout(),
+                created
+            ]
+            assert bluebeam.create_project({'access_token': 'secret'}, 'project') == \
+                mocks.CREATE_PROJECT_RESPONSE['Id']
+            assert mock_sleep.call_count == 2
+
+            # confirming an upload is idempotent
+            mock_request.side_effect = [fake_response(503), fake_response(204)]
+            assert bluebeam.confirm_upload({'access_token': 'secret'}, '123-456-789', 1)
+
+def test_bluebeam_request_retry_stream():
+    """ file bodies are rewound for a retry, streams that can't be rewound aren't retried """
+    sent = []
+    def send(**kwargs):
+        sent.append(kwargs['data'].read())
+        if len(sent) == 1:
+            raise requests.exceptions.ConnectionError()
+        return fake_response(200)
+
+    with patch('service.resources.bluebeam.http_session.request') as mock_request:
+        mock_request.side_effect = send
+        with patch('service.resources.bluebeam.sleep'):
+            file_obj = BytesIO(b'header:pdf')
+            file_obj.read(7)
+            bluebeam.bluebeam_request('put', 'https://s3.test.com/upload', data=file_obj)
+    assert sent == [b'pdf', b'pdf']
+
+    sent.clear()
+    with patch('service.resources.bluebeam.http_session.request') as mock_request:
+        mock_request.side_effect = send
+        with patch('service.resources.bluebeam.sleep'):
+            bluebeam.bluebeam_request(
+                'put',
+                'https://s3.test.com/upload',
+                data=bluebeam.SizedStream(BytesIO(b'pdf'), 3)
+            )
+    assert sent == [b'pdf', b'pdf']
+
+    with patch('service.resources.bluebeam.http_session.request') as mock_request:
+        mock_request.side_effect = requests.exceptions.ConnectionError()
+        with patch('service.resources.bluebeam.sleep') as mock_sleep:
+            with pytest.raises(requests.exceptions.ConnectionError):
+                bluebeam.bluebeam_request(
+                    'put',
+                    'https://s3.test.com/upload',
+                    data=bluebeam.SizedStream(Mock(spec=['read']), 3)
+                )
+            mock_sleep.assert_not_called()
+        assert mock_request.call_count == 1
+
+def test_get_retry_after():
+    """ Retry-After is read as secs or a date and capped """
+    assert bluebeam.get_retry_after(fake_response(503)) is None
+    assert bluebeam.get_retry_after(fake_response(503, {'Retry-After': '3'})) == 3
+    assert bluebeam.get_retry_after(fake_response(503, {'Retry-After': 'soon'})) is None
+    assert bluebeam.get_retry_after(
+        fake_response(503, {'Retry-After': '100000'})
+    ) == bluebeam.BLUEBEAM_RETRY_MAX_DELAY
+
+    in_a_minute = test_utils.NOW + datetime.timedelta(seconds=60)
+    delay = bluebeam.get_retry_after(fake_response(503, {
+        'Retry-After': in_a_minute.strftime("%a, %d %b %Y %H:%M:%S GMT")
+    }))
+    assert 0 < delay <= 60
+    past = test_utils.NOW - datetime.timedelta(seconds=60)
+    assert bluebeam.get_retry_after(fake_response(503, {
+        'Retry-After': past.strftime("%a, %d %b %Y %H:%M:%S GMT")
+    })) == 0
+
+def test_memory_buckets():
+    """ the in process bucket gives out its burst then asks to wait """
+    buckets = MemoryBuckets()
+    assert buckets.take('metadata', 10, 2) == 0
+    assert buckets.take('metadata', 10, 2) == 0
+    assert 0 < buckets.take('metadata', 10, 2) <= 0.1
+    # buckets are separate
+    assert buckets.take('upload', 10, 2) == 0
+
+def test_redis_buckets():
+    """ the redis bucket is shared by every worker """
+    name = str(uuid.uuid4())
+    worker1 = RedisBuckets(redis.Redis.from_url(os.environ['REDIS_URL']))
+    worker2 = RedisBuckets(redis.Redis.from_url(os.environ['REDIS_URL']))
+    assert worker1.take(name, 10, 2) == 0
+    assert worker2.take(name, 10, 2) == 0
+    assert 0 < worker1.take(name, 10, 2) <= 0.1
+    assert 0 < worker2.take(name, 10, 2) <= 0.1
+    assert worker1.take(str(uuid.uuid4()), 10, 2) == 0
+
+@pytest.mark.parametrize('buckets', [
+    MemoryBuckets(),
+    RedisBuckets(redis.Redis.from_url(os.environ['REDIS_URL']))
+])
+def test_rate_limiter_rate(buckets):
+    """ parallel callers are held to the bucket rate """
+    limiter = RateLimiter(buckets, {str(id(buckets)): (50, 1)})
+    start_time = perf_counter()
+    threads = [
+        threading.Thread(target=lambda: [limiter.acquire(str(id(buckets))) for _ in range(3)])
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # 12 calls, the first from the burst and the rest 1/50 sec apart
+    assert perf_counter() - start_time >= 11 / 50 * 0.9
+
+def test_rate_limiter_acquire():
+    """ acquire waits as told by the bucket and lets calls through without redis """
+    buckets = Mock()
+    buckets.take.side_effect = [0.5, 0.25, 0]
+    limiter = RateLimiter(buckets, {'metadata': (10, 20), 'upload': (0, 0)})
+    with patch('service.resources.rate_limiter.sleep') as mock_sleep:
+        assert limiter.acquire('metadata') == 0.75
+        assert [args[0] for args, _ in mock_sleep.call_args_list] == [0.5, 0.25]
+
+        # turned off
+        assert limiter.acquire('upload') == 0
+        assert buckets.take.call_count == 3
+
+        # redis is down
+        buckets.take.side_effect = redis.exceptions.ConnectionError('down')
+        assert limiter.acquire('metadata') == 0
+        assert mock_sleep.call_count == 2
+
+def test_create_rate_limiter(monkeypatch):
+    """ the limiter uses the broker redis when there is one """
+    limiter = create_rate_limiter()
+    assert isinstance(limiter.buckets, RedisBuckets)
+    assert set(limiter.limits) == {'metadata', 'upload'}
+    monkeypatch.delenv('REDIS_URL')
+    assert isinstance(create_rate_limiter().buckets, MemoryBuckets)
+
+def test_bluebeam_request_rate_limited():
+    """ calls wait for the metadata bucket, uploads for the upload bucket """
+    with patch('service.resources.bluebeam.rate_limiter') as mock_limiter:
+        mock_limiter.acquire.side_effect = [0.25, 0, 0]
+        with patch('service.resources.bluebeam.http_session.request') as mock_request:
+            mock_request.return_value = fake_response(200)
+            with patch.object(bluebeam_log.logger, 'log') as mock_log:
+                bluebeam.bluebeam_request('get', bluebeam.BLUEBEAM_API_BASE_URL + '/projects/1')
+                bluebeam.bluebeam_request(
+                    'put',
+                    bluebeam.BLUEBEAM_API_BASE_URL + '/projects/1/users/1/permissions'
+                )
+                bluebeam.bluebeam_request('put', 'https://s3.test.com/upload', data=b'pdf')
+
+    assert [args[0] for args, _ in mock_limiter.acquire.call_args_list] == \
+        ['metadata', 'metadata', 'upload']
+    entries = [entry for _, entry in logged_entries(mock_log)]
+    assert entries[0]['throttled'] == 0.25
+    assert 'throttled' not in entries[1]
+
+def test_bluebeam_operations():
+    """ each operation runs its calls with the blocking client """
+    access = {'access_token': 'secret'}
+    with patch('service.resources.bluebeam.http_session.request') as mock_request:
+        folder = fake_response(200)
+        folder.json.return_value = mocks.CREATE_FOLDER_RESPONSE
+        folders = fake_response(200)
+        folders.json.return_value = mocks.GET_FOLDERS_RESPONSE
+        users = fake_response(200)
+        users.json.return_value = mocks.GET_PROJECT_USERS_RESPONSE
+        mock_request.side_effect = [
+            folder, folders, fake_response(204), fake_response(204), users, fake_response(204)
+        ]
+
+        assert bluebeam.create_folder(access, '123-456-789', 'folder') == \
+            mocks.CREATE_FOLDER_RESPONSE['Id']
+        assert bluebeam.get_folders(access, '123-456-789') == \
+            mocks.GET_FOLDERS_RESPONSE['ProjectFolders']
+        bluebeam.add_project_user(access, '123-456-789', 'user1@test.com')
+        bluebeam.set_full_access_for_user(access, '123-456-789', 1)
+        assert bluebeam.get_project_users(access, '123-456-789') == \
+            mocks.GET_PROJECT_USERS_RESPONSE
+        bluebeam.delete_project(access, '123-456-789')
+
+    assert [call[1]['method'] for call in mock_request.call_args_list] == \
+        ['post', 'get', 'post', 'put', 'get', 'delete']
+
+def test_upload_file_folder_lock():
+    """ the folder lock is only taken while today's submittal folder is created """
+    access = {'access_token': 'secret'}
+    folder_lock = MagicMock()
+    folder_index = {}
+    with patch('service.resources.bluebeam.http_session.request') as mock_request:
+        folder = fake_response(200)
+        folder.json.return_value = mocks.CREATE_FOLDER_RESPONSE
+        upload = fake_response(200)
+        upload.json.return_value = mocks.INIT_FILE_UPLOAD_RESPONSE
+        mock_request.side_effect = [
+            folder, upload, fake_response(200), fake_response(204),
+            upload, fake_response(200), fake_response(204)
+        ]
+
+        for _ in range(2):
+            assert bluebeam.upload_file(
+                access,
+                '123-456-789',
+                'dummy.pdf',
+                TEST_PDF,
+                1234,
+                folder_index,
+                folder_lock
+            )
+
+    assert folder_lock.__enter__.call_count == 1
+    assert list(folder_index.values()) == [mocks.CREATE_FOLDER_RESPONSE['Id']]
+    # the second file went straight to today's folder
+    assert [call[1]['method'] for call in mock_request.call_args_list] == \
+        ['post', 'post', 'put', 'post', 'post', 'put', 'post']
+
+def test_async_bluebeam_operations():
+    """ the async client runs the calls of the blocking client off the event loop """
+    access = {'access_token': 'secret'}
+    requested = []
+    def request(method, url, **kwargs): # pylint: disable=unused-argument
+        requested.append((method, threading.current_thread()))
+        response = fake_response(204 if method in ('put', 'delete') else 200)
+        if url.endswith('/users'):
+            response.json.return_value = mocks.GET_PROJECT_USERS_RESPONSE
+        elif method == 'get':
+            response.json.return_value = mocks.GET_FOLDERS_RESPONSE
+        else:
+            response.json.return_value = mocks.CREATE_FOLDER_RESPONSE
+        return response
+
+    async def operations():
+        return [
+            await bluebeam_async.create_folder(access, '123-456-789', 'folder'),
+            await bluebeam_async.get_folders(access, '123-456-789'),
+            await bluebeam_async.set_full_access_for_user(access, '123-456-789', 1),
+            await bluebeam_async.get_project_users(access, '123-456-789'),
+            await bluebeam_async.delete_project(access, '123-456-789')
+        ]
+
+    with patch('service.resources.bluebeam.http_session.request', side_effect=request):
+        assert asyncio.run(operations()) == [
+            mocks.CREATE_FOLDER_RESPONSE['Id'],
+            mocks.GET_FOLDERS_RESPONSE['ProjectFolders'],
+            None,
+            mocks.GET_PROJECT_USERS_RESPONSE,
+            None
+        ]
+    assert [method for method, _ in requested] == ['post', 'get', 'put', 'get', 'delete']
+    assert threading.current_thread() not in [thread for _, thread in requested]
+
+def test_create_directories_by_level():
+    """ the folders of each level of the tree are created at the same time """
+    created = {}
+    in_flight = []
+    max_in_flight = []
+    lock = threading.Lock()
+    def create(**kwargs):
+        with lock:
+            in_flight.append(1)
+            max_in_flight.append(len(in_flight))
+        sleep(0.05)
+        with lock:
+            in_flight.pop()
+            created[kwargs['json']['Name']] = kwargs['json']['ParentFolderId']
+        response = fake_response(200)
+        response.json.return_value = {'Id': len(created)}
+        return response
+
+    folder_index = {}
+    with patch('service.resources.bluebeam.http_session.request', side_effect=create):
+        with patch.object(bluebeam_log.logger, 'log') as mock_log:
+            upload_dir_id = bluebeam.create_directories(
+                {'access_token': 'secret'},
+                '123-456-789',
+                bluebeam.DIRECTORY_STRUCTURE,
+                folder_index=folder_index
+            )
+
+    assert upload_dir_id == folder_index[bluebeam.UPLOAD_DIR_NAME]
+    assert len(folder_index) == 7
+    assert created['CCSF EPR'] == 0
+    assert created['A.PERMIT SUBMITTAL'] == folder_index['CCSF EPR']
+    assert created[bluebeam.UPLOAD_DIR_NAME] == folder_index['A.PERMIT SUBMITTAL']
+    assert created['1.BUILDING PERMIT DOCUMENTS'] == folder_index['B.APPROVED DOCUMENTS']
+    assert max(max_in_flight) == 4
+
+    _, entry = [entry for entry in logged_entries(mock_log)
+                if entry[1]['event'] == 'create_directories'][0]
+    assert entry['folders'] == 7
+    assert entry['levels'] == 3
+    # three round trips rather than seven
+    assert entry['secs'] < entry['serial_secs']
+    assert entry['serial_secs'] >= 0.35
+
+def test_create_directories_half_made():
+    """ the folders of a tree left half made are kept and only the rest are created """
+    created = {}
+    def create(**kwargs):
+        created[kwargs['json']['Name']] = kwargs['json']['ParentFolderId']
+        response = fake_response(200)
+        response.json.return_value = {'Id': 100 + len(created)}
+        return response
+
+    folder_index = {'CCSF EPR': 1, 'A.PERMIT SUBMITTAL': 2, '1.PERMIT FORMS': 3}
+    with patch('service.resources.bluebeam.http_session.request', side_effect=create):
+        upload_dir_id = bluebeam.create_directories(
+            {'access_token': 'secret'},
+            '123-456-789',
+            bluebeam.DIRECTORY_STRUCTURE,
+            folder_index=folder_index
+        )
+
+    assert created == {
+        'B.APPROVED DOCUMENTS': 1,
+        '2.ROUTING FORMS': 2,
+        bluebeam.UPLOAD_DIR_NAME: 2,
+        '1.BUILDING PERMIT DOCUMENTS': folder_index['B.APPROVED DOCUMENTS']
+    }
+    assert upload_dir_id == folder_index[bluebeam.UPLOAD_DIR_NAME]
+    assert len(folder_index) == 7
+
+    # nothing left to create
+    with patch('service.resources.bluebeam.http_session.request') as mock_request:
+        assert bluebeam.create_directories(
+            {'access_token': 'secret'},
+            '123-456-789',
+            bluebeam.DIRECTORY_STRUCTURE,
+            folder_index=folder_index
+        ) == upload_dir_id
+    mock_request.assert_not_called()
+
+def test_create_directories_error():
+    """ a folder that can't be created fails the tree once its level has finished """
+    def create(**kwargs):
+        if kwargs['json']['Name'] == '2.ROUTING FORMS':
+            return fake_response(400)
+        response = fake_response(200)
+        response.json.return_value = mocks.CREATE_FOLDER_RESPONSE
+        return response
+
+    with patch('service.resources.bluebeam.http_session.request') as mock_request:
+        mock_request.side_effect = create
+        with pytest.raises(requests.exceptions.HTTPError):
+            bluebeam.create_directories(
+                {'access_token': 'secret'},
+                '123-456-789',
+                bluebeam.DIRECTORY_STRUCTURE
+            )
+    assert mock_request.call_count == 7
+
+def test_download_cache(tmp_path):
+    """ files are cached by url and only reused when the server has the same version """
+    cache = DownloadCache(str(tmp_path / 'cache'), 1024)
+    url = 'https://bucketeer.com/plans.pdf'
+    source = tmp_path / 'plans.pdf'
+    source.write_bytes(b'%PDF plans')
+    assert not cache.validators(url)
+    assert not cache.checkout(url, str(tmp_path / 'checked-out.pdf'))
+
+    cache.add(url, {'ETag': '"v1"'}, str(source))
+    assert cache.validators(url) == {'If-None-Match': '"v1"'}
+    assert cache.checkout(url, str(tmp_path / 'checked-out.pdf'))
+    assert (tmp_path / 'checked-out.pdf').read_bytes() == b'%PDF plans'
+
+    # the same content from another url is stored once
+    cache.add('https://www.w3.org/plans.pdf', {'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT'},
+              str(source))
+    assert cache.validators('https://www.w3.org/plans.pdf') == \
+        {'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT'}
+    assert len(os.listdir(tmp_path / 'cache' / 'blobs')) == 1
+
+    # without a validator the file can't be checked later so it isn't kept
+    cache.add('https://files.test.com/plans.pdf', {}, str(source))
+    assert not cache.validators('https://files.test.com/plans.pdf')
+    assert cache.get_metrics() == {'hits': 1, 'misses': 3, 'evictions': 0}
+
+def blob_of(cache, url):
+    """ path of the cached file of url """
+    return cache.blob_path(cache.get_entry(url)['sha256'])
+
+def test_download_cache_eviction(tmp_path):
+    """ the least recently used files go once the cache is over its size """
+    cache = DownloadCache(str(tmp_path / 'cache'), 25)
+    for i in range(3):
+        source = tmp_path / 'sheet{0}.pdf'.format(i)
+        source.write_bytes('%PDF sheet{0}'.format(i).encode())
+        cache.add('https://files.test.com/sheet{0}.pdf'.format(i), {'ETag': str(i)}, str(source))
+        if i == 1:
+            # sheet0 is used after sheet1 was added
+            os.utime(blob_of(cache, 'https://files.test.com/sheet1.pdf'), (1, 1))
+            os.utime(blob_of(cache, 'https://files.test.com/sheet0.pdf'), (2, 2))
+
+    assert not cache.validators('https://files.test.com/sheet1.pdf')
+    assert not os.path.exists(cache.entry_path('https://files.test.com/sheet1.pdf'))
+    assert cache.validators('https://files.test.com/sheet0.pdf') == {'If-None-Match': '0'}
+    assert cache.validators('https://files.test.com/sheet2.pdf') == {'If-None-Match': '2'}
+    assert cache.get_metrics()['evictions'] == 1
+
+    # gone between the request and the checkout
+    os.remove(blob_of(cache, 'https://files.test.com/sheet0.pdf'))
+    assert not cache.checkout('https://files.test.com/sheet0.pdf', str(tmp_path / 'out.pdf'))
+
+    # too large for the cache
+    source = tmp_path / 'large.pdf'
+    source.write_bytes(b'0' * 26)
+    cache.add('https://files.test.com/large.pdf', {'ETag': 'large'}, str(source))
+    assert not cache.validators('https://files.test.com/large.pdf')
+
+def test_download_cache_errors(tmp_path):
+    """ a broken cache is a miss rather than a failed download """
+    source = tmp_path / 'plans.pdf'
+    source.write_bytes(b'%PDF plans')
+    (tmp_path / 'not-a-dir').write_bytes(b'')
+    cache = DownloadCache(str(tmp_path / 'not-a-dir'), 1024)
+    cache.add('https://files.test.com/plans.pdf', {'ETag': 'v1'}, str(source))
+    assert not cache.validators('https://files.test.com/plans.pdf')
+
+    cache = DownloadCache(str(tmp_path / 'cache'), 1024)
+    os.makedirs(os.path.dirname(cache.entry_path('https://files.test.com/plans.pdf')))
+    with open(cache.entry_path('https://files.test.com/plans.pdf'), 'w') as entry_file:
+        entry_file.write('{')
+    assert not cache.validators('https://files.test.com/plans.pdf')
+
+    # across file systems files are copied
+    with patch('service.resources.download_cache.os.link', side_effect=OSError()):
+        cache.add('https://files.test.com/plans.pdf', {'ETag': 'v1'}, str(source))
+        assert cache.checkout('https://files.test.com/plans.pdf', str(tmp_path / 'out.pdf'))
+    assert (tmp_path / 'out.pdf').read_bytes() == b'%PDF plans'
+
+    # turned off
+    cache = DownloadCache(str(tmp_path / 'cache'), 0)
+    assert not cache.validators('https://files.test.com/plans.pdf')
+    assert create_download_cache().cache_dir == download_cache.DOWNLOAD_CACHE_DIR
+    # removed by another worker already
+    download_cache.remove_file(str(tmp_path / 'gone.pdf'))
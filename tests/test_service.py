@@ -181,60 +181,100 @@ def test_long_error_message():
     db.commit()
     assert len(submission.error_message) == 255
 
+def fake_permission_requests(failing):
+    """
+        bluebeam requests of assign_user_permissions,
+        the calls to the urls in failing return their status
+    """
+    def fake_request(method, url, **kwargs):
+        response = Mock()
+        response.status_code = 204
+        if method == 'post':
+            url += '#' + kwargs['json']['Email']
+        if method == 'get':
+            response.status_code = 200
+            response.json.return_value = mocks.GET_PROJECT_USERS_RESPONSE
+        if url in failing:
+            response.status_code = failing[url]
+            response.ok = False
+            response.raise_for_status.side_effect = requests.exceptions.HTTPError(failing[url])
+        return response
+    return fake_request
+
 def test_bluebeam_set_permission_error():
     """
         test handling of error when setting user
         permission in bluebeam
     """
     users = db.query(UserModel).all()
-    with patch('service.resources.bluebeam.requests.request') as mock_reqs:
-        fake_responses = []
-        # add user1
-        fake_responses.append(Mock())
-        fake_responses[0].status_code = 204
-        # add user2
-        fake_responses.append(Mock())
-        fake_responses[1].status_code = 204
-        # get project users
-        fake_responses.append(Mock())
-        fake_responses[2].json.return_value = mocks.GET_PROJECT_USERS_RESPONSE
-        # set access user1
-        fake_responses.append(Mock())
-        fake_responses[3].status_code = 500
-        fake_responses[3].raise_for_status.side_effect = requests.exceptions.HTTPError
-        # set access user2
-        fake_responses.append(Mock())
-        fake_responses[4].status_code = 204
-
-        mock_reqs.side_effect = fake_responses
-
-        bluebeam.assign_user_permissions(test_utils.BLUEBEAM_ACCESS_TOKEN, '123-456-789', users)
+    with patch('service.resources.bluebeam.http_session.request') as mock_reqs:
+        mock_reqs.side_effect = fake_permission_requests({
+            bluebeam.BLUEBEAM_API_BASE_URL + '/projects/123-456-789/users/984539/permissions': 403
+        })
+        report = bluebeam.assign_user_permissions(
+            test_utils.BLUEBEAM_ACCESS_TOKEN,
+            '123-456-789',
+            users
+        )
+
+    assert report == [
+        {'email': 'user1@test.com', 'added': True, 'full_access': False, 'error': '403'},
+        {'email': 'user2@test.com', 'added': True, 'full_access': True, 'error': None}
+    ]
+    # one roster fetch for every user
+    assert [call[1]['method'] for call in mock_reqs.call_args_list].count('get') == 1
 
 def test_user_does_not_exist_permission_error():
     """
         test handling of error when adding user to a project
     """
     users = db.query(UserModel).all()
-    with patch('service.resources.bluebeam.requests.request') as mock_req:
-        fake_responses = []
-        # add user1
-        fake_responses.append(Mock())
-        fake_responses[0].status_code = 404
-        fake_responses[0].json.return_value = mocks.USER_DOES_NOT_EXIST_RESPONSE
-        fake_responses[0].raise_for_status.side_effect = requests.exceptions.HTTPError
-        # add user2
-        fake_responses.append(Mock())
-        fake_responses[1].status_code = 404
-        fake_responses[1].json.return_value = mocks.USER_DOES_NOT_EXIST_RESPONSE
-        fake_responses[1].raise_for_status.side_effect = requests.exceptions.HTTPError
-        # get project users
-        fake_responses.append(Mock())
-        fake_responses[2].json.return_value = mocks.GET_PROJECT_USERS_RESPONSE
-
-        mock_req.side_effect = fake_responses
-
-        bluebeam.assign_user_permissions(test_utils.BLUEBEAM_ACCESS_TOKEN, '123-456-789', users)
-
+    with patch('service.resources.bluebeam.http_session.request') as mock_req:
+        mock_req.side_effect = fake_permission_requests({
+            bluebeam.BLUEBEAM_API_BASE_URL + '/projects/123-456-789/users#user1@test.com': 404,
+            bluebeam.BLUEBEAM_API_BASE_URL + '/projects/123-456-789/users#user2@test.com': 404
+        })
+        report = bluebeam.assign_user_permissions(
+            test_utils.BLUEBEAM_ACCESS_TOKEN,
+            '123-456-789',
+            users
+        )
+
+    assert report == [
+        {'email': 'user1@test.com', 'added': False, 'full_access': False, 'error': '404'},
+        {'email': 'user2@test.com', 'added': False, 'full_access': False, 'error': '404'}
+    ]
+    assert [call[1]['method'] for call in mock_req.call_args_list] == ['post', 'post', 'get']
+
+def test_assign_user_permissions_once_per_email():
+    """
+        repeated emails are assigned once, users missing from the project are reported
+    """
+    users = [
+        UserModel(email='user1@test.com'),
+        UserModel(email='USER1@test.com'),
+        UserModel(email=None),
+        UserModel(email='user3@test.com')
+    ]
+    with patch('service.resources.bluebeam.http_session.request') as mock_req:
+        mock_req.side_effect = fake_permission_requests({})
+        report = bluebeam.assign_user_permissions(
+            test_utils.BLUEBEAM_ACCESS_TOKEN,
+            '123-456-789',
+            users
+        )
+
+    assert report == [
+        {'email': 'user1@test.com', 'added': True, 'full_access': True, 'error': None},
+        {
+            'email': 'user3@test.com',
+            'added': True,
+            'full_access': False,
+            'error': bluebeam.ERR_NOT_A_PROJECT_USER
+        }
+    ]
+    assert sorted(call[1]['method'] for call in mock_req.call_args_list) == \
+        ['get', 'post', 'post', 'put']
 
 def test_export(mock_env_access_key, client):
     # pylint: disable=unused-argument
@@ -250,7 +290,7 @@ def test_export(mock_env_access_key, client):
     assert response.status_code == 303
 
     # Redirect back from authserver with invalid grant
-    with patch('service.resources.bluebeam.requests.request') as mock_auth_post:
+    with patch('service.resources.bluebeam.http_session.request') as mock_auth_post:
         mock_auth_post.return_value.json.return_value = mocks.INVALID_GRANT_RESPONSE
 
         response = client.simulate_get('/export?code=super-secrete-code')
@@ -258,7 +298,7 @@ def test_export(mock_env_access_key, client):
         assert 'Login Error' in response.text
 
     # Error when scheduling with celery
-    # with patch('service.resources.bluebeam.requests.request') as mock_auth_post:
+    # with patch('service.resources.bluebeam.http_session.request') as mock_auth_post:
     #     mock_auth_post.return_value.json.return_value = mocks.ACCESS_TOKEN_RESPONSE
 
     #     with patch('tasks.bluebeam_export.apply_async') as mock_schedule:
@@ -274,7 +314,7 @@ def test_export(mock_env_access_key, client):
     #         assert exports_in_progress.count() == 0
 
     # Redirect back from authserver with valid code
-    with patch('service.resources.bluebeam.requests.request') as mock_auth_post:
+    with patch('service.resources.bluebeam.http_session.request') as mock_auth_post:
         mock_auth_post.return_value.json.return_value = mocks.ACCESS_TOKEN_RESPONSE
 
         response = client.simulate_get('/export?code=super-secret-code')
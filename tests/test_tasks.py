@@ -1,16 +1,34 @@
 """ tests for tasks """
 #pylint: disable=too-many-statements,line-too-long,too-many-lines
 import os
+import json
 import datetime
-import copy
+import tracemalloc
+import threading
+import time
+import zipfile
+import tempfile
+from io import BytesIO
+from types import SimpleNamespace
+from urllib.parse import urlparse
 from unittest.mock import patch, Mock
 import pytest
+import requests
 import tests.mocks as mocks
 import tests.utils as test_utils
 import service.resources.bluebeam as bluebeam
-from service.resources.models import create_export, create_submission, SubmissionModel
+import service.resources.bluebeam_log as bluebeam_log
+from service.resources.models import create_export, create_submission, save_checkpoint,\
+    get_poll_cursor, SubmissionModel, UploadedFileModel
 from service.resources.db import create_session
-from tasks import celery_app as queue, bluebeam_export, scheduler
+from service.resources.download_cache import DownloadCache
+from service.resources.submission_files import save_response, get_passthrough_length,\
+    check_zip_limits, ERR_DOWNLOAD_TOO_LARGE, ERR_ZIP_TOO_MANY_FILES, ERR_ZIP_TOO_LARGE,\
+    ERR_ZIP_RATIO
+from tasks import celery_app as queue, bluebeam_export, scheduler, upload_files,\
+    finish_export, export_to_bluebeam, upload_zip, upload_once, start_export, run_export,\
+    assign_permissions, defer_permissions, APPLICATIONS_CURSOR, PERMISSIONS_PENDING,\
+    PERMISSIONS_DONE, PERMISSIONS_FAILED, ERR_INVALID_PROJECT_ID, ERR_UPLOAD_FAIL
 
 session = create_session() # pylint: disable=invalid-name
 db = session() # pylint: disable=invalid-name
@@ -43,7 +61,7 @@ def test_export_task_new_project(mock_env_access_key):
     create_submission(db, data, export_obj.guid)
 
     # mock all responses for expected requests
-    with patch('service.resources.bluebeam.requests.request') as mock_post:
+    with patch('service.resources.bluebeam.http_session.request') as mock_post:
         fake_post_responses = []
         # refresh token
         fake_post_responses.append(Mock())
@@ -59,9 +77,6 @@ def test_export_task_new_project(mock_env_access_key):
             fake_post_responses.append(Mock())
             fake_post_responses[i].json.return_value = mocks.CREATE_FOLDER_RESPONSE
             i += 1
-        # get folders
-        fake_post_responses.append(Mock())
-        fake_post_responses[len(fake_post_responses)-1].json.return_value = mocks.GET_FOLDERS_RESPONSE
         # create folders
         fake_post_responses.append(Mock())
         fake_post_responses[len(fake_post_responses)-1].json.return_value = mocks.CREATE_FOLDER_RESPONSE
@@ -130,7 +145,7 @@ def test_export_task_new_project_no_files(mock_env_access_key):
     )
 
     # mock all responses for expected requests
-    with patch('service.resources.bluebeam.requests.request') as mock_post:
+    with patch('service.resources.bluebeam.http_session.request') as mock_post:
         fake_post_responses = []
         # create project
         fake_post_responses.append(Mock())
@@ -142,21 +157,6 @@ def test_export_task_new_project_no_files(mock_env_access_key):
             fake_post_responses.append(Mock())
             fake_post_responses[i].json.return_value = mocks.CREATE_FOLDER_RESPONSE
             i += 1
-        # get folders
-        fake_post_responses.append(Mock())
-        fake_post_responses[len(fake_post_responses)-1].json.return_value = mocks.GET_FOLDERS_RESPONSE
-        # create folders
-        fake_post_responses.append(Mock())
-        fake_post_responses[len(fake_post_responses)-1].json.return_value = mocks.CREATE_FOLDER_RESPONSE
-        # initiate upload
-        fake_post_responses.append(Mock())
-        fake_post_responses[len(fake_post_responses)-1].json.return_value = mocks.INIT_FILE_UPLOAD_RESPONSE
-        # upload
-        fake_post_responses.append(Mock())
-        fake_post_responses[len(fake_post_responses)-1].return_value.status_code = 200
-        # confirm upload
-        fake_post_responses.append(Mock())
-        fake_post_responses[len(fake_post_responses)-1].status_code = 204
         # add user1
         fake_post_responses.append(Mock())
         fake_post_responses[len(fake_post_responses)-1].status_code = 204
@@ -202,7 +202,7 @@ def test_export_task_new_project_bucketeer(mock_env_access_key):
     # create a submission so there's something to export
     create_submission(db, mocks.BUCKETEER_SUBMISSION_POST_DATA, export_obj.guid)
     # mock all responses for expected requests
-    with patch('service.resources.bluebeam.requests.request') as mock_post:
+    with patch('service.resources.bluebeam.http_session.request') as mock_post:
         fake_post_responses = []
         # create project
         fake_post_responses.append(Mock())
@@ -214,9 +214,6 @@ def test_export_task_new_project_bucketeer(mock_env_access_key):
             fake_post_responses.append(Mock())
             fake_post_responses[i].json.return_value = mocks.CREATE_FOLDER_RESPONSE
             i += 1
-        # get folders
-        fake_post_responses.append(Mock())
-        fake_post_responses[len(fake_post_responses)-1].json.return_value = mocks.GET_FOLDERS_RESPONSE
         # create folders
         fake_post_responses.append(Mock())
         fake_post_responses[len(fake_post_responses)-1].json.return_value = mocks.CREATE_FOLDER_RESPONSE
@@ -249,7 +246,8 @@ def test_export_task_new_project_bucketeer(mock_env_access_key):
 
         with patch('tasks.requests.get') as mock_get:
             with open(TEST_PDF, 'rb') as f: # pylint: disable=invalid-name
-                mock_get.return_value.content = f.read()
+                mock_get.return_value.headers = {}
+                mock_get.return_value.iter_content.return_value = [f.read()]
 
                 #patch the logger request
                 with patch('tasks.requests.patch') as mock_patch:
@@ -280,7 +278,7 @@ def test_export_task_new_project_with_permit_number(mock_env_access_key):
     export_obj = create_export(db)
     create_submission(db, submission_data_with_permit, export_obj.guid)
     # mock all responses for expected requests
-    with patch('service.resources.bluebeam.requests.request') as mock_post:
+    with patch('service.resources.bluebeam.http_session.request') as mock_post:
         fake_post_responses = []
         # create project
         fake_post_responses.append(Mock())
@@ -292,9 +290,6 @@ def test_export_task_new_project_with_permit_number(mock_env_access_key):
             fake_post_responses.append(Mock())
             fake_post_responses[i].json.return_value = mocks.CREATE_FOLDER_RESPONSE
             i += 1
-        # get folders
-        fake_post_responses.append(Mock())
-        fake_post_responses[len(fake_post_responses)-1].json.return_value = mocks.GET_FOLDERS_RESPONSE
         # create folders
         fake_post_responses.append(Mock())
         fake_post_responses[len(fake_post_responses)-1].json.return_value = mocks.CREATE_FOLDER_RESPONSE
@@ -352,7 +347,7 @@ def test_export_task_new_project_zip(mock_env_access_key):
     # create a submission so there's something to export
     create_submission(db, mocks.SUBMISSION_POST_DATA_ZIP, export_obj.guid)
     # mock all responses for expected requests
-    with patch('service.resources.bluebeam.requests.request') as mock_post:
+    with patch('service.resources.bluebeam.http_session.request') as mock_post:
         fake_post_responses = []
         # create project
         fake_post_responses.append(Mock())
@@ -364,9 +359,6 @@ def test_export_task_new_project_zip(mock_env_access_key):
             fake_post_responses.append(Mock())
             fake_post_responses[i].json.return_value = mocks.CREATE_FOLDER_RESPONSE
             i += 1
-        # get folders
-        fake_post_responses.append(Mock())
-        fake_post_responses[len(fake_post_responses)-1].json.return_value = mocks.GET_FOLDERS_RESPONSE
         # create folders
         fake_post_responses.append(Mock())
         fake_post_responses[len(fake_post_responses)-1].json.return_value = mocks.CREATE_FOLDER_RESPONSE
@@ -379,19 +371,6 @@ def test_export_task_new_project_zip(mock_env_access_key):
         # confirm upload
         fake_post_responses.append(Mock())
         fake_post_responses[len(fake_post_responses)-1].status_code = 204
-        # get folders 2
-        # this mock is modified to contain today's upload folder
-        fake_post_responses.append(Mock())
-        get_folders_updated = copy.deepcopy(mocks.GET_FOLDERS_RESPONSE)
-        get_folders_updated['ProjectFolders'].append(
-            {
-                '$id': '8',
-                'Id': '1234567',
-                'Name': bluebeam.SUBMITTAL_DIR_NAME + " " + str(datetime.date.today()),
-                'Path': '/path/somewhere'
-            }
-        )
-        fake_post_responses[len(fake_post_responses)-1].json.return_value = get_folders_updated
         # initiate upload 2
         fake_post_responses.append(Mock())
         fake_post_responses[len(fake_post_responses)-1].json.return_value = mocks.INIT_FILE_UPLOAD_RESPONSE
@@ -421,7 +400,8 @@ def test_export_task_new_project_zip(mock_env_access_key):
 
         with patch('tasks.requests.get') as mock_get:
             with open(ZIP_FILE, 'rb') as f: # pylint: disable=invalid-name
-                mock_get.return_value.content = f.read()
+                mock_get.return_value.headers = {}
+                mock_get.return_value.iter_content.return_value = [f.read()]
 
                 #patch the logger request
                 with patch('tasks.requests.patch') as mock_patch:
@@ -437,9 +417,52 @@ def test_export_task_new_project_zip(mock_env_access_key):
         assert len(export_obj.result['success']) > 0
         assert len(export_obj.result['failure']) == 0
 
+        # folders are looked up from the index built while creating them
+        folder_requests = [
+            call for call in mock_post.call_args_list
+            if call[1]['url'].endswith('/folders')
+        ]
+        assert [call[1]['method'] for call in folder_requests] == ['post'] * 8
+
     # clear out the queue
     queue.control.purge()
 
+def test_export_task_new_project_zip_limits(mock_env_access_key):
+    # pylint: disable=unused-argument
+    """ a zip over the zip limits fails a new project's export before the project is created """
+    test_utils.finish_submissions_exports()
+    bluebeam.save_auth_token(db, test_utils.BLUEBEAM_ACCESS_TOKEN)
+    with open(ZIP_FILE, 'rb') as f: # pylint: disable=invalid-name
+        zipped = f.read()
+
+    export_obj = create_export(db)
+    create_submission(db, mocks.SUBMISSION_POST_DATA_ZIP, export_obj.guid)
+    with patch('service.resources.submission_files.MAX_ZIP_UNCOMPRESSED_BYTES', 20),\
+        patch('service.resources.bluebeam.http_session.request') as mock_reqs,\
+        patch('tasks.requests.get') as mock_get,\
+        patch('tasks.requests.patch'):
+        mock_get.return_value.headers = {}
+        mock_get.return_value.iter_content.return_value = [zipped]
+        bluebeam_export.s(export_id=export_obj.guid).apply()
+    db.refresh(export_obj)
+    assert export_obj.result['failure'][0]['err'] == ERR_ZIP_TOO_LARGE
+    mock_reqs.assert_not_called()
+
+    export_obj = create_export(db)
+    create_submission(db, mocks.SUBMISSION_POST_DATA_ZIP, export_obj.guid)
+    fake = FakeBluebeam()
+    with patch('service.resources.submission_files.MAX_ZIP_UNCOMPRESSED_BYTES', 20):
+        export_async(export_obj, fake)
+    assert export_obj.result['failure'][0]['err'] == ERR_ZIP_TOO_LARGE
+    assert fake.events == ['download']
+
+    # within the limits, the zip is uploaded from where it was checked
+    fake = FakeBluebeam()
+    export_async(export_obj, fake)
+    assert len(export_obj.result['success']) == 1
+    assert fake.events.count('download') == 1
+    assert fake.events.index('download') < fake.events.index('project')
+
 def test_export_task_new_project_zip_upload_err(mock_env_access_key):
     # pylint: disable=unused-argument
     """
@@ -453,7 +476,7 @@ def test_export_task_new_project_zip_upload_err(mock_env_access_key):
     # create a submission so there's something to export
     create_submission(db, mocks.SUBMISSION_POST_DATA_ZIP, export_obj.guid)
     # mock all responses for expected requests
-    with patch('service.resources.bluebeam.requests.request') as mock_post:
+    with patch('service.resources.bluebeam.http_session.request') as mock_post:
         fake_post_responses = []
         # create project
         fake_post_responses.append(Mock())
@@ -465,9 +488,6 @@ def test_export_task_new_project_zip_upload_err(mock_env_access_key):
             fake_post_responses.append(Mock())
             fake_post_responses[i].json.return_value = mocks.CREATE_FOLDER_RESPONSE
             i += 1
-        # get folders
-        fake_post_responses.append(Mock())
-        fake_post_responses[len(fake_post_responses)-1].json.return_value = mocks.GET_FOLDERS_RESPONSE
         # create folders
         fake_post_responses.append(Mock())
         fake_post_responses[len(fake_post_responses)-1].json.return_value = mocks.CREATE_FOLDER_RESPONSE
@@ -480,19 +500,6 @@ def test_export_task_new_project_zip_upload_err(mock_env_access_key):
         # confirm upload
         fake_post_responses.append(Mock())
         fake_post_responses[len(fake_post_responses)-1].status_code = 204
-        # get folders 2
-        # this mock is modified to contain today's upload folder
-        fake_post_responses.append(Mock())
-        get_folders_updated = copy.deepcopy(mocks.GET_FOLDERS_RESPONSE)
-        get_folders_updated['ProjectFolders'].append(
-            {
-                '$id': '8',
-                'Id': '1234567',
-                'Name': bluebeam.SUBMITTAL_DIR_NAME + " " + str(datetime.date.today()),
-                'Path': '/path/somewhere'
-            }
-        )
-        fake_post_responses[len(fake_post_responses)-1].json.return_value = get_folders_updated
         # initiate upload 2
         fake_post_responses.append(Mock())
         fake_post_responses[len(fake_post_responses)-1].json.return_value = mocks.INIT_FILE_UPLOAD_RESPONSE
@@ -510,7 +517,8 @@ def test_export_task_new_project_zip_upload_err(mock_env_access_key):
 
         with patch('tasks.requests.get') as mock_get:
             with open(ZIP_FILE, 'rb') as f: # pylint: disable=invalid-name
-                mock_get.return_value.content = f.read()
+                mock_get.return_value.headers = {}
+                mock_get.return_value.iter_content.return_value = [f.read()]
 
                 #patch the logger request
                 with patch('tasks.requests.patch') as mock_patch:
@@ -543,7 +551,7 @@ def test_export_task_delete_project_err(mock_env_access_key):
     # create a submission so there's something to export
     create_submission(db, mocks.SUBMISSION_POST_DATA_ZIP, export_obj.guid)
     # mock all responses for expected requests
-    with patch('service.resources.bluebeam.requests.request') as mock_post:
+    with patch('service.resources.bluebeam.http_session.request') as mock_post:
         fake_post_responses = []
         # create project
         fake_post_responses.append(Mock())
@@ -563,8 +571,12 @@ def test_export_task_delete_project_err(mock_env_access_key):
         mock_post.side_effect = fake_post_responses
 
         #patch the logger request
-        with patch('tasks.requests.patch') as mock_patch:
+        with patch('tasks.requests.patch') as mock_patch,\
+            patch('tasks.requests.get') as mock_get:
             mock_patch.status_code = 200
+            with open(ZIP_FILE, 'rb') as f: # pylint: disable=invalid-name
+                mock_get.return_value.headers = {}
+                mock_get.return_value.iter_content.return_value = [f.read()]
 
             bluebeam_export.s(
                 export_id=export_obj.guid
@@ -575,6 +587,7 @@ def test_export_task_delete_project_err(mock_env_access_key):
         assert export_obj.date_finished is not None
         assert len(export_obj.result['success']) == 0
         assert len(export_obj.result['failure']) > 0
+        assert mock_post.call_count == 3
 
     # clear out the queue
     queue.control.purge()
@@ -593,7 +606,7 @@ def test_export_task_resubmission(mock_env_access_key):
     create_submission(db, data, export_obj.guid)
 
     # mock all responses for expected requests
-    with patch('service.resources.bluebeam.requests.request') as mock_reqs:
+    with patch('service.resources.bluebeam.http_session.request') as mock_reqs:
         fake_responses = []
         # project exists
         fake_responses.append(Mock())
@@ -601,36 +614,33 @@ def test_export_task_resubmission(mock_env_access_key):
         # get folders
         fake_responses.append(Mock())
         fake_responses[1].json.return_value = mocks.GET_FOLDERS_RESPONSE
-        # get folders
-        fake_responses.append(Mock())
-        fake_responses[2].json.return_value = mocks.GET_FOLDERS_RESPONSE
         # create folders
         fake_responses.append(Mock())
-        fake_responses[3].json.return_value = mocks.CREATE_FOLDER_RESPONSE
+        fake_responses[2].json.return_value = mocks.CREATE_FOLDER_RESPONSE
         # initiate upload
         fake_responses.append(Mock())
-        fake_responses[4].json.return_value = mocks.INIT_FILE_UPLOAD_RESPONSE
+        fake_responses[3].json.return_value = mocks.INIT_FILE_UPLOAD_RESPONSE
         # upload
         fake_responses.append(Mock())
-        fake_responses[5].return_value.status_code = 200
+        fake_responses[4].return_value.status_code = 200
         # confirm upload
         fake_responses.append(Mock())
-        fake_responses[6].status_code = 204
+        fake_responses[5].status_code = 204
         # add user1
         fake_responses.append(Mock())
-        fake_responses[7].status_code = 204
+        fake_responses[6].status_code = 204
         # add user2
         fake_responses.append(Mock())
-        fake_responses[8].status_code = 204
+        fake_responses[7].status_code = 204
         # get project users
         fake_responses.append(Mock())
-        fake_responses[9].json.return_value = mocks.GET_PROJECT_USERS_RESPONSE
+        fake_responses[8].json.return_value = mocks.GET_PROJECT_USERS_RESPONSE
         # set access user1
         fake_responses.append(Mock())
-        fake_responses[10].status_code = 204
+        fake_responses[9].status_code = 204
         # set access user2
         fake_responses.append(Mock())
-        fake_responses[11].status_code = 204
+        fake_responses[10].status_code = 204
 
         mock_reqs.side_effect = fake_responses
 
@@ -666,7 +676,7 @@ def test_export_task_resubmission_log_status_error(mock_env_access_key):
     create_submission(db, data, export_obj.guid)
 
     # mock all responses for expected requests
-    with patch('service.resources.bluebeam.requests.request') as mock_reqs:
+    with patch('service.resources.bluebeam.http_session.request') as mock_reqs:
         fake_responses = []
         # project exists
         fake_responses.append(Mock())
@@ -674,21 +684,18 @@ def test_export_task_resubmission_log_status_error(mock_env_access_key):
         # get folders
         fake_responses.append(Mock())
         fake_responses[1].json.return_value = mocks.GET_FOLDERS_RESPONSE
-        # get folders
-        fake_responses.append(Mock())
-        fake_responses[2].json.return_value = mocks.GET_FOLDERS_RESPONSE
         # create folders
         fake_responses.append(Mock())
-        fake_responses[3].json.return_value = mocks.CREATE_FOLDER_RESPONSE
+        fake_responses[2].json.return_value = mocks.CREATE_FOLDER_RESPONSE
         # initiate upload
         fake_responses.append(Mock())
-        fake_responses[4].json.return_value = mocks.INIT_FILE_UPLOAD_RESPONSE
+        fake_responses[3].json.return_value = mocks.INIT_FILE_UPLOAD_RESPONSE
         # upload
         fake_responses.append(Mock())
-        fake_responses[5].return_value.status_code = 200
+        fake_responses[4].return_value.status_code = 200
         # confirm upload
         fake_responses.append(Mock())
-        fake_responses[6].status_code = 204
+        fake_responses[5].status_code = 204
 
         mock_reqs.side_effect = fake_responses
 
@@ -719,7 +726,7 @@ def test_export_task_resubmission_no_upload_dir(mock_env_access_key):
     # create a resubmission so there's something to export
     create_submission(db, mocks.RESUBMISSION_POST_DATA, export_obj.guid)
     # mock all responses for expected requests
-    with patch('service.resources.bluebeam.requests.request') as mock_reqs:
+    with patch('service.resources.bluebeam.http_session.request') as mock_reqs:
         fake_responses = []
         # project exists
         fake_responses.append(Mock())
@@ -757,7 +764,7 @@ def test_export_task_resubmission_no_project(mock_env_access_key):
     # create a resubmission so there's something to export
     create_submission(db, mocks.RESUBMISSION_POST_DATA, export_obj.guid)
     # mock all responses for expected requests
-    with patch('service.resources.bluebeam.requests.request') as mock_reqs:
+    with patch('service.resources.bluebeam.http_session.request') as mock_reqs:
         fake_responses = []
         # project exists
         fake_responses.append(Mock())
@@ -794,7 +801,7 @@ def test_export_task_file_upload_error(mock_env_access_key):
     export_obj = create_export(db)
     create_submission(db, data, export_obj.guid)
     # mock all responses for expected outbound requests
-    with patch('service.resources.bluebeam.requests.request') as mock_post:
+    with patch('service.resources.bluebeam.http_session.request') as mock_post:
         fake_post_responses = []
         # create project
         fake_post_responses.append(Mock())
@@ -806,9 +813,6 @@ def test_export_task_file_upload_error(mock_env_access_key):
             fake_post_responses.append(Mock())
             fake_post_responses[i].json.return_value = mocks.CREATE_FOLDER_RESPONSE
             i += 1
-        # get folders
-        fake_post_responses.append(Mock())
-        fake_post_responses[len(fake_post_responses)-1].json.return_value = mocks.GET_FOLDERS_RESPONSE
         # create folders
         fake_post_responses.append(Mock())
         fake_post_responses[len(fake_post_responses)-1].json.return_value = mocks.CREATE_FOLDER_RESPONSE
@@ -851,7 +855,7 @@ def test_export_task_no_upload_folder(mock_env_access_key):
     # create a submission so there's something to export
     create_submission(db, mocks.SUBMISSION_POST_DATA, export_obj.guid)
     # mock all responses for expected outbound requests
-    with patch('service.resources.bluebeam.requests.request') as mock_post:
+    with patch('service.resources.bluebeam.http_session.request') as mock_post:
         fake_post_responses = []
         # create project
         fake_post_responses.append(Mock())
@@ -899,7 +903,7 @@ def test_scheduler(mock_env_access_key):
         mock_permits_query.return_value.status_code = 200
 
         # mock all bluebeam export requests
-        with patch('service.resources.bluebeam.requests.request') as mock_post:
+        with patch('service.resources.bluebeam.http_session.request') as mock_post:
             fake_post_responses = []
             # create project
             fake_post_responses.append(Mock())
@@ -911,9 +915,6 @@ def test_scheduler(mock_env_access_key):
                 fake_post_responses.append(Mock())
                 fake_post_responses[i].json.return_value = mocks.CREATE_FOLDER_RESPONSE
                 i += 1
-            # get folders
-            fake_post_responses.append(Mock())
-            fake_post_responses[len(fake_post_responses)-1].json.return_value = mocks.GET_FOLDERS_RESPONSE
             # create folders
             fake_post_responses.append(Mock())
             fake_post_responses[len(fake_post_responses)-1].json.return_value = mocks.CREATE_FOLDER_RESPONSE
@@ -973,6 +974,161 @@ def test_scheduler_error(mock_env_access_key):
 
     assert new_submissions_count == existing_submissions_count
 
+def test_scheduler_batch(mock_env_access_key):
+    # pylint: disable=unused-argument
+    """ Test the scheduler saving a run's applications as one export """
+    print("begin test_scheduler_batch")
+    invalid = {'_id': 'invalid', 'data': {}, 'files': [{'url': 'not a url'}]}
+    queued = mocks.BUILDING_PERMITS_EXPORT_QUERY + [invalid]
+    existing_submissions_count = db.query(SubmissionModel.id).count()
+
+    with patch('tasks.requests.get') as mock_permits_query,\
+            patch('tasks.utils.get_files', side_effect=lambda submission: submission.get('files', [])),\
+            patch('tasks.log_status') as mock_log_status,\
+            patch('tasks.bluebeam_export.apply_async') as mock_export,\
+            patch('tasks.SCHEDULER_EXPORT_SIZE', 0):
+        mock_permits_query.return_value.json.return_value = queued
+        scheduler.s().apply()
+
+    # the invalid application is left queued
+    assert sorted(call.args[1] for call in mock_log_status.call_args_list) ==\
+        sorted(submission['_id'] for submission in mocks.BUILDING_PERMITS_EXPORT_QUERY)
+    assert mock_export.call_count == 1
+    export_id = mock_export.call_args.kwargs['args'][0]
+    assert db.query(SubmissionModel).filter(SubmissionModel.export_status_guid == export_id).count() == 2
+    assert db.query(SubmissionModel.id).count() == existing_submissions_count + 2
+
+def test_scheduler_status_error(mock_env_access_key):
+    # pylint: disable=unused-argument
+    """ Test the scheduler leaving applications it couldn't mark as processing """
+    print("begin test_scheduler_status_error")
+    existing_submissions_count = db.query(SubmissionModel.id).count()
+    failing_id = mocks.BUILDING_PERMITS_EXPORT_QUERY[0]['_id']
+
+    def fake_log_status(status, formio_id):
+        # pylint: disable=unused-argument
+        if formio_id == failing_id:
+            raise requests.exceptions.HTTPError("500 Server Error")
+
+    with patch('tasks.requests.get') as mock_permits_query,\
+            patch('tasks.log_status', side_effect=fake_log_status),\
+            patch('tasks.bluebeam_export.apply_async') as mock_export:
+        mock_permits_query.return_value.json.return_value = mocks.BUILDING_PERMITS_EXPORT_QUERY
+        scheduler.s().apply()
+
+    assert mock_export.call_count == 1
+    assert db.query(SubmissionModel.id).count() == existing_submissions_count + 1
+    saved = db.query(SubmissionModel).order_by(SubmissionModel.id.desc()).first()
+    assert saved.data['_id'] != failing_id
+
+def test_scheduler_export_error(mock_env_access_key):
+    # pylint: disable=unused-argument
+    """ Test the scheduler putting applications back in the queue when their exports can't be saved """
+    print("begin test_scheduler_export_error")
+    existing_submissions_count = db.query(SubmissionModel.id).count()
+
+    with patch('tasks.requests.get') as mock_permits_query,\
+            patch('tasks.log_status') as mock_log_status,\
+            patch('tasks.create_exports', side_effect=Exception("commit failed")),\
+            patch('tasks.bluebeam_export.apply_async') as mock_export:
+        mock_permits_query.return_value.json.return_value = mocks.BUILDING_PERMITS_EXPORT_QUERY
+        with pytest.raises(Exception):
+            scheduler.s().apply(throw=True)
+
+    for application in mocks.BUILDING_PERMITS_EXPORT_QUERY:
+        assert [
+            call.args[0] for call in mock_log_status.call_args_list
+            if call.args[1] == application['_id']
+        ] == [{'actionState':'processing'}, {'actionState':'Bluebeam Q'}]
+    assert mock_export.call_count == 0
+    assert db.query(SubmissionModel.id).count() == existing_submissions_count
+
+def fake_applications_response(applications, status_code=200, headers=None):
+    """ a page of applications from the Building Permits API """
+    response = Mock()
+    response.status_code = status_code
+    response.headers = headers or {}
+    response.json.return_value = applications
+    return response
+
+def test_scheduler_pages(mock_env_access_key):
+    # pylint: disable=unused-argument
+    """ Test the scheduler reading queued applications a page at a time """
+    print("begin test_scheduler_pages")
+    first, second = mocks.BUILDING_PERMITS_EXPORT_QUERY
+    third = dict(first, _id='xxxcc015fefa4f42fec2dxxx')
+    invalid = {'_id': 'invalid', 'data': {}, 'files': [{'url': 'not a url'}]}
+
+    with patch('tasks.requests.get') as mock_permits_query,\
+            patch('tasks.utils.get_files', side_effect=lambda submission: submission.get('files', [])),\
+            patch('tasks.log_status'),\
+            patch('tasks.bluebeam_export.apply_async') as mock_export,\
+            patch('tasks.BUILDING_PERMITS_PAGE_SIZE', 2):
+        mock_permits_query.side_effect = [
+            fake_applications_response([first, second]),
+            fake_applications_response([invalid, third]),
+            fake_applications_response([])
+        ]
+        scheduler.s().apply()
+
+        assert mock_export.call_count == 3
+        queries = [call.kwargs['params'] for call in mock_permits_query.call_args_list]
+        assert [query['max'] for query in queries] == [2, 2, 2]
+        # the exported applications leave the queue, the invalid one stays in it
+        assert [query['skip'] for query in queries] == [0, 0, 1]
+        # an empty page after the first isn't remembered
+        assert get_poll_cursor(db, APPLICATIONS_CURSOR).etag is None
+        db.rollback()
+
+        # nothing queued, the empty response is remembered
+        mock_permits_query.reset_mock()
+        mock_permits_query.side_effect = [fake_applications_response([], headers={'ETag': '"empty"'})]
+        scheduler.s().apply()
+        assert mock_permits_query.call_args.kwargs['params']['skip'] == 0
+        assert 'If-None-Match' not in mock_permits_query.call_args.kwargs['headers']
+
+        # and checked on the next run
+        mock_permits_query.side_effect = [fake_applications_response(None, status_code=304)]
+        scheduler.s().apply()
+        assert mock_permits_query.call_args.kwargs['headers']['If-None-Match'] == '"empty"'
+        assert mock_export.call_count == 3
+
+def test_scheduler_requeued(mock_env_access_key):
+    # pylint: disable=unused-argument
+    """ Test the scheduler exporting an application again once it's queued again """
+    print("begin test_scheduler_requeued")
+    first, second = mocks.BUILDING_PERMITS_EXPORT_QUERY
+    with patch('tasks.requests.get') as mock_permits_query,\
+            patch('tasks.log_status'),\
+            patch('tasks.bluebeam_export.apply_async') as mock_export:
+        mock_permits_query.side_effect = [
+            fake_applications_response([first, second]),
+            # the older of the two is queued again after it failed
+            fake_applications_response([first])
+        ]
+        scheduler.s().apply()
+        scheduler.s().apply()
+
+    assert mock_export.call_count == 3
+    assert 'q' not in mock_permits_query.call_args.kwargs['params']
+    saved = db.query(SubmissionModel).order_by(SubmissionModel.id.desc()).limit(3)
+    assert [submission.data['_id'] for submission in saved] ==\
+        [first['_id'], second['_id'], first['_id']]
+
+def test_scheduler_last_modified(mock_env_access_key):
+    # pylint: disable=unused-argument
+    """ Test the scheduler sending If-Modified-Since when there's no ETag """
+    print("begin test_scheduler_last_modified")
+    last_modified = 'Sun, 18 Oct 2026 12:00:00 GMT'
+    with patch('tasks.requests.get') as mock_permits_query:
+        mock_permits_query.side_effect = [
+            fake_applications_response([], headers={'Last-Modified': last_modified}),
+            fake_applications_response(None, status_code=304)
+        ]
+        scheduler.s().apply()
+        scheduler.s().apply()
+    assert mock_permits_query.call_args.kwargs['headers']['If-Modified-Since'] == last_modified
+
 def test_export_task_new_project_webhook(mock_env_access_key):
     # pylint: disable=unused-argument
     """
@@ -988,7 +1144,7 @@ def test_export_task_new_project_webhook(mock_env_access_key):
     create_submission(db, data, export_obj.guid)
 
     # mock all responses for expected requests
-    with patch('service.resources.bluebeam.requests.request') as mock_post:
+    with patch('service.resources.bluebeam.http_session.request') as mock_post:
         fake_post_responses = []
         # refresh token
         fake_post_responses.append(Mock())
@@ -1004,9 +1160,6 @@ def test_export_task_new_project_webhook(mock_env_access_key):
             fake_post_responses.append(Mock())
             fake_post_responses[i].json.return_value = mocks.CREATE_FOLDER_RESPONSE
             i += 1
-        # get folders
-        fake_post_responses.append(Mock())
-        fake_post_responses[len(fake_post_responses)-1].json.return_value = mocks.GET_FOLDERS_RESPONSE
         # create folders
         fake_post_responses.append(Mock())
         fake_post_responses[len(fake_post_responses)-1].json.return_value = mocks.CREATE_FOLDER_RESPONSE
@@ -1075,7 +1228,7 @@ def test_export_task_new_project_webhook_error(mock_env_access_key):
     create_submission(db, data, export_obj.guid)
 
     # mock all responses for expected requests
-    with patch('service.resources.bluebeam.requests.request') as mock_post:
+    with patch('service.resources.bluebeam.http_session.request') as mock_post:
         fake_post_responses = []
         # refresh token
         fake_post_responses.append(Mock())
@@ -1091,9 +1244,6 @@ def test_export_task_new_project_webhook_error(mock_env_access_key):
             fake_post_responses.append(Mock())
             fake_post_responses[i].json.return_value = mocks.CREATE_FOLDER_RESPONSE
             i += 1
-        # get folders
-        fake_post_responses.append(Mock())
-        fake_post_responses[len(fake_post_responses)-1].json.return_value = mocks.GET_FOLDERS_RESPONSE
         # create folders
         fake_post_responses.append(Mock())
         fake_post_responses[len(fake_post_responses)-1].json.return_value = mocks.CREATE_FOLDER_RESPONSE
@@ -1146,3 +1296,1009 @@ def test_export_task_new_project_webhook_error(mock_env_access_key):
 
     # clear out the queue
     queue.control.purge()
+
+def test_upload_files_streams_large_file():
+    """ a large download goes to disk without being held in memory """
+    chunk_size = 1024 * 1024
+    chunk_count = 64
+
+    def synthetic_chunks(chunk_size):
+        for _ in range(chunk_count):
+            yield b'0' * chunk_size
+
+    uploaded_sizes = []
+    def fake_upload_file(access, project_id, file_name, file_path, folder_id, folder_index, folder_lock): # pylint: disable=unused-argument,too-many-arguments
+        uploaded_sizes.append(os.path.getsize(file_path))
+
+    with patch('tasks.requests.get') as mock_get:
+        mock_get.return_value.headers = {}
+        mock_get.return_value.iter_content.side_effect = synthetic_chunks
+        with patch('tasks.bluebeam.upload_file', side_effect=fake_upload_file):
+            tracemalloc.start()
+            upload_files(
+                '123-456-789',
+                1234,
+                [{'url': 'https://large.file/plans.pdf', 'originalName': 'plans.pdf'}],
+                {'access_token': 'secret'},
+                {}
+            )
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+    print("peak memory for {0} bytes: {1} bytes".format(chunk_size * chunk_count, peak))
+    assert uploaded_sizes == [chunk_size * chunk_count]
+    assert peak < chunk_size * 4
+
+def test_save_response_too_large(tmp_path):
+    """ downloads over the size limit are refused """
+    file_path = str(tmp_path / 'too_large.pdf')
+
+    # known length over the limit fails before reading
+    response = Mock()
+    response.headers = {'Content-Length': '2048'}
+    with pytest.raises(Exception, match=ERR_DOWNLOAD_TOO_LARGE):
+        save_response(response, file_path, max_bytes=1024)
+    response.iter_content.assert_not_called()
+
+    # unknown length fails once the stream passes the limit
+    response = Mock()
+    response.headers = {}
+    response.iter_content.return_value = [b'0' * 1000, b'0' * 1000]
+    with pytest.raises(Exception, match=ERR_DOWNLOAD_TOO_LARGE):
+        save_response(response, file_path, max_bytes=1024)
+
+def test_upload_files_download_error():
+    """ a failed download closes the response and cleans up """
+    with patch('tasks.requests.get') as mock_get:
+        mock_get.return_value.headers = {'Content-Length': str(10 * 1024 * 1024 * 1024)}
+        with pytest.raises(Exception, match=ERR_DOWNLOAD_TOO_LARGE):
+            upload_files(
+                '123-456-789',
+                1234,
+                [{'url': 'https://large.file/plans.pdf', 'originalName': 'plans.pdf'}],
+                {'access_token': 'secret'},
+                {}
+            )
+        mock_get.return_value.close.assert_called_once()
+
+def test_upload_files_stream_passthrough():
+    """ with streaming uploads on, a file of known length never touches disk """
+    with open(TEST_PDF, 'rb') as f: # pylint: disable=invalid-name
+        pdf = f.read()
+    uploaded = {}
+
+    def fake_bluebeam_request(method, url, **kwargs):
+        response = Mock()
+        if url.endswith('/files'):
+            response.json.return_value = mocks.INIT_FILE_UPLOAD_RESPONSE
+        elif method == 'put':
+            uploaded['body'] = kwargs['data'].read()
+            uploaded['length'] = kwargs['data'].len
+        else:
+            response.status_code = 204
+        return response
+
+    folder_index = {bluebeam.SUBMITTAL_DIR_NAME + " " + str(datetime.date.today()): 1234}
+    with patch('tasks.STREAM_UPLOADS', True):
+        with patch('tasks.requests.get') as mock_get:
+            mock_get.return_value.headers = {'Content-Length': str(len(pdf))}
+            mock_get.return_value.raw = BytesIO(pdf)
+            with patch('service.resources.bluebeam.http_session.request') as mock_reqs:
+                mock_reqs.side_effect = fake_bluebeam_request
+                with patch('tasks.tempfile.mkdtemp') as mock_mkdtemp:
+                    upload_files(
+                        '123-456-789',
+                        1234,
+                        mocks.SUBMISSION_POST_DATA['files'],
+                        {'access_token': 'secret'},
+                        folder_index
+                    )
+
+    mock_mkdtemp.assert_not_called()
+    assert uploaded['body'] == pdf
+    assert uploaded['length'] == len(pdf)
+
+def test_upload_files_stream_passthrough_uploaded():
+    """ a streamed file is recorded, sending it again goes through disk to be skipped """
+    with open(TEST_PDF, 'rb') as f: # pylint: disable=invalid-name
+        pdf = f.read()
+    files = mocks.SUBMISSION_POST_DATA['files'][:1]
+    uploaded = []
+    def fake_upload_file(access, project_id, file_name, source, folder_id, folder_index, folder_lock): # pylint: disable=unused-argument,too-many-arguments
+        uploaded.append(source.read())
+
+    def fake_download(url, params=None, headers=None, stream=False): # pylint: disable=unused-argument
+        response = Mock()
+        response.status_code = 200
+        response.headers = {'Content-Length': str(len(pdf))}
+        response.raw = BytesIO(pdf)
+        response.iter_content.return_value = [pdf]
+        return response
+
+    with patch('tasks.STREAM_UPLOADS', True),\
+        patch('tasks.requests.get', side_effect=fake_download),\
+        patch('tasks.bluebeam.upload_file', side_effect=fake_upload_file),\
+        patch('tasks.tempfile.mkdtemp', wraps=tempfile.mkdtemp) as mock_mkdtemp:
+        upload_files('123-456-789', 1234, files, {'access_token': 'secret'}, {})
+        mock_mkdtemp.assert_not_called()
+        assert uploaded == [pdf]
+
+        upload_files('123-456-789', 1234, files, {'access_token': 'secret'}, {})
+        mock_mkdtemp.assert_called_once()
+        assert uploaded == [pdf]
+
+def test_get_passthrough_length():
+    """ only plain downloads of a known length are passed through """
+    response = Mock()
+
+    response.headers = {'Content-Length': '1024'}
+    assert get_passthrough_length(response) == 1024
+
+    # unknown length falls back to disk
+    response.headers = {}
+    assert get_passthrough_length(response) is None
+
+    # encoded body length doesn't match the file length
+    response.headers = {'Content-Length': '1024', 'Content-Encoding': 'gzip'}
+    assert get_passthrough_length(response) is None
+
+    response.headers = {'Content-Length': str(10 * 1024 * 1024 * 1024)}
+    with pytest.raises(Exception, match=ERR_DOWNLOAD_TOO_LARGE):
+        get_passthrough_length(response)
+
+def fake_parallel_bluebeam(state, fail_on=None):
+    """ fake bluebeam api which tracks how many uploads are in flight """
+    lock = threading.Lock()
+
+    def fake_request(method, url, **kwargs): # pylint: disable=unused-argument
+        response = Mock()
+        if url.endswith('/folders'):
+            with lock:
+                state['folders_created'] += 1
+            response.json.return_value = mocks.CREATE_FOLDER_RESPONSE
+        elif url.endswith('/files'):
+            response.json.return_value = mocks.INIT_FILE_UPLOAD_RESPONSE
+        elif method == 'put':
+            with lock:
+                state['in_flight'] += 1
+                state['max_in_flight'] = max(state['max_in_flight'], state['in_flight'])
+            time.sleep(0.05)
+            with lock:
+                state['in_flight'] -= 1
+                state['uploads'] += 1
+            if fail_on is not None and state['uploads'] == fail_on:
+                raise Exception("Upload failed")
+        else:
+            response.status_code = 204
+        return response
+    return fake_request
+
+def test_upload_files_parallel():
+    """ files of a submission are uploaded concurrently up to the limit """
+    files = [
+        {'url': 'https://files.test/sheet{0}.pdf'.format(i), 'originalName': 'sheet{0}.pdf'.format(i)}
+        for i in range(6)
+    ]
+    state = {'folders_created': 0, 'in_flight': 0, 'max_in_flight': 0, 'uploads': 0}
+
+    with patch('tasks.MAX_PARALLEL_UPLOADS', 3):
+        with patch('tasks.requests.get') as mock_get:
+            mock_get.return_value.headers = {}
+            mock_get.return_value.iter_content.return_value = [b'%PDF-1.4']
+            with patch('service.resources.bluebeam.http_session.request') as mock_reqs:
+                mock_reqs.side_effect = fake_parallel_bluebeam(state)
+                timings = upload_files('123-456-789', 1234, files, {'access_token': 'secret'}, {})
+
+    assert state['uploads'] == 6
+    assert 1 < state['max_in_flight'] <= 3
+    # today's folder is only created once
+    assert state['folders_created'] == 1
+    assert [timing['name'] for timing in timings] == [f['originalName'] for f in files]
+    assert all(timing['seconds'] > 0 for timing in timings)
+
+def test_upload_files_parallel_error():
+    """ one failed upload fails the whole batch """
+    files = [
+        {'url': 'https://files.test/sheet{0}.pdf'.format(i), 'originalName': 'sheet{0}.pdf'.format(i)}
+        for i in range(6)
+    ]
+    state = {'folders_created': 0, 'in_flight': 0, 'max_in_flight': 0, 'uploads': 0}
+
+    with patch('tasks.MAX_PARALLEL_UPLOADS', 2):
+        with patch('tasks.requests.get') as mock_get:
+            mock_get.return_value.headers = {}
+            mock_get.return_value.iter_content.return_value = [b'%PDF-1.4']
+            with patch('service.resources.bluebeam.http_session.request') as mock_reqs:
+                mock_reqs.side_effect = fake_parallel_bluebeam(state, fail_on=1)
+                with pytest.raises(Exception, match="Upload failed"):
+                    upload_files('123-456-789', 1234, files, {'access_token': 'secret'}, {})
+
+    # files queued behind the failure are never started
+    assert state['uploads'] < 6
+    assert state['in_flight'] == 0
+
+def test_export_task_fan_out(mock_env_access_key):
+    # pylint: disable=unused-argument
+    """ each submission of an export gets its own subtask """
+    test_utils.finish_submissions_exports()
+    export_obj = create_export(db)
+    first = create_submission(db, mocks.SUBMISSION_POST_DATA, export_obj.guid)
+    second = create_submission(db, mocks.RESUBMISSION_POST_DATA, export_obj.guid)
+
+    with patch('tasks.celery.chord') as mock_chord:
+        # called directly the task isn't eager so the chord is queued
+        bluebeam_export(export_obj.guid) # pylint: disable=no-value-for-parameter
+
+    header, callback = mock_chord.call_args[0]
+    assert [subtask.args for subtask in header] == [(first.id,), (second.id,)]
+    assert callback.args == (export_obj.guid,)
+    mock_chord.return_value.apply_async.assert_called_once()
+
+def test_export_task_no_submissions():
+    """ an export without submissions finishes right away """
+    export_obj = create_export(db)
+
+    bluebeam_export.s(export_id=export_obj.guid).apply()
+
+    db.refresh(export_obj)
+    assert export_obj.date_finished is not None
+    assert export_obj.result == {'success': [], 'failure': []}
+
+def test_export_task_token_error(mock_env_access_key):
+    # pylint: disable=unused-argument
+    """ a failed token fetch fails the submission and the export still finishes """
+    test_utils.finish_submissions_exports()
+    export_obj = create_export(db)
+    submission = create_submission(db, mocks.SUBMISSION_POST_DATA, export_obj.guid)
+
+    with patch('tasks.bluebeam.get_auth_token', side_effect=Exception('token refresh failed')),\
+            patch('tasks.requests.patch') as mock_patch:
+        bluebeam_export.s(export_id=export_obj.guid).apply()
+
+    db.refresh(export_obj)
+    db.refresh(submission)
+    assert export_obj.date_finished is not None
+    assert [status['id'] for status in export_obj.result['failure']] == [submission.id]
+    assert submission.error_message == 'token refresh failed'
+    assert submission.date_exported is None
+    # the failure is reported
+    assert mock_patch.call_args.kwargs['json']['bluebeamStatus'] == 'Error'
+
+def test_export_metrics(mock_env_access_key, tmp_path):
+    # pylint: disable=unused-argument
+    """ both runners log the worker's retry and cache counters once they're done exporting """
+    test_utils.finish_submissions_exports()
+    cache = DownloadCache(str(tmp_path / 'cache'), 1024 * 1024)
+    cache.metrics.update({'hits': 3, 'misses': 1})
+    for runner in ('chord', 'async'):
+        export_obj = create_export(db)
+        submission = create_submission(db, mocks.SUBMISSION_POST_DATA, export_obj.guid)
+        with patch('tasks.EXPORT_RUNNER', runner),\
+                patch.dict(bluebeam_log.retry_metrics, {'GET /projects/{id} 503': 2}, clear=True),\
+                patch('service.resources.submission_files.download_cache', cache),\
+                patch('tasks.bluebeam.get_auth_token', side_effect=Exception('token refresh failed')),\
+                patch('tasks.requests.patch'),\
+                patch.object(bluebeam_log.logger, 'log') as mock_log:
+            bluebeam_export.s(export_id=export_obj.guid).apply()
+
+        entries = [json.loads(call.args[1]) for call in mock_log.call_args_list]
+        [metrics] = [entry for entry in entries if entry['event'] == 'export_metrics']
+        assert metrics['retries'] == {'GET /projects/{id} 503': 2}
+        assert metrics['download_cache'] == {'hits': 3, 'misses': 1, 'evictions': 0}
+        if runner == 'chord':
+            assert metrics['submission_id'] == submission.id
+        else:
+            assert metrics['export_id'] == str(export_obj.guid)
+
+def test_finish_export():
+    """ subtask results are grouped into the export status """
+    export_obj = create_export(db)
+    results = [
+        ('success', {'submission_id': 1, 'bluebeam_id': '123-456-789', 'file_timings': []}),
+        ('failure', {'id': 2, 'data': {}, 'err': 'Error'}),
+        ('success', {'submission_id': 3, 'bluebeam_id': '987-654-321', 'file_timings': []})
+    ]
+
+    finish_export.s(results, export_obj.guid).apply()
+
+    db.refresh(export_obj)
+    assert export_obj.date_finished is not None
+    assert [status['submission_id'] for status in export_obj.result['success']] == [1, 3]
+    assert [status['id'] for status in export_obj.result['failure']] == [2]
+
+def http_response(status_code, content=b'', json_body=None, url=''):
+    """ a requests response with the given body """
+    response = requests.Response()
+    response.status_code = status_code
+    response.url = url
+    response.raw = BytesIO(json.dumps(json_body).encode() if json_body is not None else content)
+    return response
+
+class FakeBluebeam(): # pylint: disable=too-many-instance-attributes
+    """
+        bluebeam, cloud storage and the upload urls for exports run by export_async
+        files named broken.pdf fail to upload
+    """
+    def __init__(self, fail_delete=False):
+        self.fail_delete = fail_delete
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.uploads = []
+        self.deleted = []
+        self.events = []
+        # submissions whose permissions were queued, set by export_async
+        self.deferred = []
+
+    def get(self, url, params=None, headers=None, stream=False): # pylint: disable=unused-argument
+        """ downloads a submission file """
+        with self.lock:
+            self.events.append('download')
+            # downloads are where submissions overlap
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.05)
+        with self.lock:
+            self.in_flight -= 1
+        if url.endswith('missing.pdf'):
+            return http_response(404, url=url)
+        name = (params or {}).get('name', '')
+        with open(ZIP_FILE if name.endswith('.zip') else TEST_PDF, 'rb') as file_obj:
+            return http_response(200, file_obj.read(), url=url)
+
+    def request(self, method, url, data=None, json=None, headers=None): # pylint: disable=unused-argument,redefined-outer-name,too-many-return-statements
+        """ a call to bluebeam or to an upload url """
+        method, path = method.upper(), urlparse(url).path
+        if url.startswith(mocks.INIT_FILE_UPLOAD_RESPONSE['UploadUrl']):
+            with self.lock:
+                self.events.append('upload')
+                self.uploads.append(data.read())
+            return http_response(500 if path == '/broken' else 200, url=url)
+
+        path = path[len(urlparse(bluebeam.BLUEBEAM_API_BASE_URL).path):]
+        if method == 'POST' and path == '/projects':
+            time.sleep(0.05)
+            self.events.append('project')
+            return http_response(200, json_body=mocks.CREATE_PROJECT_RESPONSE)
+        if method == 'GET' and path.endswith('/folders'):
+            return http_response(200, json_body=mocks.GET_FOLDERS_RESPONSE)
+        if method == 'POST' and path.endswith('/folders'):
+            self.events.append('folder')
+            return http_response(200, json_body=mocks.CREATE_FOLDER_RESPONSE)
+        if method == 'POST' and path.endswith('/files'):
+            upload = dict(mocks.INIT_FILE_UPLOAD_RESPONSE)
+            if json['Name'] == 'broken.pdf':
+                upload['UploadUrl'] += '/broken'
+            return http_response(200, json_body=upload)
+        if method == 'GET' and path.endswith('/users'):
+            self.events.append('users')
+            return http_response(200, json_body=mocks.GET_PROJECT_USERS_RESPONSE)
+        if method == 'GET' and path.startswith('/projects/'):
+            return http_response({
+                '/projects/999-999-999': 404,
+                '/projects/000-000-000': 204,
+                '/projects/403-403-403': 403
+            }.get(path, 200), url=url)
+        if method == 'DELETE':
+            self.deleted.append(path)
+            if self.fail_delete:
+                raise requests.exceptions.ConnectionError('refused')
+        return http_response(204)
+
+def export_async(export_obj, fake, log_status_error=None):
+    """ runs an export with the async runner against fake """
+    with patch('tasks.EXPORT_RUNNER', 'async'), patch('tasks.MAX_ASYNC_EXPORTS', 3),\
+        patch('service.resources.bluebeam.http_session.request', side_effect=fake.request),\
+        patch('service.resources.bluebeam.sleep'),\
+        patch('tasks.requests.get', side_effect=fake.get),\
+        patch('tasks.requests.patch') as mock_patch,\
+        patch('tasks.assign_permissions') as mock_assign_permissions:
+        mock_patch.status_code = 200
+        mock_patch.side_effect = log_status_error
+        bluebeam_export.s(export_id=export_obj.guid).apply()
+    fake.deferred = [call[1]['args'] for call in mock_assign_permissions.apply.call_args_list]
+    db.refresh(export_obj)
+
+def test_export_task_async(mock_env_access_key):
+    # pylint: disable=unused-argument
+    """ the async runner exports submissions concurrently from one event loop """
+    test_utils.finish_submissions_exports()
+    bluebeam.save_auth_token(db, test_utils.BLUEBEAM_ACCESS_TOKEN)
+    export_obj = create_export(db)
+    for i in range(5):
+        data = mocks.SUBMISSION_POST_DATA.copy()
+        data['_id'] = str(i)
+        create_submission(db, data, export_obj.guid)
+    fake = FakeBluebeam()
+
+    # every project the fake creates has the same id
+    with patch('tasks.is_uploaded', return_value=False):
+        export_async(export_obj, fake)
+
+    assert export_obj.date_finished is not None
+    assert len(export_obj.result['success']) == 5
+    assert len(export_obj.result['failure']) == 0
+    assert 1 < fake.max_in_flight <= 3
+    # permissions are assigned once the exports are reported
+    assert 'users' not in fake.events
+    assert sorted(fake.deferred) == sorted(
+        (status['submission_id'],) for status in export_obj.result['success']
+    )
+
+    with open(TEST_PDF, 'rb') as file_obj:
+        pdf = file_obj.read()
+    assert fake.uploads == [pdf] * 5
+    # files are downloaded while the projects are created
+    assert fake.events.index('download') < fake.events.index('project')
+
+def test_export_task_async_errors(mock_env_access_key):
+    # pylint: disable=unused-argument
+    """ async exports fail or succeed independently of each other """
+    test_utils.finish_submissions_exports()
+    bluebeam.save_auth_token(db, test_utils.BLUEBEAM_ACCESS_TOKEN)
+    export_obj = create_export(db)
+    zipped = mocks.RESUBMISSION_POST_DATA.copy()
+    zipped['files'] = mocks.SUBMISSION_POST_DATA_ZIP['files']
+    zipped = create_submission(db, zipped, export_obj.guid)
+    no_project = mocks.RESUBMISSION_POST_DATA.copy()
+    no_project['project_id'] = '999-999-999'
+    no_project = create_submission(db, no_project, export_obj.guid)
+    broken = mocks.SUBMISSION_POST_DATA.copy()
+    broken['files'] = [
+        mocks.SUBMISSION_POST_DATA['files'][0],
+        dict(mocks.SUBMISSION_POST_DATA['files'][0], originalName='broken.pdf')
+    ]
+    broken = create_submission(db, broken, export_obj.guid)
+    no_files = mocks.SUBMISSION_POST_DATA.copy()
+    del no_files['files']
+    no_files = create_submission(db, no_files, export_obj.guid)
+    missing = mocks.SUBMISSION_POST_DATA.copy()
+    missing['files'] = [{'url': 'https://www.w3.org/missing.pdf', 'originalName': 'missing.pdf'}]
+    missing = create_submission(db, missing, export_obj.guid)
+    fake = FakeBluebeam()
+
+    # one file of a submission at a time, so the good file of broken is
+    # always uploaded before broken.pdf fails
+    with patch('tasks.MAX_PARALLEL_UPLOADS', 1):
+        export_async(export_obj, fake)
+
+    assert [status['submission_id'] for status in export_obj.result['success']] == \
+        [zipped.id, no_files.id]
+    failures = {status['id']: status['err'] for status in export_obj.result['failure']}
+    assert '404' in failures[no_project.id]
+    assert broken.id in failures
+    assert '404' in failures[missing.id]
+    # nothing exports the failed new submissions again, their projects are removed
+    assert fake.deleted == ['/projects/' + mocks.CREATE_PROJECT_RESPONSE['Id']] * 2
+    db.refresh(broken)
+    assert not broken.checkpoint
+    assert fake.deferred == [(no_files.id,)]
+    # both pdfs of the zip were uploaded
+    assert len(fake.uploads) == 4
+
+def test_export_task_lookup_errors(mock_env_access_key):
+    # pylint: disable=unused-argument
+    """ a submission that can't be read or resumed fails on its own, with either runner """
+    test_utils.finish_submissions_exports()
+    bluebeam.save_auth_token(db, test_utils.BLUEBEAM_ACCESS_TOKEN)
+    export_obj = create_export(db)
+    submission = create_submission(db, mocks.SUBMISSION_POST_DATA, export_obj.guid)
+    with patch('tasks.get_checkpoint', side_effect=Exception('checkpoint lookup failed')),\
+        patch('service.resources.bluebeam.http_session.request') as mock_reqs:
+        bluebeam_export.s(export_id=export_obj.guid).apply()
+    db.refresh(export_obj)
+    db.refresh(submission)
+    assert export_obj.result['failure'][0]['err'] == 'checkpoint lookup failed'
+    assert submission.error_message == 'checkpoint lookup failed'
+    mock_reqs.assert_not_called()
+
+    failed = create_submission(db, mocks.SUBMISSION_POST_DATA, export_obj.guid)
+    def export(submission_id):
+        if submission_id == failed.id:
+            raise Exception('db went away')
+        return run_export(submission_id)
+
+    export_obj = create_export(db)
+    for submission in (failed, submission):
+        submission.export_status_guid = export_obj.guid
+    db.commit()
+    fake = FakeBluebeam()
+    with patch('tasks.run_export', side_effect=export):
+        export_async(export_obj, fake)
+    assert export_obj.result['failure'] == [{'id': failed.id, 'data': None, 'err': 'db went away'}]
+    assert [status['submission_id'] for status in export_obj.result['success']] == [submission.id]
+
+    # the submission is gone
+    assert run_export(0) == ('failure', {
+        'id': 0,
+        'data': None,
+        'err': "'NoneType' object has no attribute 'id'"
+    })
+
+def test_export_task_async_cleanup_errors(mock_env_access_key):
+    # pylint: disable=unused-argument
+    """ failing to delete a project or to log the error doesn't stop the export """
+    test_utils.finish_submissions_exports()
+    bluebeam.save_auth_token(db, test_utils.BLUEBEAM_ACCESS_TOKEN)
+    export_obj = create_export(db)
+    no_project = mocks.RESUBMISSION_POST_DATA.copy()
+    no_project['project_id'] = '000-000-000'
+    no_project = create_submission(db, no_project, export_obj.guid)
+    broken = mocks.SUBMISSION_POST_DATA.copy()
+    broken['files'] = [dict(mocks.SUBMISSION_POST_DATA['files'][0], originalName='broken.pdf')]
+    broken = create_submission(db, broken, export_obj.guid)
+    fake = FakeBluebeam(fail_delete=True)
+
+    export_async(export_obj, fake, Exception('log status error'))
+
+    assert export_obj.date_finished is not None
+    failures = {status['id']: status['err'] for status in export_obj.result['failure']}
+    assert failures[no_project.id] == ERR_INVALID_PROJECT_ID
+    assert broken.id in failures
+    assert set(fake.deleted) == {'/projects/' + mocks.CREATE_PROJECT_RESPONSE['Id']}
+    # the project is still there, so is its checkpoint
+    db.refresh(broken)
+    assert broken.checkpoint['project_id'] == mocks.CREATE_PROJECT_RESPONSE['Id']
+
+def fake_pipelined_bluebeam(events, project_error=None, project_status=200):
+    """ fake bluebeam api with a slow project creation which records the order of calls """
+    def fake_request(method, url, **kwargs): # pylint: disable=unused-argument
+        response = Mock()
+        response.status_code = 200
+        if url.endswith('/projects'):
+            time.sleep(0.1)
+            if project_error is not None:
+                raise project_error
+            events.append('project')
+            response.json.return_value = mocks.CREATE_PROJECT_RESPONSE
+        elif url.endswith('/folders') and method == 'get':
+            events.append('folders')
+            response.json.return_value = mocks.GET_FOLDERS_RESPONSE
+        elif method == 'get' and '/projects/' in url and not url.endswith('/users'):
+            events.append('exists')
+            response.status_code = project_status
+            response.ok = project_status < 400
+            if not response.ok:
+                response.raise_for_status.side_effect = requests.exceptions.HTTPError(
+                    response=response
+                )
+        elif url.endswith('/folders'):
+            events.append('folder')
+            response.json.return_value = mocks.CREATE_FOLDER_RESPONSE
+        elif url.endswith('/files'):
+            response.json.return_value = mocks.INIT_FILE_UPLOAD_RESPONSE
+        elif url.endswith('/users') and method == 'get':
+            response.json.return_value = mocks.GET_PROJECT_USERS_RESPONSE
+        else:
+            events.append(method)
+            response.status_code = 204
+        return response
+    return fake_request
+
+def test_export_to_bluebeam_pipelined():
+    """ files of a new project are downloaded while the project is created """
+    events = []
+    def fake_download(url, **kwargs): # pylint: disable=unused-argument
+        events.append('download')
+        response = Mock()
+        response.headers = {}
+        response.iter_content.return_value = [b'%PDF-1.4']
+        return response
+
+    submission = create_submission(db, mocks.SUBMISSION_POST_DATA_WEBHOOK)
+    export = start_export(submission)
+    with patch('tasks.requests.get', side_effect=fake_download):
+        with patch('service.resources.bluebeam.http_session.request') as mock_reqs:
+            mock_reqs.side_effect = fake_pipelined_bluebeam(events)
+            export_to_bluebeam(submission, {'access_token': 'secret'}, export)
+
+    assert export['project_id'] == mocks.CREATE_PROJECT_RESPONSE['Id']
+    assert [timing['name'] for timing in export['file_timings']] == ['dummy.pdf']
+    assert export['permissions'] == PERMISSIONS_PENDING
+    assert events.index('download') < events.index('project')
+    # uploads wait for the tree, the last folder is today's submittal folder
+    assert events.count('folder') == 8
+    assert events.index('put') > events.index('folder') + 6
+
+def test_export_to_bluebeam_pipelined_errors():
+    """
+        a project created while a download failed is kept for the next export
+        of its application, without an application there's no next export
+        and the project is removed
+    """
+    def export(data):
+        events = []
+        submission = create_submission(db, data)
+        export = start_export(submission)
+        with patch('tasks.requests.get', side_effect=Exception('download failed')):
+            with patch('service.resources.bluebeam.http_session.request') as mock_reqs:
+                mock_reqs.side_effect = fake_pipelined_bluebeam(events)
+                with pytest.raises(Exception, match='download failed'):
+                    export_to_bluebeam(submission, {'access_token': 'secret'}, export)
+        db.refresh(submission)
+        return events, submission.checkpoint
+
+    events, checkpoint = export(dict(mocks.SUBMISSION_POST_DATA_WEBHOOK, _id='application-1'))
+    assert 'delete' not in events
+    assert checkpoint['project_id'] == mocks.CREATE_PROJECT_RESPONSE['Id']
+    assert len(checkpoint['folders']) == 7
+
+    events, checkpoint = export(mocks.SUBMISSION_POST_DATA_WEBHOOK)
+    assert events[-1] == 'delete'
+    assert not checkpoint
+
+    # a project that couldn't be created fails the export even without files
+    events = []
+    data = mocks.SUBMISSION_POST_DATA_WEBHOOK.copy()
+    data['files'] = []
+    submission = create_submission(db, data)
+    export = start_export(submission)
+    with patch('service.resources.bluebeam.http_session.request') as mock_reqs:
+        mock_reqs.side_effect = fake_pipelined_bluebeam(
+            events,
+            requests.exceptions.ConnectionError('refused')
+        )
+        with pytest.raises(requests.exceptions.ConnectionError):
+            export_to_bluebeam(submission, {'access_token': 'secret'}, export)
+    assert export['project_id'] is None
+    assert not events
+
+def test_export_to_bluebeam_resume():
+    """ a new project's export resumes after the steps an earlier export completed """
+    submission = create_submission(db, mocks.SUBMISSION_POST_DATA_WEBHOOK)
+    def fake_download(url, **kwargs): # pylint: disable=unused-argument
+        response = Mock()
+        response.headers = {}
+        response.iter_content.return_value = [b'%PDF-1.4']
+        return response
+
+    def export(checkpoint, project_status=200):
+        save_checkpoint(db, submission.id, checkpoint)
+        db.refresh(submission)
+        events = []
+        export_obj = start_export(submission)
+        with patch('tasks.requests.get', side_effect=fake_download):
+            with patch('service.resources.bluebeam.http_session.request') as mock_reqs:
+                mock_reqs.side_effect = fake_pipelined_bluebeam(events, project_status=project_status)
+                export_to_bluebeam(submission, {'access_token': 'secret'}, export_obj)
+        db.refresh(submission)
+        assert export_obj['project_id'] == submission.checkpoint['project_id']
+        return events
+
+    # the folders were all made, only today's submittal folder is created
+    events = export({'project_id': '111-111-111'})
+    assert events[:2] == ['exists', 'folders']
+    assert 'project' not in events
+    assert events.count('folder') == 1
+    assert 'put' in events
+    assert submission.checkpoint['project_id'] == '111-111-111'
+    assert submission.checkpoint['folders']['CCSF EPR'] == 147572933
+
+    # finished, the file is already uploaded
+    events = export(submission.checkpoint)
+    assert events == ['exists', 'folders']
+
+    # the project was deleted since
+    for project_status in (404, 204):
+        events = export({'project_id': '111-111-111'}, project_status)
+        assert 'project' in events
+        assert submission.checkpoint['project_id'] == mocks.CREATE_PROJECT_RESPONSE['Id']
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        export({'project_id': '111-111-111'}, 403)
+
+def test_export_task_resume_application(mock_env_access_key):
+    # pylint: disable=unused-argument
+    """
+        a re-queued application comes back as a new submission,
+        which resumes the project its failed submission left until it's exported
+    """
+    test_utils.finish_submissions_exports()
+    bluebeam.save_auth_token(db, test_utils.BLUEBEAM_ACCESS_TOKEN)
+    def export(data):
+        export_obj = create_export(db)
+        create_submission(db, data, export_obj.guid)
+        fake = FakeBluebeam()
+        export_async(export_obj, fake)
+        return fake, export_obj.result
+
+    broken = dict(mocks.SUBMISSION_POST_DATA, _id='application-1')
+    broken['files'] = [dict(mocks.SUBMISSION_POST_DATA['files'][0], originalName='broken.pdf')]
+    fake, result = export(broken)
+    assert result['failure']
+    assert 'project' in fake.events
+    assert not fake.deleted
+
+    fake, result = export(dict(mocks.SUBMISSION_POST_DATA, _id='application-1'))
+    assert result['success'][0]['bluebeam_id'] == mocks.CREATE_PROJECT_RESPONSE['Id']
+    # only today's submittal folder is created
+    assert 'project' not in fake.events
+    assert fake.events.count('folder') == 1
+    assert len(fake.uploads) == 1
+
+    # exported, so a later export of the application starts over
+    assert not db.query(SubmissionModel).filter(
+        SubmissionModel.checkpoint.isnot(None),
+        SubmissionModel.data.op('->>')('_id') == 'application-1'
+    ).count()
+    fake, result = export(dict(mocks.SUBMISSION_POST_DATA, _id='application-1'))
+    assert result['success']
+    assert 'project' in fake.events
+
+    # another application gets its own project
+    fake, result = export(dict(mocks.SUBMISSION_POST_DATA, _id='application-2'))
+    assert 'project' in fake.events
+
+def test_export_task_async_resume(mock_env_access_key):
+    # pylint: disable=unused-argument
+    """ the async runner resumes exports too """
+    bluebeam.save_auth_token(db, test_utils.BLUEBEAM_ACCESS_TOKEN)
+    def export(checkpoint):
+        test_utils.finish_submissions_exports()
+        export_obj = create_export(db)
+        submission = create_submission(db, mocks.SUBMISSION_POST_DATA, export_obj.guid)
+        save_checkpoint(db, submission.id, checkpoint)
+        fake = FakeBluebeam()
+        export_async(export_obj, fake)
+        db.refresh(submission)
+        return fake, export_obj.result, submission.checkpoint
+
+    fake, result, checkpoint = export({'project_id': '111-111-111'})
+    assert result['success'][0]['bluebeam_id'] == '111-111-111'
+    assert 'project' not in fake.events
+    assert fake.events.count('folder') == 1
+    assert len(fake.uploads) == 1
+
+    fake, result, _ = export(checkpoint)
+    assert result['success'][0]['bluebeam_id'] == '111-111-111'
+    assert not {'project', 'folder', 'users'} & set(fake.events)
+    assert not fake.uploads
+
+    fake, result, checkpoint = export({'project_id': '999-999-999'})
+    assert 'project' in fake.events
+    assert checkpoint['project_id'] == mocks.CREATE_PROJECT_RESPONSE['Id']
+
+    fake, result, _ = export({'project_id': '403-403-403'})
+    assert '403' in result['failure'][0]['err']
+    assert 'project' not in fake.events
+
+def make_zip(path):
+    """ a zip with pdfs at the top and in nested folders, and files that aren't pdfs """
+    with zipfile.ZipFile(path, 'w') as zip_file:
+        zip_file.writestr('plans.pdf', b'%PDF plans')
+        zip_file.writestr('sheets/', b'')
+        zip_file.writestr('sheets/A1.pdf', b'%PDF A1')
+        zip_file.writestr('sheets/deeper/B2.pdf', b'%PDF B2')
+        zip_file.writestr('sheets/notes.txt', b'notes')
+        zip_file.writestr('__MACOSX/sheets/._A1.pdf', b'resource fork')
+    return str(path)
+
+def test_upload_zip_streams_pdfs(tmp_path):
+    """ pdfs anywhere in a zip are streamed into their uploads without extracting anything """
+    uploaded = []
+    def fake_upload_file(access, project_id, file_name, source, folder_id, folder_index, folder_lock): # pylint: disable=unused-argument,too-many-arguments
+        uploaded.append((file_name, source.len, source.read()))
+
+    with patch('tasks.bluebeam.upload_file', side_effect=fake_upload_file):
+        with patch('tasks.tempfile.mkdtemp') as mock_mkdtemp:
+            upload_zip(
+                {'access_token': 'secret'},
+                lambda: ('123-456-789', 1234),
+                make_zip(tmp_path / 'plans.zip'),
+                {},
+                threading.Lock()
+            )
+    mock_mkdtemp.assert_not_called()
+    assert uploaded == [
+        ('plans.pdf', 10, b'%PDF plans'),
+        ('A1.pdf', 7, b'%PDF A1'),
+        ('B2.pdf', 7, b'%PDF B2')
+    ]
+
+def test_upload_zip_limits(tmp_path):
+    """ zips over the limits fail from their central directory before anything is uploaded """
+    bomb = str(tmp_path / 'bomb.zip')
+    with zipfile.ZipFile(bomb, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr('plans.pdf', b'0' * 1024 * 1024)
+    plans = make_zip(tmp_path / 'plans.zip')
+
+    cases = [
+        (plans, 'service.resources.submission_files.MAX_ZIP_FILES', 5, ERR_ZIP_TOO_MANY_FILES),
+        (plans, 'service.resources.submission_files.MAX_ZIP_UNCOMPRESSED_BYTES', 20, ERR_ZIP_TOO_LARGE),
+        (bomb, 'service.resources.submission_files.MAX_ZIP_RATIO', 100, ERR_ZIP_RATIO)
+    ]
+    for zip_path, limit, value, err_msg in cases:
+        destination = Mock()
+        with patch(limit, value), patch('tasks.bluebeam.upload_file') as mock_upload_file:
+            with pytest.raises(Exception, match=err_msg):
+                upload_zip({'access_token': 'secret'}, destination, zip_path, {}, threading.Lock())
+            with pytest.raises(Exception, match=err_msg):
+                check_zip_limits(zip_path)
+        destination.assert_not_called()
+        mock_upload_file.assert_not_called()
+
+    # within the limits
+    with patch('service.resources.submission_files.MAX_ZIP_FILES', 6),\
+        patch('service.resources.submission_files.MAX_ZIP_UNCOMPRESSED_BYTES', 24):
+        check_zip_limits(plans)
+
+def test_upload_files_download_cache(tmp_path):
+    """ a file downloaded by an earlier export is taken from the cache once the server agrees """
+    cache = DownloadCache(str(tmp_path / 'cache'), 1024 * 1024)
+    files = [{'url': 'https://bucketeer.com/plans.pdf', 'originalName': 'plans.pdf'}]
+    uploaded = []
+    def fake_upload_file(access, project_id, file_name, file_path, folder_id, folder_index, folder_lock): # pylint: disable=unused-argument,too-many-arguments
+        with open(file_path, 'rb') as file_obj:
+            uploaded.append(file_obj.read())
+
+    def fake_download(url, params=None, headers=None, stream=False): # pylint: disable=unused-argument
+        response = Mock()
+        if headers and headers.get('If-None-Match') == '"v1"':
+            response.status_code = 304
+            return response
+        response.status_code = 200
+        response.headers = {'ETag': '"v1"'}
+        response.iter_content.return_value = [b'%PDF plans']
+        return response
+
+    with patch('service.resources.submission_files.download_cache', cache), patch('tasks.requests.get') as mock_get:
+        mock_get.side_effect = fake_download
+        with patch('tasks.bluebeam.upload_file', side_effect=fake_upload_file):
+            first = upload_files('123-456-789', 1234, files, {'access_token': 'secret'}, {})
+            second = upload_files('123-456-780', 1234, files, {'access_token': 'secret'}, {})
+
+            # evicted between the request and the checkout
+            os.remove(cache.blob_path(cache.get_entry(files[0]['url'])['sha256']))
+            with patch.object(cache, 'validators', return_value={'If-None-Match': '"v1"'}):
+                third = upload_files('123-456-781', 1234, files, {'access_token': 'secret'}, {})
+
+    assert [timings[0]['cached'] for timings in (first, second, third)] == [False, True, False]
+    assert uploaded == [b'%PDF plans'] * 3
+    assert cache.get_metrics() == {'hits': 1, 'misses': 2, 'evictions': 0}
+
+def test_upload_files_skips_uploaded(tmp_path):
+    """
+        files a project already has are not uploaded again, zips are checked pdf by pdf
+        plans.pdf is the same at the top and in the zip, only the first is uploaded
+    """
+    with open(make_zip(tmp_path / 'plans.zip'), 'rb') as zip_file:
+        contents = {'plans.pdf': b'%PDF plans', 'plans.zip': zip_file.read()}
+    files = [
+        {'url': 'https://bucketeer.com/plans.pdf', 'originalName': 'plans.pdf'},
+        {'url': 'https://bucketeer.com/plans.zip', 'originalName': 'plans.zip'}
+    ]
+    uploaded = []
+    def fake_upload_file(access, project_id, file_name, source, folder_id, folder_index, folder_lock): # pylint: disable=unused-argument,too-many-arguments
+        uploaded.append((project_id, file_name))
+
+    def fake_download(url, params=None, headers=None, stream=False): # pylint: disable=unused-argument
+        response = Mock()
+        response.status_code = 200
+        response.headers = {}
+        response.iter_content.return_value = [contents[url.rsplit('/', 1)[-1]]]
+        return response
+
+    def export(project_id):
+        uploaded.clear()
+        upload_files(project_id, 1234, files, {'access_token': 'secret'}, {})
+        return sorted(uploaded)
+
+    # one file at a time so the top level plans.pdf is recorded before the zip's is checked
+    with patch('tasks.requests.get', side_effect=fake_download),\
+        patch('tasks.bluebeam.upload_file', side_effect=fake_upload_file),\
+        patch('tasks.MAX_PARALLEL_UPLOADS', 1):
+        assert export('123-456-789') == [
+            ('123-456-789', 'A1.pdf'),
+            ('123-456-789', 'B2.pdf'),
+            ('123-456-789', 'plans.pdf')
+        ]
+        # resubmitted
+        assert not export('123-456-789')
+
+        # another project
+        assert len(export('123-456-780')) == 3
+
+        # changed
+        contents['plans.pdf'] = b'%PDF plans v2'
+        assert export('123-456-789') == [('123-456-789', 'plans.pdf')]
+
+    # not recorded when the upload fails
+    contents['plans.pdf'] = b'%PDF plans v3'
+    with patch('tasks.requests.get', side_effect=fake_download),\
+        patch('tasks.bluebeam.upload_file', side_effect=Exception(ERR_UPLOAD_FAIL)):
+        with pytest.raises(Exception, match=ERR_UPLOAD_FAIL):
+            upload_files('123-456-789', 1234, files[:1], {'access_token': 'secret'}, {})
+    # one file at a time so the top level plans.pdf is recorded before the zip's is checked
+    with patch('tasks.requests.get', side_effect=fake_download),\
+        patch('tasks.bluebeam.upload_file', side_effect=fake_upload_file),\
+        patch('tasks.MAX_PARALLEL_UPLOADS', 1):
+        assert export('123-456-789') == [('123-456-789', 'plans.pdf')]
+
+def test_upload_once_records_after_upload():
+    """
+        a file is only recorded once its upload returns, an upload that fails or
+        is interrupted leaves no record and the next export uploads the file
+    """
+    uploads = []
+    def upload():
+        uploads.append(1)
+
+    for interrupted in (Exception(ERR_UPLOAD_FAIL), KeyboardInterrupt()):
+        with pytest.raises(type(interrupted)):
+            upload_once('123-456-789', 'plans.pdf', 10, 'sha', Mock(side_effect=interrupted))
+        assert not db.query(UploadedFileModel).count()
+
+    assert upload_once('123-456-789', 'plans.pdf', 10, 'sha', upload)
+    assert not upload_once('123-456-789', 'plans.pdf', 10, 'sha', upload)
+    assert uploads == [1]
+
+    # uploaded by another export at the same time, recorded once
+    with patch('tasks.is_uploaded', return_value=False):
+        assert upload_once('123-456-789', 'plans.pdf', 10, 'sha', upload)
+    assert uploads == [1, 1]
+    assert db.query(UploadedFileModel).count() == 1
+
+def test_export_defers_permissions(mock_env_access_key):
+    # pylint: disable=unused-argument
+    """ a new project's users are given access by a task of their own after the export """
+    test_utils.finish_submissions_exports()
+    bluebeam.save_auth_token(db, test_utils.BLUEBEAM_ACCESS_TOKEN)
+    export_obj = create_export(db)
+    data = mocks.SUBMISSION_POST_DATA_WEBHOOK.copy()
+    data['files'] = []
+    submission = create_submission(db, data, export_obj.guid)
+    events = []
+    def fake_trigger_webhook(webhook, payload, err_msg=None): # pylint: disable=unused-argument
+        events.append('reported')
+
+    with patch('service.resources.bluebeam.http_session.request') as mock_reqs,\
+        patch('tasks.trigger_webhook', side_effect=fake_trigger_webhook):
+        mock_reqs.side_effect = fake_pipelined_bluebeam(events)
+        bluebeam_export.s(export_id=export_obj.guid).apply()
+
+    db.refresh(export_obj)
+    db.refresh(submission)
+    assert export_obj.result['success'][0]['permissions'] == PERMISSIONS_PENDING
+    assert submission.permissions_status == PERMISSIONS_DONE
+    assert [result['email'] for result in submission.permissions_result['users']] == \
+        ['hello@local', 'world@local']
+    # reported before the users are added
+    assert events.index('reported') < events.index('post')
+
+def test_assign_permissions_retry():
+    """ a failed assignment is retried and recorded once the retries run out """
+    bluebeam.save_auth_token(db, test_utils.BLUEBEAM_ACCESS_TOKEN)
+    submission = create_submission(db, mocks.SUBMISSION_POST_DATA_WEBHOOK)
+    submission.bluebeam_project_id = '123-456-789'
+    db.commit()
+    report = [{'email': 'hello@local', 'added': True, 'full_access': True, 'error': None}]
+
+    with patch('tasks.bluebeam.assign_user_permissions') as mock_assign:
+        mock_assign.side_effect = [requests.exceptions.ConnectionError('refused'), report]
+        assign_permissions.apply(args=(submission.id,))
+    db.refresh(submission)
+    assert mock_assign.call_count == 2
+    assert mock_assign.call_args[0][1] == '123-456-789'
+    assert submission.permissions_status == PERMISSIONS_DONE
+    assert submission.permissions_result == {'users': report}
+
+    with patch('tasks.bluebeam.assign_user_permissions') as mock_assign,\
+        patch.object(assign_permissions, 'max_retries', 2):
+        mock_assign.side_effect = requests.exceptions.ConnectionError('refused')
+        assign_permissions.apply(args=(submission.id,))
+    db.refresh(submission)
+    assert mock_assign.call_count == 3
+    assert submission.permissions_status == PERMISSIONS_FAILED
+    assert submission.permissions_result == {'error': 'refused'}
+
+def test_defer_permissions():
+    """ permissions are queued for new projects only, in process when the export was """
+    results = [
+        ('success', {'submission_id': 1, 'permissions': PERMISSIONS_PENDING}),
+        ('success', {'submission_id': 2, 'permissions': None}),
+        ('failure', {'id': 3, 'err': 'failed'})
+    ]
+    with patch('tasks.assign_permissions') as mock_assign_permissions:
+        defer_permissions(SimpleNamespace(request=SimpleNamespace(is_eager=False)), results)
+    mock_assign_permissions.apply_async.assert_called_once_with(args=(1,))
+    mock_assign_permissions.apply.assert_not_called()